@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# Copyright Dansk Bibliotekscenter a/s. Licensed under GPLv3
+# See license text at https://opensource.dbc.dk/licenses/gpl-3.0
+
+""" Scaling benchmarks of the config merge and application diff cores
+
+    Every benchmark is run on synthetic input of growing size and the time
+    per call and peak memory are reported. Times are also stored relative
+    to a fixed calibration workload so baselines written on one machine can
+    be checked on another.
+
+    PYTHONPATH=src python3 benchmarks/benchmark.py --check benchmarks/baseline.json
+"""
+
+import argparse
+import collections
+import copy
+import json
+import os
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from mesos_tools import marathon_config_producer as producer
+from mesos_tools.marathon_deployer import Marathon
+
+SIZES = (10, 100, 1000)
+REPEAT = 3
+""" Runs per measurement, the fastest is kept """
+MIN_TIME = 0.05
+""" Seconds each run lasts at least, calls are repeated until then """
+LIST_SIZE = 20
+""" Entries of env, constraints and portDefinitions when they are not the size being scaled """
+CALIBRATION_REPEAT = 5
+CALIBRATION_TIME = 0.2
+""" The calibration is run longer than the benchmarks since every relative time depends on it """
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+def make_env(size):
+    return {"VAR_{}".format(i): "value-{}".format(i) for i in range(size)}
+
+def make_constraints(size):
+    return [["attribute{}".format(i), "LIKE", "value-{}".format(i)] for i in range(size)]
+
+def make_port_definitions(size):
+    return [{"port": 10000 + i, "protocol": "tcp", "name": "port{}".format(i)} for i in range(size)]
+
+def make_app(app_id, list_size=LIST_SIZE):
+    return {"id": app_id, "instances": 2, "cpus": 0.5, "mem": 256, "cmd": "run.sh",
+            "env": make_env(list_size), "constraints": make_constraints(list_size),
+            "portDefinitions": make_port_definitions(list_size), "labels": {"team": "platform"}}
+
+def make_app_response(app, tasks):
+    """ returns app as marathon would list it, with the given number of running and healthy tasks """
+    response = copy.deepcopy(app)
+    response["version"] = "2017-04-26T08:12:05.580Z"
+    response["tasks"] = [{"id": "{}.{}".format(app["id"].strip("/").replace("/", "_"), i), "appId": app["id"],
+                          "host": "host{}".format(i % 50), "ports": [31000 + i % 1000], "state": "TASK_RUNNING",
+                          "version": response["version"], "healthCheckResults": [{"alive": True}]}
+                         for i in range(tasks)]
+    return response
+
+def write_json(path, data):
+    with open(path, "w") as json_file:
+        json.dump(data, json_file)
+
+def write_extends_chain(root, depth, list_size=LIST_SIZE):
+    """ writes a base template, depth templates each extending the previous one and an instance extending the
+        last, returning the path of the instance
+    """
+    write_json(os.path.join(root, "template-0.template"), make_app("/base", list_size))
+    for i in range(1, depth + 1):
+        write_json(os.path.join(root, "template-{}.template".format(i)), {
+            "extends": "template-{}".format(i - 1),
+            "changes": {"env": {"LEVEL_{}".format(i): str(i)}, "constraints": [["level", "LIKE", str(i)]]}})
+    instance = os.path.join(root, "app.instance")
+    write_json(instance, {"extends": "template-{}".format(depth), "changes": {"id": "/grp/instance"}})
+    return instance
+
+def make_group_instances(size):
+    """ returns size applications spread over ten groups below /grp """
+    return [make_app("/grp/group{}/app{}".format(i % 10, i)) for i in range(size)]
+
+def bench_extends_depth(size):
+    root = tempfile.mkdtemp()
+    instance = write_extends_chain(root, size)
+    # a fresh index per call so nothing is served from its cache
+    return lambda: producer.ConfigIndex(root).make_config_json(instance), lambda: shutil.rmtree(root)
+
+def bench_list_size(size):
+    root = tempfile.mkdtemp()
+    instance = write_extends_chain(root, 3, size)
+    return lambda: producer.ConfigIndex(root).make_config_json(instance), lambda: shutil.rmtree(root)
+
+def bench_hierarchy_dict(size):
+    instances = make_group_instances(size)
+    return lambda: producer.make_hierarchy_dict("/grp", instances), None
+
+def bench_format_output(size):
+    group = producer.make_hierarchy_dict("/grp", make_group_instances(size))
+    return lambda: producer.format_output(group, {"version": "1.0"}), None
+
+def bench_is_update(size):
+    app = make_app("/grp/app", size)
+    current = make_app_response(app, size)
+    return lambda: Marathon.is_update(app, current), None
+
+def bench_is_scale_only_update(size):
+    app = make_app("/grp/app", size)
+    current = make_app_response(app, size)
+    app = dict(app, instances=app["instances"] + 1)
+    return lambda: Marathon.is_scale_only_update(app, current), None
+
+BENCHMARKS = collections.OrderedDict([
+    ("make_config_json extends depth", bench_extends_depth),
+    ("make_config_json list size", bench_list_size),
+    ("make_hierarchy_dict apps", bench_hierarchy_dict),
+    ("format_output apps", bench_format_output),
+    ("is_update list size and tasks", bench_is_update),
+    ("is_scale_only_update list size and tasks", bench_is_scale_only_update),
+])
+""" Benchmark name -> function taking the size and returning (call, cleanup) """
+
+def time_call(call, repeat=REPEAT, min_time=MIN_TIME):
+    """ returns the fastest time per call of repeat runs, each calling call for at least min_time seconds """
+    best = None
+    for _ in range(repeat):
+        calls = 0
+        start = time.perf_counter()
+        while True:
+            call()
+            calls += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                break
+        per_call = elapsed / calls
+        best = per_call if best is None else min(best, per_call)
+    return best
+
+def peak_memory(call):
+    """ returns the peak number of bytes allocated by one call """
+    tracemalloc.start()
+    try:
+        call()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def calibrate(repeat=CALIBRATION_REPEAT, min_time=CALIBRATION_TIME):
+    """ time per call of a fixed workload of the same kind as the benchmarks """
+    data = {"apps": [make_app("/calibration/app{}".format(i)) for i in range(10)]}
+    return time_call(lambda: json.loads(json.dumps(copy.deepcopy(data))), repeat, min_time)
+
+def run_benchmarks(sizes=SIZES, names=None, repeat=REPEAT, min_time=MIN_TIME, stream=None):
+    """ runs the benchmarks and returns the results in the format of the baseline file """
+    calibration = calibrate(max(repeat, CALIBRATION_REPEAT), max(min_time, CALIBRATION_TIME))
+    results = collections.OrderedDict()
+    for name, benchmark in BENCHMARKS.items():
+        if names is not None and name not in names:
+            continue
+        results[name] = collections.OrderedDict()
+        for size in sizes:
+            call, cleanup = benchmark(size)
+            try:
+                wall = time_call(call, repeat, min_time)
+                peak = peak_memory(call)
+            finally:
+                if cleanup is not None:
+                    cleanup()
+            results[name][str(size)] = {"wall": wall, "relative": wall / calibration, "peak_bytes": peak}
+            if stream is not None:
+                stream.write("{:<42} {:>6} {:>12.1f} us {:>10.1f} KiB\n".format(name, size, wall * 1e6,
+                                                                              peak / 1024.0))
+    # calibrating again afterwards evens out machines that speed up or slow down while running
+    after = calibrate(max(repeat, CALIBRATION_REPEAT), max(min_time, CALIBRATION_TIME))
+    if after < calibration:
+        for sizes in results.values():
+            for result in sizes.values():
+                result["relative"] = result["wall"] / after
+        calibration = after
+    return {"calibration": calibration, "results": results}
+
+def find_regressions(baseline, current, tolerance=2.0, memory_tolerance=1.5):
+    """ returns a description of every measurement in current that is slower than tolerance times, or uses
+        more than memory_tolerance times the memory of, the same measurement in baseline
+    """
+    regressions = []
+    for name, sizes in current["results"].items():
+        for size, result in sizes.items():
+            expected = baseline["results"].get(name, {}).get(size)
+            if expected is None:
+                continue
+            if result["relative"] > expected["relative"] * tolerance:
+                regressions.append("{} at size {}: {:.1f}x slower than the baseline".format(
+                    name, size, result["relative"] / expected["relative"]))
+            if result["peak_bytes"] > expected["peak_bytes"] * memory_tolerance:
+                regressions.append("{} at size {}: {:.1f}x the peak memory of the baseline".format(
+                    name, size, result["peak_bytes"] / float(expected["peak_bytes"])))
+    return regressions
+
+def main():
+    parser = argparse.ArgumentParser(description="Scaling benchmarks of the config merge and application diff "
+                                                 "cores")
+    parser.add_argument("--sizes", default=",".join(str(size) for size in SIZES),
+                        help="comma separated input sizes. defaults to %(default)s")
+    parser.add_argument("--benchmark", action="append", choices=list(BENCHMARKS),
+                        help="benchmark to run, may be repeated. defaults to all")
+    parser.add_argument("--write-baseline", metavar="FILE", nargs="?", const=BASELINE,
+                        help="store the results as baseline in FILE. defaults to %(const)s")
+    parser.add_argument("--check", metavar="FILE", nargs="?", const=BASELINE,
+                        help="exit with status 1 if the results regress from the baseline in FILE. "
+                             "defaults to %(const)s")
+    parser.add_argument("--tolerance", type=float, default=2.0,
+                        help="factor of the baseline time considered a regression. defaults to %(default)s")
+    parser.add_argument("--memory-tolerance", type=float, default=1.5,
+                        help="factor of the baseline peak memory considered a regression. defaults to "
+                             "%(default)s")
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(",")]
+    current = run_benchmarks(sizes, args.benchmark, stream=sys.stdout)
+    if args.write_baseline is not None:
+        with open(args.write_baseline, "w") as baseline_file:
+            json.dump(current, baseline_file, indent=4)
+            baseline_file.write("\n")
+    if args.check is not None:
+        with open(args.check) as baseline_file:
+            baseline = json.load(baseline_file)
+        regressions = find_regressions(baseline, current, args.tolerance, args.memory_tolerance)
+        for regression in regressions:
+            sys.stderr.write("regression: {}\n".format(regression))
+        if regressions:
+            sys.exit(1)
+
+if __name__ == "__main__":
+    main()
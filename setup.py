@@ -17,6 +17,7 @@ setup(name='mesos-tools',
       scripts=glob.glob('src/bin/*'),
       test_suite='..tests',
       install_requires=['requests'],
+      extras_require={'watch': ['inotify_simple']},
       provides=['mesos_tools'],
       maintainer="jda",
       maintainer_email="jda@dbc.dk",
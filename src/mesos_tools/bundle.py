@@ -0,0 +1,190 @@
+#!/usr/bin/env python3
+# Copyright Dansk Bibliotekscenter a/s. Licensed under GPLv3
+# See license text at https://opensource.dbc.dk/licenses/gpl-3.0
+
+import hashlib
+import json
+import mmap
+import os
+import struct
+import tempfile
+import zlib
+
+MAGIC = b"MTBNDL01"
+HEADER = struct.Struct("<8s32sI")
+""" magic, sha256 of the source tree and number of entries """
+RECORD = struct.Struct("<QIQI")
+""" key offset, key length, data offset and data length of an entry """
+NAME_PREFIX = "name:"
+""" prefix of keys for configs looked up by name rather than app id """
+BUNDLE_MODE = 0o644
+
+class BundleException(Exception):
+    pass
+
+def tree_hash(index, template_keys=None):
+    """ sha256 over the relative paths and contents of all config files of
+        a ConfigIndex and the template keys applied when packing
+    """
+    digest = hashlib.sha256()
+    for path in sorted(index.files):
+        digest.update(os.path.relpath(path, index.root_dir).encode("utf-8"))
+        digest.update(b"\0")
+        with open(path, "rb") as config_file:
+            digest.update(hashlib.sha256(config_file.read()).digest())
+    for key, value in sorted((template_keys or {}).items()):
+        digest.update("{}={}\0".format(key, value).encode("utf-8"))
+    return digest.digest()
+
+def pack(index, path, template_keys=None):
+    """ writes every resolved config of index to a bundle at path
+
+        instances are stored under their app id and every template and
+        instance under NAME_PREFIX + config name. Configs are filled with
+        template_keys, a marathon_config_producer.TemplateKeys, once each
+        before storing. Returns the hex tree hash.
+    """
+    resolved = {}
+
+    def resolve(config_path):
+        if config_path not in resolved:
+            config = index.make_config_json(config_path)
+            if template_keys is not None:
+                config = template_keys.fill(config)
+            resolved[config_path] = config
+        return resolved[config_path]
+
+    entries = {}
+    for name, config_path in index.paths.items():
+        entries[NAME_PREFIX + name] = resolve(config_path)
+    sources = {}
+    for instance in index.instances:
+        config = resolve(instance)
+        if "id" in config:
+            if config["id"] in sources:
+                raise BundleException("app id {} is used by both {} and {}"
+                    .format(config["id"], sources[config["id"]], instance))
+            sources[config["id"]] = instance
+            entries[config["id"]] = config
+    blobs = []
+    for key in sorted(entries, key=lambda k: k.encode("utf-8")):
+        data = json.dumps(entries[key], sort_keys=True, separators=(",", ":"))
+        blobs.append((key.encode("utf-8"), zlib.compress(data.encode("utf-8"))))
+    digest = tree_hash(index, None if template_keys is None else
+        template_keys.values)
+    offset = HEADER.size + RECORD.size * len(blobs)
+    records = []
+    for key, data in blobs:
+        records.append(RECORD.pack(offset, len(key), offset + len(key),
+            len(data)))
+        offset += len(key) + len(data)
+    # write next to the target and rename so readers never see half a bundle
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".bundle")
+    try:
+        # mkstemp creates the file readable by its owner only
+        os.fchmod(fd, BUNDLE_MODE)
+        with os.fdopen(fd, "wb") as bundle_file:
+            bundle_file.write(HEADER.pack(MAGIC, digest, len(blobs)))
+            bundle_file.writelines(records)
+            for key, data in blobs:
+                bundle_file.write(key)
+                bundle_file.write(data)
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.unlink(tmp_path)
+        raise
+    return digest.hex()
+
+class Bundle(object):
+    """ Read-only, memory-mapped view of a bundle written by pack
+
+        Entries are found by binary search over the sorted index, so only
+        the pages holding the index and the requested entry are read.
+    """
+
+    def __init__(self, path, expected_hash=None):
+        self.path = path
+        try:
+            with open(path, "rb") as bundle_file:
+                self._mmap = mmap.mmap(bundle_file.fileno(), 0,
+                    access=mmap.ACCESS_READ)
+        except (OSError, ValueError) as e:
+            raise BundleException("couldn't open bundle {}: {}".format(path,
+                e))
+        if len(self._mmap) < HEADER.size:
+            self.close()
+            raise BundleException("{} is not a bundle".format(path))
+        magic, digest, self.count = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC:
+            self.close()
+            raise BundleException("{} is not a bundle".format(path))
+        self.tree_hash = digest.hex()
+        end = HEADER.size + RECORD.size * self.count
+        if self.count and len(self._mmap) >= end:
+            _, _, data_offset, data_length = self._record(self.count - 1)
+            end = data_offset + data_length
+        if end != len(self._mmap):
+            # entries are written in index order, so the last one ends the file
+            self.close()
+            raise BundleException("bundle {} is truncated or corrupt".format(
+                path))
+        if expected_hash is not None and expected_hash != self.tree_hash:
+            self.close()
+            raise BundleException("bundle {} has tree hash {}, expected {}"
+                .format(path, self.tree_hash, expected_hash))
+
+    def close(self):
+        self._mmap.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _record(self, i):
+        return RECORD.unpack_from(self._mmap, HEADER.size + RECORD.size * i)
+
+    def _key(self, i):
+        key_offset, key_length, _, _ = self._record(i)
+        return self._mmap[key_offset:key_offset + key_length]
+
+    def _data(self, i):
+        _, _, data_offset, data_length = self._record(i)
+        try:
+            return json.loads(zlib.decompress(self._mmap[data_offset:
+                data_offset + data_length]).decode("utf-8"))
+        except (zlib.error, ValueError) as e:
+            raise BundleException("corrupt entry {} in bundle {}: {}".format(
+                self._key(i).decode("utf-8", "replace"), self.path, e))
+
+    def _lower_bound(self, key):
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            if self._key(middle) < key:
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def get(self, key):
+        """ returns the config stored under key, or None """
+        key = key.encode("utf-8")
+        i = self._lower_bound(key)
+        if i < self.count and self._key(i) == key:
+            return self._data(i)
+        return None
+
+    def get_config(self, name_or_id):
+        """ looks up an app id first and a config name second """
+        config = self.get(name_or_id)
+        if config is None:
+            config = self.get(NAME_PREFIX + name_or_id)
+        return config
+
+    def app_ids(self):
+        """ returns the app ids of all instances in the bundle """
+        return [key for key in (self._key(i).decode("utf-8")
+            for i in range(self.count)) if not key.startswith(NAME_PREFIX)]
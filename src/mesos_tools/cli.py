@@ -0,0 +1,58 @@
+#!/usr/bin/env python3
+# Copyright Dansk Bibliotekscenter a/s. Licensed under GPLv3
+# See license text at https://opensource.dbc.dk/licenses/gpl-3.0
+
+import argparse
+
+from mesos_tools import daemon
+from mesos_tools import marathon_config_producer
+from mesos_tools import marathon_deployer
+from mesos_tools import profiling
+
+DEPLOYER_ACTIONS = {
+    "deploy": "marathon json file to deploy",
+    "delete": "name of the group to delete",
+    "plan": "marathon json file to show the deployment plan of",
+}
+
+def setup_args(argv=None):
+    parser = argparse.ArgumentParser(prog="mesos-tools",
+        description="Mesos application orchestration using Marathon")
+    subparsers = parser.add_subparsers(dest="command", metavar="command")
+    subparsers.required = True
+    produce_parser = subparsers.add_parser("produce",
+        help="produce marathon json from templates and instances")
+    marathon_config_producer.add_arguments(produce_parser)
+    produce_parser.set_defaults(parser=produce_parser,
+        check_args=marathon_config_producer.check_args,
+        run_command=marathon_config_producer.run_command)
+    for action, argument_help in sorted(DEPLOYER_ACTIONS.items()):
+        action_parser = subparsers.add_parser(action,
+            help="{} on marathon".format(action))
+        marathon_deployer.add_arguments(action_parser)
+        action_parser.add_argument("argument", help=argument_help)
+        action_parser.set_defaults(parser=action_parser,
+            check_args=marathon_deployer.check_args,
+            run_command=marathon_deployer.run_command)
+    daemon_parser = subparsers.add_parser("daemon",
+        help="serve deploy, delete and plan jobs over http")
+    daemon.add_arguments(daemon_parser)
+    daemon_parser.set_defaults(parser=daemon_parser,
+        check_args=daemon.check_args, run_command=daemon.run_command)
+    submit_parser = subparsers.add_parser("submit",
+        help="run a job on a daemon and follow its progress")
+    daemon.add_submit_arguments(submit_parser)
+    submit_parser.set_defaults(parser=submit_parser,
+        check_args=daemon.check_submit_args, run_command=daemon.run_submit)
+    args = parser.parse_args(argv)
+    args.check_args(args.parser, args)
+    if args.command in DEPLOYER_ACTIONS:
+        args.action = [args.command, args.argument]
+    return args
+
+def main(argv=None):
+    args = setup_args(argv)
+    profiling.run(args, args.run_command, args)
+
+if __name__ == "__main__":
+    main()
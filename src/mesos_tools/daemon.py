@@ -0,0 +1,592 @@
+#!/usr/bin/env python3
+# Copyright Dansk Bibliotekscenter a/s. Licensed under GPLv3
+# See license text at https://opensource.dbc.dk/licenses/gpl-3.0
+
+import collections
+import concurrent.futures
+import contextlib
+import http.client
+import http.server
+import ipaddress
+import itertools
+import json
+import logging
+import os
+import socket
+import socketserver
+import stat
+import sys
+import threading
+import time
+import urllib.parse
+
+from mesos_tools import marathon_deployer
+from mesos_tools import profiling
+from mesos_tools import status
+from mesos_tools.marathon_deployer import Marathon, MarathonException
+
+DEFAULT_ADDRESS = "127.0.0.1:8047"
+""" Address the daemon listens on and clients submit to by default """
+JOB_ACTIONS = ("deploy", "delete", "plan")
+FINISHED_STATES = ("succeeded", "failed")
+KEEP_JOBS = 100
+""" Number of finished jobs the daemon keeps for clients to look up """
+
+class Job(object):
+    """ A deploy, delete or plan submitted to the daemon
+
+        Log records of the job are kept as events, so clients can follow
+        them while the job runs and read them afterwards.
+    """
+
+    def __init__(self, job_id, action, argument, clusters):
+        self.id = job_id
+        self.action = action
+        self.argument = argument
+        self.clusters = clusters
+        self.state = "queued"
+        self.results = collections.OrderedDict()
+        """ cluster name -> None on success or the error that made it fail """
+        self.events = []
+        self._changed = threading.Condition()
+
+    @property
+    def finished(self):
+        return self.state in FINISHED_STATES
+
+    def add_event(self, message):
+        with self._changed:
+            self.events.append({"time": time.time(), "message": message})
+            self._changed.notify_all()
+
+    def set_state(self, state):
+        with self._changed:
+            self.state = state
+            self._changed.notify_all()
+
+    def finish(self, results):
+        with self._changed:
+            self.results = results
+            self.state = "failed" if any(error is not None
+                for error in results.values()) else "succeeded"
+            self._changed.notify_all()
+
+    def follow(self):
+        """ yields all events of the job, waiting for new ones until it has
+            finished
+        """
+        position = 0
+        while True:
+            with self._changed:
+                self._changed.wait_for(lambda: position < len(self.events)
+                    or self.finished)
+                events = self.events[position:]
+                finished = self.finished
+            position += len(events)
+            for event in events:
+                yield event
+            if finished and not events:
+                return
+
+    def as_dict(self, events=False):
+        with self._changed:
+            job = {"id": self.id, "action": self.action, "state": self.state,
+                "clusters": self.clusters, "results":
+                collections.OrderedDict((name, None if error is None
+                else str(error)) for name, error in self.results.items())}
+            if events:
+                job["events"] = list(self.events)
+        return job
+
+class JobLogHandler(logging.Handler):
+    """ Records log records as events of a job """
+
+    def __init__(self, job):
+        super().__init__(logging.INFO)
+        self.job = job
+        self.setFormatter(logging.Formatter("%(name)s - %(levelname)s - "
+            "%(message)s"))
+
+    def emit(self, record):
+        self.job.add_event(self.format(record))
+
+class AppLocks(object):
+    """ One lock per (cluster name, application id)
+
+        Locks are taken in sorted order so holders of overlapping keys
+        queue behind each other instead of deadlocking. A lock is dropped
+        once nobody holds or waits for it.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._locks = {}
+        """ key -> [lock, number of holders and waiters] """
+
+    @contextlib.contextmanager
+    def hold(self, keys):
+        with self._lock:
+            entries = []
+            for key in sorted(set(keys)):
+                entry = self._locks.setdefault(key, [threading.Lock(), 0])
+                entry[1] += 1
+                entries.append((key, entry))
+        acquired = []
+        try:
+            for _, entry in entries:
+                entry[0].acquire()
+                acquired.append(entry[0])
+            yield
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+            with self._lock:
+                for key, entry in entries:
+                    entry[1] -= 1
+                    if not entry[1]:
+                        del self._locks[key]
+
+class ClusterLocks(object):
+    """ The locks Marathon.deploy takes on one service of the daemon
+
+        The daemon's lock of the application is taken first, then the lock
+        configured with --lock, if any.
+    """
+
+    def __init__(self, app_locks, cluster, locks=None):
+        self.app_locks = app_locks
+        self.cluster = cluster
+        self.locks = locks
+
+    @contextlib.contextmanager
+    def hold(self, app_id):
+        with self.app_locks.hold([(self.cluster, app_id)]):
+            if self.locks is None:
+                yield
+            else:
+                with self.locks.hold(app_id):
+                    yield
+
+class Daemon(object):
+    """ Runs jobs against a fixed set of marathon services
+
+        Every service has one connection pool and one StatusCache of all its
+        applications and deployments, fed by marathon's event stream and
+        shared by all jobs waiting for deployments. Jobs run concurrently,
+        except that only one job at a time deploys or deletes a given
+        application of a service. The latest keep_jobs finished jobs are
+        kept.
+    """
+
+    def __init__(self, clusters, jobs=4, status_interval=2.0,
+            follow_events=True, keep_jobs=KEEP_JOBS, **marathon_args):
+        names = [cluster[0] for cluster in clusters]
+        if len(set(names)) != len(names):
+            raise MarathonException("cluster names must be unique")
+        self.marathon_args = marathon_args
+        self.follow_events = follow_events
+        self.keep_jobs = keep_jobs
+        self.logger = logging.getLogger("Marathon.daemon")
+        self.caches = collections.OrderedDict()
+        for name, baseurl, access_token in clusters:
+            marathon = Marathon(baseurl, access_token, name=name,
+                **marathon_args)
+            self.caches[name] = status.StatusCache(marathon, "/",
+                status_interval)
+        self.locks = AppLocks()
+        self._executor = concurrent.futures.ThreadPoolExecutor(
+            max_workers=jobs)
+        self._jobs = collections.OrderedDict()
+        self._job_ids = itertools.count(1)
+        self._lock = threading.Lock()
+
+    def start(self):
+        for cache in self.caches.values():
+            cache.start()
+            if self.follow_events:
+                threading.Thread(target=cache.follow_events,
+                    daemon=True).start()
+        return self
+
+    def stop(self):
+        self._executor.shutdown(wait=True)
+        for cache in self.caches.values():
+            cache.stop()
+
+    def submit(self, action, argument, clusters=None):
+        """ queues a job and returns it, running against all services
+            unless the names of some are given
+        """
+        if action not in JOB_ACTIONS:
+            raise MarathonException("unknown action: {}".format(action))
+        if action == "delete" and not isinstance(argument, str):
+            raise MarathonException("delete takes a group name")
+        if action != "delete" and (not isinstance(argument, dict) or
+                "id" not in argument):
+            raise MarathonException("{} takes marathon json with an id"
+                .format(action))
+        clusters = list(self.caches) if not clusters else clusters
+        unknown = [name for name in clusters if name not in self.caches]
+        if unknown:
+            raise MarathonException("unknown cluster(s): {}".format(
+                ", ".join(unknown)))
+        with self._lock:
+            job = Job("job-{}".format(next(self._job_ids)), action, argument,
+                clusters)
+            self._jobs[job.id] = job
+            finished = [job_id for job_id, known in self._jobs.items()
+                if known.finished]
+            for job_id in finished[:max(len(finished) - self.keep_jobs, 0)]:
+                del self._jobs[job_id]
+        self._executor.submit(self._run_job, job)
+        return job
+
+    def get_job(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def get_jobs(self):
+        with self._lock:
+            return list(self._jobs.values())
+
+    def get_status(self):
+        """ returns the rollout rows of every service's latest snapshot """
+        result = collections.OrderedDict()
+        for name, cache in self.caches.items():
+            snapshot = cache.snapshot()
+            result[name] = None if snapshot is None else {"time":
+                snapshot["time"], "apps":
+                status.RolloutTracker().rows(snapshot)}
+        return result
+
+    def _make_marathon(self, job, name):
+        cache = self.caches[name]
+        marathon = Marathon(cache.marathon.baseurl,
+            cache.marathon.cookies["access_token"], name=name,
+            session=cache.marathon.session, status_cache=cache,
+            **self.marathon_args)
+        # logged below the job's logger so its handler sees only this job
+        marathon.logger = logging.getLogger("Marathon.{}.{}".format(job.id,
+            name))
+        # each application is locked only while it is deployed
+        marathon.locks = ClusterLocks(self.locks, name, marathon.locks)
+        return marathon
+
+    def _get_group_app_ids(self, name, group_id):
+        """ returns group_id and the ids of the applications below it on
+            the service name, as far as its cache knows them
+        """
+        group_id = group_id.rstrip("/")
+        app_ids = [group_id]
+        snapshot = self.caches[name].snapshot()
+        if snapshot is not None:
+            app_ids.extend(app_id for app_id in snapshot["apps"]
+                if app_id.startswith(group_id + "/"))
+        return app_ids
+
+    def _run_on_cluster(self, job, name):
+        marathon = self._make_marathon(job, name)
+        try:
+            if job.action == "delete":
+                # a group is deleted at once, so all its applications are
+                # locked for the whole delete
+                locked = self.locks.hold([(name, app_id) for app_id in
+                    self._get_group_app_ids(name, job.argument)])
+            else:
+                locked = contextlib.ExitStack()
+            with locked:
+                marathon_deployer.run_action(marathon, job.action,
+                    job.argument)
+            return None
+        except Exception as e:
+            marathon.logger.error(e, exc_info=True)
+            return e
+
+    def _run_job(self, job):
+        logger = logging.getLogger("Marathon.{}".format(job.id))
+        handler = JobLogHandler(job)
+        logger.addHandler(handler)
+        # clients follow jobs through their info events
+        if logger.getEffectiveLevel() > logging.INFO:
+            logger.setLevel(logging.INFO)
+        try:
+            job.set_state("running")
+            with concurrent.futures.ThreadPoolExecutor(
+                    max_workers=len(job.clusters)) as executor:
+                errors = executor.map(lambda name: self._run_on_cluster(
+                    job, name), job.clusters)
+                results = collections.OrderedDict(zip(job.clusters, errors))
+            job.finish(results)
+        except Exception as e:
+            logger.error(e, exc_info=True)
+            job.finish(collections.OrderedDict((name, e)
+                for name in job.clusters))
+        finally:
+            logger.removeHandler(handler)
+            self.logger.info("%s %s", job.id, job.state)
+
+class DaemonRequestHandler(http.server.BaseHTTPRequestHandler):
+    """ The daemon's http api
+
+        POST /jobs with {"action", "argument", "clusters"} queues a job,
+        GET /jobs and /jobs/<id> describe jobs, GET /jobs/<id>/events
+        streams the events of a job as json lines until it has finished and
+        GET /status returns the rollout rows of every service.
+    """
+
+    def _send_json(self, code, data):
+        body = json.dumps(data).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _get_job(self, job_id):
+        job = self.server.daemon.get_job(job_id)
+        if job is None:
+            self._send_json(404, {"message": "no job {}".format(job_id)})
+        return job
+
+    def do_GET(self):
+        parts = [part for part in urllib.parse.urlparse(self.path)
+            .path.split("/") if part]
+        if parts == ["status"]:
+            self._send_json(200, self.server.daemon.get_status())
+        elif parts == ["jobs"]:
+            self._send_json(200, [job.as_dict() for job in
+                self.server.daemon.get_jobs()])
+        elif len(parts) == 2 and parts[0] == "jobs":
+            job = self._get_job(parts[1])
+            if job is not None:
+                self._send_json(200, job.as_dict(events=True))
+        elif len(parts) == 3 and parts[0] == "jobs" and parts[2] == "events":
+            job = self._get_job(parts[1])
+            if job is not None:
+                self._stream_events(job)
+        else:
+            self._send_json(404, {"message": "not found"})
+
+    def _stream_events(self, job):
+        # without a content length the end of the stream is the end of the
+        # connection
+        self.send_response(200)
+        self.send_header("Content-Type", "application/x-ndjson")
+        self.end_headers()
+        for event in job.follow():
+            self.wfile.write("{}\n".format(json.dumps(event)).encode("utf-8"))
+            self.wfile.flush()
+        self.wfile.write("{}\n".format(json.dumps(job.as_dict()))
+            .encode("utf-8"))
+
+    def do_POST(self):
+        if [part for part in self.path.split("/") if part] != ["jobs"]:
+            self._send_json(404, {"message": "not found"})
+            return
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+            request = json.loads(self.rfile.read(length).decode("utf-8"))
+            job = self.server.daemon.submit(request.get("action"),
+                request.get("argument"), request.get("clusters"))
+        except (ValueError, AttributeError, MarathonException) as e:
+            self._send_json(400, {"message": str(e)})
+            return
+        self._send_json(202, job.as_dict())
+
+    def address_string(self):
+        # unix socket clients have no address
+        return str(self.client_address[0]) if self.client_address else "local"
+
+    def log_message(self, format, *args):
+        self.server.daemon.logger.debug("%s - %s", self.address_string(),
+            format % args)
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+class ThreadingUnixHTTPServer(socketserver.ThreadingMixIn,
+        socketserver.UnixStreamServer):
+    daemon_threads = True
+
+class UnixHTTPConnection(http.client.HTTPConnection):
+    """ HTTPConnection to a unix socket """
+
+    def __init__(self, path, timeout=None):
+        super().__init__("localhost", timeout=timeout)
+        self.path = path
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+
+def is_unix_socket(address):
+    """ addresses are host:port or the path of a unix socket """
+    return "/" in address
+
+def parse_address(address):
+    host, _, port = address.rpartition(":")
+    try:
+        return host or "127.0.0.1", int(port)
+    except ValueError:
+        raise MarathonException("invalid address {}, expected host:port or "
+            "the path of a unix socket".format(address))
+
+def is_loopback(host):
+    """ whether every address host resolves to is a loopback address """
+    try:
+        return all(ipaddress.ip_address(info[4][0]).is_loopback
+            for info in socket.getaddrinfo(host, None))
+    except (socket.gaierror, ValueError):
+        return False
+
+def remove_stale_socket(path):
+    """ removes the unix socket at path left by a daemon that is gone,
+        refusing to remove anything else
+    """
+    try:
+        mode = os.lstat(path).st_mode
+    except FileNotFoundError:
+        return
+    if not stat.S_ISSOCK(mode):
+        raise MarathonException("{} exists and is not a socket".format(path))
+    probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        probe.connect(path)
+    except OSError:
+        os.unlink(path)
+    else:
+        raise MarathonException("a daemon is already listening on {}".format(
+            path))
+    finally:
+        probe.close()
+
+def make_server(daemon, address=DEFAULT_ADDRESS):
+    """ returns a server for daemon on a unix socket or a loopback address
+
+        the api has no authentication and jobs run with the daemon's access
+        tokens, so only local users may reach it
+    """
+    if is_unix_socket(address):
+        remove_stale_socket(address)
+        server = ThreadingUnixHTTPServer(address, DaemonRequestHandler)
+    else:
+        host, port = parse_address(address)
+        if not is_loopback(host):
+            raise MarathonException("the daemon has no authentication and "
+                "only listens on loopback addresses or unix sockets, not {}"
+                .format(address))
+        server = ThreadingHTTPServer((host, port), DaemonRequestHandler)
+    server.daemon = daemon
+    return server
+
+def connect(address=DEFAULT_ADDRESS, timeout=None):
+    if is_unix_socket(address):
+        return UnixHTTPConnection(address, timeout)
+    return http.client.HTTPConnection(*parse_address(address),
+        timeout=timeout)
+
+def submit(address, action, argument, clusters=None, stream=None):
+    """ submits a job to the daemon at address, writes its events to stream
+        as they happen and returns the finished job
+    """
+    connection = connect(address)
+    try:
+        connection.request("POST", "/jobs", json.dumps({"action": action,
+            "argument": argument, "clusters": clusters}),
+            {"Content-Type": "application/json"})
+        response = connection.getresponse()
+        job = json.loads(response.read().decode("utf-8"))
+        if response.status != 202:
+            raise MarathonException("{} error while submitting {} - {}"
+                .format(response.status, action, job.get("message")))
+    finally:
+        connection.close()
+    connection = connect(address)
+    try:
+        connection.request("GET", "/jobs/{}/events".format(job["id"]))
+        response = connection.getresponse()
+        for line in response:
+            event = json.loads(line.decode("utf-8"))
+            if "message" not in event:
+                return event
+            if stream is not None:
+                stream.write("{}\n".format(event["message"]))
+                stream.flush()
+    finally:
+        connection.close()
+    raise MarathonException("connection to daemon lost while following {}"
+        .format(job["id"]))
+
+def add_arguments(parser):
+    marathon_deployer.add_cluster_arguments(parser)
+    marathon_deployer.add_marathon_arguments(parser)
+    parser.add_argument("--address", default=DEFAULT_ADDRESS, help="host:port "
+        "of a loopback address or path of a unix socket to listen on. "
+        "defaults to %(default)s")
+    parser.add_argument("--jobs", type=int, default=4, help="maximum number "
+        "of jobs running at once. defaults to %(default)s")
+    parser.add_argument("--keep-jobs", type=int, default=KEEP_JOBS,
+        help="number of finished jobs kept for clients to look up. defaults "
+        "to %(default)s")
+    parser.add_argument("--status-interval", type=float, default=2.0,
+        help="seconds between polls of applications and deployments, which "
+        "marathon's event stream triggers sooner. defaults to %(default)s")
+    parser.add_argument("--no-events", action="store_true", help="only poll, "
+        "without following marathon's event stream")
+    profiling.add_arguments(parser)
+
+def check_args(parser, args):
+    marathon_deployer.check_marathon_args(parser, args)
+
+def run_command(args):
+    logger = marathon_deployer.create_logger()
+    try:
+        clusters = marathon_deployer.get_clusters(args.baseurl,
+            args.access_token, args.clusters_file)
+        daemon = Daemon(clusters, args.jobs, args.status_interval,
+            not args.no_events, args.keep_jobs,
+            **marathon_deployer.get_marathon_args(args))
+        server = make_server(daemon, args.address)
+    except Exception as e:
+        logger.error(e, exc_info=True)
+        sys.exit(1)
+    daemon.start()
+    logger.info("listening on %s", args.address)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        daemon.stop()
+
+def add_submit_arguments(parser):
+    parser.add_argument("--address", default=DEFAULT_ADDRESS, help="host:port "
+        "or path of the unix socket of the daemon. defaults to %(default)s")
+    parser.add_argument("--cluster", action="append", help="name of a "
+        "marathon service of the daemon to run against, may be repeated. "
+        "defaults to all")
+    parser.add_argument("job_action", metavar="deploy|delete|plan",
+        choices=JOB_ACTIONS, help="what the daemon should do")
+    parser.add_argument("argument", help="marathon json file to deploy or "
+        "plan, or name of the group to delete")
+    profiling.add_arguments(parser)
+
+def check_submit_args(parser, args):
+    pass
+
+def run_submit(args):
+    logger = marathon_deployer.create_logger()
+    try:
+        argument = args.argument
+        if args.job_action != "delete":
+            argument = marathon_deployer.load_applications(argument)
+        job = submit(args.address, args.job_action, argument, args.cluster,
+            sys.stderr)
+    except Exception as e:
+        logger.error(e, exc_info=True)
+        sys.exit(1)
+    for name, error in job["results"].items():
+        logger.info("%s: %s", name, "ok" if error is None else
+            "failed - {}".format(error))
+    sys.exit(os.EX_OK if job["state"] == "succeeded" else 1)
@@ -0,0 +1,21 @@
+#!/usr/bin/env python3
+# Copyright Dansk Bibliotekscenter a/s. Licensed under GPLv3
+# See license text at https://opensource.dbc.dk/licenses/gpl-3.0
+
+import importlib
+
+class LazyModule(object):
+    """ Stand-in for a module that is imported on first attribute access
+
+        Keeps heavy dependencies like requests out of code paths that never
+        use them, such as --help and argument errors.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+
+    def __getattr__(self, attribute):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+        return getattr(self._module, attribute)
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+# Copyright Dansk Bibliotekscenter a/s. Licensed under GPLv3
+# See license text at https://opensource.dbc.dk/licenses/gpl-3.0
+
+import contextlib
+import errno
+import fcntl
+import os
+import socket
+import threading
+import time
+import urllib.parse
+import uuid
+
+LOCK_KINDS = ("none", "marathon", "file")
+LOCK_GROUP = "/mesos-tools-locks"
+""" Group below which MarathonLocks creates one lease application per locked application """
+OWNER_LABEL = "mesos-tools.lease-owner"
+EXPIRES_LABEL = "mesos-tools.lease-expires"
+LEASE_TTL = 300
+""" Seconds a lease stays valid without being renewed, after which a lease
+    left by a crashed deployer may be taken over """
+RETRY_INTERVAL = 1.0
+""" Seconds between attempts to take a lock held by someone else """
+SETTLE_TIME = 2.0
+""" Seconds a deployer taking over an expired lease waits before checking
+    that it got it """
+
+class LockException(Exception):
+    pass
+
+def get_owner():
+    """ describes the current thread for the owner of a lease """
+    return "{}:{}:{}".format(socket.gethostname(), os.getpid(),
+        threading.get_ident())
+
+def _wait_or_fail(app_id, deadline, holder):
+    if deadline is not None and time.time() > deadline:
+        raise LockException("timed out waiting for the lock of {} held by {}"
+            .format(app_id, holder))
+    time.sleep(RETRY_INTERVAL)
+
+class FileLocks(object):
+    """ Per-application locks as flock()ed files in a directory, for
+        deployers sharing a host
+    """
+
+    def __init__(self, directory, timeout=None):
+        self.directory = directory
+        self.timeout = timeout
+        os.makedirs(directory, exist_ok=True)
+
+    def get_path(self, app_id):
+        return os.path.join(self.directory, "{}.lock".format(
+            urllib.parse.quote(app_id, safe="")))
+
+    @contextlib.contextmanager
+    def hold(self, app_id):
+        deadline = None if self.timeout is None else \
+            time.time() + self.timeout
+        # the file is never removed, that would let two holders lock
+        # different files of the same name
+        with open(self.get_path(app_id), "a+") as lock_file:
+            while True:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                    break
+                except OSError as e:
+                    if e.errno not in (errno.EAGAIN, errno.EACCES):
+                        raise
+                    lock_file.seek(0)
+                    _wait_or_fail(app_id, deadline, lock_file.read().strip()
+                        or "another process")
+            try:
+                lock_file.truncate(0)
+                lock_file.write(get_owner())
+                lock_file.flush()
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+class MarathonLocks(object):
+    """ Per-application leases stored in marathon itself, for deployers on
+        different hosts
+
+        A lease is an application without instances below LOCK_GROUP,
+        labelled with its owner and expiry. Creating an application that
+        already exists fails, so only one deployer gets the lease. The
+        holder renews the expiry every ttl / 3 seconds and only the owner
+        releases a lease. Marathon can't delete conditionally, so a
+        deployer taking over an expired lease waits SETTLE_TIME before
+        checking that it owns the new lease, by which time deployers racing
+        for it have all seen the last one created.
+    """
+
+    def __init__(self, marathon, timeout=None, ttl=LEASE_TTL):
+        self.marathon = marathon
+        self.timeout = timeout
+        self.ttl = ttl
+
+    def get_lease_id(self, app_id):
+        return LOCK_GROUP + "/" + app_id.strip("/")
+
+    def _get_labels(self, lease_id):
+        """ returns the labels of a lease, or None if there is none """
+        current = self.marathon._get_application(lease_id)
+        return None if current is None else current["app"].get("labels", {})
+
+    def _make_labels(self, owner):
+        return {OWNER_LABEL: owner,
+            EXPIRES_LABEL: str(int(time.time() + self.ttl))}
+
+    def _create_lease(self, lease_id, owner):
+        """ returns whether the lease was created """
+        return self.marathon._post_lease({"id": lease_id,
+            "cmd": "sleep infinity", "instances": 0, "cpus": 0.01, "mem": 16,
+            "labels": self._make_labels(owner)})
+
+    def _acquire(self, app_id, lease_id, owner):
+        deadline = None if self.timeout is None else \
+            time.time() + self.timeout
+        waiting = False
+        while True:
+            if self._create_lease(lease_id, owner):
+                return
+            labels = self._get_labels(lease_id)
+            if labels is None:
+                # released in between
+                continue
+            holder = labels.get(OWNER_LABEL)
+            expires = labels.get(EXPIRES_LABEL)
+            if expires is not None and float(expires) < time.time():
+                if self._take_over(app_id, lease_id, owner, holder):
+                    return
+                continue
+            if not waiting:
+                self.marathon.logger.info("waiting for the lease of %s held "
+                    "by %s", app_id, holder)
+                waiting = True
+            _wait_or_fail(app_id, deadline, holder)
+
+    def _take_over(self, app_id, lease_id, owner, expired_owner):
+        """ replaces the expired lease of expired_owner by one of owner,
+            returning whether owner holds the lease afterwards
+        """
+        # another deployer may have taken it over since it was read
+        labels = self._get_labels(lease_id)
+        if labels is None or labels.get(OWNER_LABEL) != expired_owner:
+            return False
+        self.marathon.logger.warning("taking over expired lease of %s held by "
+            "%s", app_id, expired_owner)
+        try:
+            self.marathon._delete_application(lease_id)
+        except Exception as e:
+            self.marathon.logger.info("couldn't delete the expired lease of "
+                "%s: %s", app_id, e)
+            return False
+        if not self._create_lease(lease_id, owner):
+            return False
+        time.sleep(SETTLE_TIME)
+        labels = self._get_labels(lease_id)
+        return labels is not None and labels.get(OWNER_LABEL) == owner
+
+    def _renew(self, app_id, lease_id, owner, stopped):
+        while not stopped.wait(self.ttl / 3.0):
+            try:
+                labels = self._get_labels(lease_id)
+                if labels is None or labels.get(OWNER_LABEL) != owner:
+                    self.marathon.logger.error("lost the lease of %s to %s",
+                        app_id, None if labels is None else
+                        labels.get(OWNER_LABEL))
+                    return
+                # a lease has no instances, so changing it starts no tasks
+                self.marathon._put_application_fields(lease_id,
+                    {"labels": self._make_labels(owner)}, force=True)
+            except Exception as e:
+                self.marathon.logger.warning("couldn't renew the lease of "
+                    "%s: %s", app_id, e)
+
+    def _release(self, app_id, lease_id, owner):
+        try:
+            labels = self._get_labels(lease_id)
+            if labels is not None and labels.get(OWNER_LABEL) == owner:
+                self.marathon._delete_application(lease_id)
+            elif labels is not None:
+                self.marathon.logger.warning("not releasing the lease of %s, "
+                    "it is held by %s", app_id, labels.get(OWNER_LABEL))
+        except Exception as e:
+            # it expires on its own
+            self.marathon.logger.warning("couldn't release the lease of "
+                "%s: %s", app_id, e)
+
+    @contextlib.contextmanager
+    def hold(self, app_id):
+        lease_id = self.get_lease_id(app_id)
+        owner = "{}:{}".format(get_owner(), uuid.uuid4().hex[:8])
+        self._acquire(app_id, lease_id, owner)
+        stopped = threading.Event()
+        renewer = threading.Thread(target=self._renew, args=(app_id, lease_id,
+            owner, stopped), daemon=True)
+        renewer.start()
+        try:
+            yield
+        finally:
+            stopped.set()
+            renewer.join()
+            self._release(app_id, lease_id, owner)
+
+def make_locks(kind, marathon, directory=None, timeout=None):
+    """ returns the locks of the given kind for marathon, or None """
+    if kind not in LOCK_KINDS:
+        raise LockException("unknown kind of lock: {}".format(kind))
+    if kind == "file":
+        if directory is None:
+            raise LockException("file locks need a directory")
+        return FileLocks(directory, timeout)
+    if kind == "marathon":
+        return MarathonLocks(marathon, timeout)
+    return None
@@ -3,12 +3,21 @@
 # See license text at https://opensource.dbc.dk/licenses/gpl-3.0
 
 import argparse
+import collections
 import configparser
 import copy
+import fnmatch
 import json
 import os
 import re
 import sys
+import time
+
+from mesos_tools import bundle
+from mesos_tools import profiling
+from mesos_tools import validation
+
+CONFIG_EXTENSIONS = (".template", ".instance")
 
 class ConfigException(Exception):
     pass
@@ -28,11 +37,18 @@ class StoreTemplateKeyValuePairsAction(argparse.Action):
 
 def setup_args():
     parser = argparse.ArgumentParser()
+    add_arguments(parser)
+    args = parser.parse_args()
+    check_args(parser, args)
+    return args
+
+def add_arguments(parser):
+    """ adds the producer options, shared with the mesos-tools command """
     parser.add_argument("--root", help="root of config directory",
         default=os.getcwd())
-    parser.add_argument("input", help="corresponding to the value for "
-        "--mode, input should either be an application json file or a "
-        "group name")
+    parser.add_argument("input", nargs="?", help="corresponding to the "
+        "value for --mode, input should either be an application json file "
+        "or a group name. not used with --affected-by")
     parser.add_argument("-o", "--output",
         help="file to write resulting config json to, defaults to standard out",
         default="-")
@@ -47,40 +63,75 @@ def setup_args():
     parser.add_argument("--template-keys-file", help="read template keys "
         "from file in key=value format. template keys specified on the "
         "command line takes precedence over those specified in a file")
+    parser.add_argument("--template-keys-report", metavar="FILE",
+        help="write the template keys each application uses, the ones it "
+            "references but aren't given and the ones no application uses "
+            "as json to FILE, - for standard error")
     parser.add_argument("--flatten_hierarchy", action="store_true",
         help="flatten the hierarchy when producing a group json file. "
             "/parent/child/grandchild becomes parent-child-grandchild")
-    args = parser.parse_args()
-    return args
+    parser.add_argument("--select", action="append", metavar="SELECTOR",
+        help="only produce the instances of a group that are below a "
+            "directory relative to --root, have an app id matching a glob "
+            "like '/prod/search/*' or an app id starting with a given "
+            "prefix. may be given several times. other instances are not "
+            "resolved")
+    parser.add_argument("--watch", action="store_true",
+        help="keep running and rewrite the output whenever a template or "
+            "instance under --root changes")
+    parser.add_argument("--watch-interval", type=float, default=0.5,
+        help="seconds between scans of --root when watching without "
+            "inotify_simple installed. defaults to 0.5")
+    parser.add_argument("--affected-by", nargs="+", metavar="FILE",
+        help="print the ids of the applications whose extends chain "
+            "includes any of the given template or instance files, one per "
+            "line. files can be given by path or config name")
+    parser.add_argument("--pack", metavar="BUNDLE", help="resolve every "
+        "template and instance under --root and write them to BUNDLE, a "
+        "single indexed file that --bundle reads without walking --root. "
+        "template keys given are applied before packing")
+    parser.add_argument("--bundle", help="read configs from a bundle written "
+        "by --pack instead of --root, with its template keys already "
+        "applied. in single mode input is an app id or config name")
+    parser.add_argument("--bundle-hash", metavar="HASH", help="fail unless "
+        "the bundle was packed with this tree hash, as printed by --pack")
+    parser.add_argument("--validate", action="store_true",
+        help="check the produced applications for unknown keys, wrong "
+            "types, bad ports, missing instances and dependencies outside "
+            "the group, and fail with all errors found")
+    profiling.add_arguments(parser)
 
-def get_config_file(root_dir, config_name, exts=[".template", ".instance"]):
-    for root, _, files in os.walk(root_dir):
-        for f_path in files:
-            for ext in exts:
-                if f_path == config_name + ext:
-                    return os.path.join(root, f_path)
-    return None
+def check_args(parser, args):
+    if args.input is None and args.affected_by is None and args.pack is None:
+        parser.error("the following arguments are required: input")
+    if args.bundle is not None and (args.watch or args.affected_by or
+            args.pack):
+        parser.error("--bundle can't be combined with --watch, "
+            "--affected-by or --pack")
+    if args.bundle is not None and (args.template_keys is not None or
+            args.template_keys_file is not None or
+            args.template_keys_report is not None):
+        parser.error("--bundle can't be combined with --template-keys, "
+            "--template-keys-file or --template-keys-report, template keys "
+            "are applied by --pack")
+
+def get_config_file(root_dir, config_name):
+    return ConfigIndex(root_dir).get_config_file(config_name)
 
 def get_extending_config_data(root_dir, instance_json_data):
     if "extends" not in instance_json_data:
         return None
-    extending_path = get_config_file(root_dir, instance_json_data["extends"])
+    index = ConfigIndex(root_dir)
+    extending_path = index.get_config_file(instance_json_data["extends"])
     if extending_path is None:
         raise ConfigException("couldn't find template {} in root {}".format(
             instance_json_data["extends"], root_dir))
-    with open(extending_path) as f:
-        return json.load(f)
+    return index.load(extending_path)
 
 def iterate_extend_hierarchy(root_dir, config_path):
-    with open(config_path) as f:
-        json_data = json.load(f)
-        extending_data = get_extending_config_data(root_dir, json_data)
-        config_stack = []
-        config_stack.append(json_data)
-        while(extending_data is not None):
-            config_stack.append(extending_data)
-            extending_data = get_extending_config_data(root_dir, extending_data)
-        return config_stack
+    index = ConfigIndex(root_dir)
+    return [index.load(path) for path in index.get_extend_hierarchy(
+        config_path)]
 
 def merge_lists(src, dest):
     if not (isinstance(src, list) and isinstance(dest, list)):
@@ -138,11 +189,284 @@ def merge_config_stack(config_stack):
             dest = merge(data, dest)
     return dest
 
+TEMPLATE_KEY_PATTERN = re.compile(r"\$\{([^}]*)\}")
+""" matches ${key} with the key as its group """
+
 def fill_template(template, **kwargs):
-    for key, value in kwargs.items():
-        # replace ${key} -> value
-        template = re.sub("\${{{}}}".format(key), value, template)
-    return template
+    # replace ${key} -> value in one pass, leaving unknown keys as they are
+    return TEMPLATE_KEY_PATTERN.sub(lambda match: kwargs.get(match.group(1),
+        match.group(0)), template)
+
+class TemplateKeys(object):
+    """ Template keys applied to one application at a time
+
+        Only the keys an application references are looked up, and every
+        string is filled once however many applications share it through a
+        template. Keys referenced and missing are recorded per application.
+    """
+
+    def __init__(self, template_keys=None):
+        self.values = dict(template_keys or {})
+        self._filled = {}
+        """ string -> (filled string, keys referenced by it) """
+        self.referenced = collections.OrderedDict()
+        """ app id -> keys referenced by the application """
+
+    def fill_text(self, text):
+        """ returns text filled and the keys it references """
+        if "${" not in text:
+            return text, ()
+        if text not in self._filled:
+            keys = TEMPLATE_KEY_PATTERN.findall(text)
+            self._filled[text] = (fill_template(text, **self.values),
+                frozenset(keys))
+        return self._filled[text]
+
+    def _fill(self, value, keys):
+        if isinstance(value, str):
+            filled, referenced = self.fill_text(value)
+            keys.update(referenced)
+            return filled
+        if isinstance(value, dict):
+            return {self._fill(key, keys): self._fill(item, keys)
+                for key, item in value.items()}
+        if isinstance(value, list):
+            return [self._fill(item, keys) for item in value]
+        return value
+
+    def fill(self, config):
+        """ returns a filled copy of a config and records its keys """
+        keys = set()
+        filled = self._fill(config, keys)
+        if isinstance(filled, dict):
+            app_id = filled.get("id", "<no id>")
+            self.referenced.setdefault(app_id, set()).update(keys)
+        return filled
+
+    def get_report(self):
+        """ returns the keys used and missing per application and the keys
+            no application used
+        """
+        used = set()
+        apps = collections.OrderedDict()
+        for app_id, keys in self.referenced.items():
+            used.update(keys)
+            apps[app_id] = {"used": sorted(k for k in keys if k in self.values),
+                "missing": sorted(k for k in keys if k not in self.values)}
+        return {"apps": apps, "unused": sorted(set(self.values) - used)}
+
+class ConfigIndex(object):
+    """ In-memory index of a config root
+
+        The root is walked once to map config names to paths, and parsed
+        and merged configs are cached per file so instances sharing a
+        template only resolve that template once.
+    """
+
+    def __init__(self, root_dir):
+        self.root_dir = os.path.abspath(root_dir)
+        self.rescan()
+
+    def rescan(self):
+        self.paths = {}
+        """ config name -> path of the first file with that name in walk order """
+        self.files = set()
+        self.instances = []
+        with profiling.timings.stage("walk"):
+            for root, _, files in os.walk(self.root_dir):
+                profiling.timings.count("files walked", len(files))
+                for f_path in files:
+                    name, ext = os.path.splitext(f_path)
+                    if ext not in CONFIG_EXTENSIONS:
+                        continue
+                    path = os.path.join(root, f_path)
+                    self.paths.setdefault(name, path)
+                    self.files.add(path)
+                    if ext == ".instance":
+                        self.instances.append(path)
+        self._data = {}
+        self._parents = {}
+        self._merged = {}
+
+    def get_config_file(self, config_name):
+        return self.paths.get(config_name)
+
+    def load(self, path):
+        # all caches are keyed by absolute path so any spelling of a path
+        # given on the command line matches the paths found by the walk
+        path = os.path.abspath(path)
+        if path not in self._data:
+            profiling.timings.count("files parsed")
+            try:
+                with open(path) as f, profiling.timings.stage("json decode"):
+                    self._data[path] = json.load(f)
+            except json.decoder.JSONDecodeError as e:
+                raise ConfigException("error decoding json file {}: {}"
+                    .format(path, e))
+        return self._data[path]
+
+    def get_parent(self, path):
+        path = os.path.abspath(path)
+        if path not in self._parents:
+            data = self.load(path)
+            parent = None
+            if "extends" in data:
+                parent = self.get_config_file(data["extends"])
+                if parent is None:
+                    raise ConfigException("couldn't find template {} in root "
+                        "{}".format(data["extends"], self.root_dir))
+            self._parents[path] = parent
+        return self._parents[path]
+
+    def get_extend_hierarchy(self, path):
+        """ returns the paths of the extends chain, starting with path """
+        path = os.path.abspath(path)
+        chain = [path]
+        parent = self.get_parent(path)
+        while parent is not None:
+            if parent in chain:
+                raise ConfigException("circular extends: {}".format(
+                    " -> ".join(chain + [parent])))
+            chain.append(parent)
+            parent = self.get_parent(parent)
+        return chain
+
+    def _get_merged(self, path):
+        path = os.path.abspath(path)
+        if path not in self._merged:
+            dest = {}
+            for config_path in self.get_extend_hierarchy(path)[::-1]:
+                if config_path in self._merged:
+                    dest = self._merged[config_path]
+                    continue
+                data = self.load(config_path)
+                with profiling.timings.stage("merge"):
+                    dest = merge(data["changes"] if "changes" in data
+                        else data, dest)
+                self._merged[config_path] = dest
+        return self._merged[path]
+
+    def make_config_json(self, path):
+        return copy.deepcopy(self._get_merged(path))
+
+    def get_instance_id(self, path):
+        """ returns the app id of an instance, reading only the instance file
+            when it sets the id itself
+        """
+        data = self.load(path)
+        own = data["changes"] if "changes" in data else data
+        if isinstance(own, dict) and "id" in own:
+            return own["id"]
+        return self._get_merged(path).get("id")
+
+    def select_instances(self, selectors, template_keys=None):
+        """ returns the instances matching any of selectors, see Selector
+
+            directory selectors are decided from the path alone, so only
+            instances outside the selected directories are parsed, and only
+            their own file. app ids are matched after filling template_keys
+        """
+        selectors = [s if isinstance(s, Selector) else
+            Selector(s, self.root_dir) for s in selectors]
+        selected = []
+        for path in self.instances:
+            for selector in selectors:
+                if selector.matches(self, path, template_keys):
+                    selected.append(path)
+                    break
+        return selected
+
+    def get_reverse_index(self):
+        """ maps each config path to the instances whose extends chain
+            includes it
+        """
+        reverse_index = {}
+        for instance in self.instances:
+            for path in self.get_extend_hierarchy(instance):
+                reverse_index.setdefault(path, []).append(instance)
+        return reverse_index
+
+    def get_affected_instances(self, paths):
+        """ returns the instances whose extends chain includes any of paths """
+        reverse_index = self.get_reverse_index()
+        affected = set()
+        for path in paths:
+            affected.update(reverse_index.get(os.path.abspath(path), []))
+        return [i for i in self.instances if i in affected]
+
+    def invalidate(self, changed_paths):
+        """ drops cached data for changed_paths
+
+            Returns the instances whose extends chain includes a changed
+            file. Added, removed or unknown paths cause a full rescan and
+            all instances are returned. Files outside the root that have
+            been loaded, like an input file given by path, are known too.
+        """
+        changed_paths = {os.path.abspath(path) for path in changed_paths}
+        for path in changed_paths:
+            if path in self._data and path not in self.files:
+                continue
+            is_config = os.path.splitext(path)[1] in CONFIG_EXTENSIONS
+            if not is_config or (path in self.files) != os.path.isfile(path):
+                self.rescan()
+                return list(self.instances)
+        children = {}
+        for child, parent in self._parents.items():
+            children.setdefault(parent, []).append(child)
+        affected = set()
+        stack = list(changed_paths)
+        while stack:
+            path = stack.pop()
+            if path in affected:
+                continue
+            affected.add(path)
+            stack.extend(children.get(path, []))
+        for path in affected:
+            self._merged.pop(path, None)
+        for path in changed_paths:
+            self._data.pop(path, None)
+            self._parents.pop(path, None)
+        return [i for i in self.instances if i in affected]
+
+class Selector(object):
+    """ Selects instances by directory, app id prefix or app id glob
+
+        a value naming an existing directory below root_dir, relative to it,
+        selects the instances below it, a value containing *, ? or [ is
+        matched against app ids as a glob and anything else selects an app
+        id and the ids below it
+    """
+
+    def __init__(self, value, root_dir=None):
+        self.value = value
+        self.directory = None
+        if root_dir is not None:
+            root_dir = os.path.join(os.path.abspath(root_dir), "")
+            directory = os.path.join(os.path.abspath(os.path.join(root_dir,
+                value)), "")
+            if directory.startswith(root_dir) and os.path.isdir(directory):
+                self.directory = directory
+        self.is_glob = self.directory is None and any(c in value
+            for c in "*?[")
+
+    def __str__(self):
+        return self.value
+
+    def matches(self, index, path, template_keys=None):
+        if self.directory is not None:
+            return path.startswith(self.directory)
+        app_id = index.get_instance_id(path)
+        if app_id is not None and template_keys is not None:
+            app_id = template_keys.fill_text(app_id)[0]
+        return self.matches_id(app_id)
+
+    def matches_id(self, app_id):
+        if app_id is None or self.directory is not None:
+            return False
+        if self.is_glob:
+            return fnmatch.fnmatchcase(app_id, self.value)
+        prefix = self.value.rstrip("/")
+        return app_id == prefix or app_id.startswith(prefix + "/")
 
 def make_config_json(root, config_file_path):
     try:
@@ -154,14 +478,25 @@ def make_config_json(root, config_file_path):
             config_file_path, e))
 
 def collect_instance_files(group_name, root_dir, template_keys=None,
-        flat_hierarchy_compatibility=False):
-    instances = []
-    for root, _, files in os.walk(root_dir):
-        for f_path in files:
-            if f_path[-9:] == ".instance":
-                instance = make_config_json(root_dir, os.path.join(root,
-                    f_path))
-                instances.append(instance)
+        flat_hierarchy_compatibility=False, index=None, selectors=None):
+    if index is None:
+        index = ConfigIndex(root_dir)
+    if template_keys is not None and not isinstance(template_keys,
+            TemplateKeys):
+        template_keys = TemplateKeys(template_keys)
+    if template_keys is not None:
+        group_name = template_keys.fill_text(group_name)[0]
+    paths = index.instances
+    if selectors:
+        paths = index.select_instances(selectors, template_keys)
+        if not paths:
+            raise ConfigException("no instances under {} match {}".format(
+                index.root_dir, ", ".join(str(s) for s in selectors)))
+    instances = [index.make_config_json(path) for path in paths]
+    if template_keys is not None:
+        with profiling.timings.stage("fill template"):
+            instances = [template_keys.fill(instance) for instance in
+                instances]
     return make_hierarchy_dict(group_name, instances,
         flat_hierarchy_compatibility)
 
@@ -213,10 +548,12 @@ def replace_path_slashes(app_id):
     return app_id.replace("/", "-").lstrip("-")
 
 def format_output(config_json, template_keys=None):
-    json_output = "{}\n".format(json.dumps(config_json, sort_keys=True,
-        indent=4))
+    with profiling.timings.stage("format output"):
+        json_output = "{}\n".format(json.dumps(config_json, sort_keys=True,
+            indent=4))
     if template_keys is not None:
-        json_output = fill_template(json_output, **template_keys)
+        with profiling.timings.stage("fill template"):
+            json_output = fill_template(json_output, **template_keys)
     return json_output
 
 def read_template_keys_file(path):
@@ -240,37 +577,254 @@ def merge_template_keys(file_path, template_keys_from_args):
             template_keys[key] = template_keys_from_file[key]
     return template_keys
 
+def watch_config_root(root_dir, interval=0.5, extra_files=()):
+    """ yields sets of absolute paths changed below root_dir or in
+        extra_files, which may lie outside root_dir
+
+        uses inotify when inotify_simple is installed and falls back to
+        polling modification times every interval seconds
+    """
+    root_dir = os.path.abspath(root_dir)
+    extra_files = {os.path.abspath(path) for path in extra_files}
+    try:
+        import inotify_simple
+    except ImportError:
+        return _poll_changes(root_dir, interval, extra_files)
+    return _inotify_changes(inotify_simple, root_dir, extra_files)
+
+def _snapshot_config_root(root_dir, extra_files=()):
+    paths = set(extra_files)
+    for root, _, files in os.walk(root_dir):
+        for f_path in files:
+            if os.path.splitext(f_path)[1] in CONFIG_EXTENSIONS:
+                paths.add(os.path.join(root, f_path))
+    mtimes = {}
+    for path in paths:
+        try:
+            mtimes[path] = os.stat(path).st_mtime_ns
+        except OSError:
+            # removed between walk and stat
+            pass
+    return mtimes
+
+def _poll_changes(root_dir, interval, extra_files=()):
+    # the baseline is taken before returning the generator so changes made
+    # right after this call are not missed
+    return _poll_snapshots(root_dir, interval, extra_files,
+        _snapshot_config_root(root_dir, extra_files))
+
+def _poll_snapshots(root_dir, interval, extra_files, previous):
+    while True:
+        profiling.sleep(interval)
+        current = _snapshot_config_root(root_dir, extra_files)
+        changed = {path for path in set(previous) | set(current)
+            if previous.get(path) != current.get(path)}
+        previous = current
+        if changed:
+            yield changed
+
+def _inotify_changes(inotify_simple, root_dir, extra_files=()):
+    inotify = inotify_simple.INotify()
+    flags = inotify_simple.flags
+    mask = flags.CLOSE_WRITE | flags.CREATE | flags.DELETE | \
+        flags.MOVED_FROM | flags.MOVED_TO
+    watches = {}
+
+    def add_watches(directory):
+        for root, _, _ in os.walk(directory):
+            watches[inotify.add_watch(root, mask)] = root
+
+    add_watches(root_dir)
+    for directory in {os.path.dirname(path) for path in extra_files}:
+        if directory not in watches.values():
+            watches[inotify.add_watch(directory, mask)] = directory
+    while True:
+        changed = set()
+        # read_delay collects the burst of events a single save causes
+        for event in inotify.read(read_delay=50):
+            if event.wd not in watches:
+                continue
+            path = os.path.join(watches[event.wd], event.name)
+            if event.mask & flags.ISDIR:
+                if event.mask & (flags.CREATE | flags.MOVED_TO):
+                    add_watches(path)
+                # a directory path makes the index rescan the whole root
+                changed.add(path)
+            elif os.path.splitext(event.name)[1] in CONFIG_EXTENSIONS or \
+                    path in extra_files:
+                changed.add(path)
+        if changed:
+            yield changed
+
+def produce(args, index):
+    config_json = None
+    template_keys = TemplateKeys(args.template_keys)
+    if args.mode == "group":
+        config_json = collect_instance_files(args.input, args.root,
+            template_keys, args.flatten_hierarchy, index, args.select)
+    elif args.mode == "single":
+        with profiling.timings.stage("fill template"):
+            config_json = template_keys.fill(index.make_config_json(
+                args.input))
+    if config_json is None:
+        raise ConfigException("couldn't make config json")
+    return finish_output(args, config_json, template_keys)
+
+def produce_from_bundle(args):
+    # the bundle was filled when packing, filling again would substitute
+    # keys inside values
+    template_keys = TemplateKeys()
+    with bundle.Bundle(args.bundle, args.bundle_hash) as config_bundle:
+        if args.mode == "group":
+            app_ids = config_bundle.app_ids()
+            if args.select:
+                # without a root every selector is an app id selector
+                selectors = [Selector(value) for value in args.select]
+                app_ids = [app_id for app_id in app_ids
+                    if any(s.matches_id(app_id) for s in selectors)]
+                if not app_ids:
+                    raise ConfigException("no instances in {} match {}"
+                        .format(args.bundle, ", ".join(args.select)))
+            instances = [config_bundle.get(app_id) for app_id in app_ids]
+            config_json = make_hierarchy_dict(args.input, instances,
+                args.flatten_hierarchy)
+        elif args.mode == "single":
+            config_json = config_bundle.get_config(args.input)
+            if config_json is None:
+                raise ConfigException("couldn't find config {} in bundle {}"
+                    .format(args.input, args.bundle))
+        else:
+            raise ConfigException("couldn't make config json")
+    return finish_output(args, config_json, template_keys)
+
+def write_template_keys_report(path, template_keys):
+    """ writes the template keys report as json to path, or to stderr if
+        path is -
+    """
+    report = "{}\n".format(json.dumps(template_keys.get_report(), indent=4))
+    if path == "-":
+        sys.stderr.write(report)
+    else:
+        with open(path, "w") as report_file:
+            report_file.write(report)
+
+def finish_output(args, config_json, template_keys):
+    if args.validate:
+        with profiling.timings.stage("validate"):
+            errors = validation.validate(config_json)
+        if errors:
+            raise ConfigException("{} validation error(s):\n{}".format(
+                len(errors), "\n".join(errors)))
+    if args.template_keys_report is not None:
+        write_template_keys_report(args.template_keys_report, template_keys)
+    # template keys are already applied per application
+    return format_output(config_json)
+
+def write_output(output, json_output):
+    if output == "-":
+        sys.stdout.write(json_output)
+        sys.stdout.flush()
+    else:
+        with open(output, "w") as output_file:
+            output_file.write(json_output)
+
+def watch(args, index):
+    try:
+        write_output(args.output, produce(args, index))
+    except ConfigException as e:
+        print(str(e), file=sys.stderr)
+    extra_files = [args.input] if args.mode == "single" else []
+    for changed in watch_config_root(args.root, args.watch_interval,
+            extra_files):
+        start = time.time()
+        affected = index.invalidate(changed)
+        try:
+            write_output(args.output, produce(args, index))
+            print("regenerated {} instance(s) in {:.1f} ms".format(
+                len(affected), (time.time() - start) * 1000),
+                file=sys.stderr)
+        except ConfigException as e:
+            print(str(e), file=sys.stderr)
+
+def get_affected_app_ids(index, configs, template_keys=None,
+        flat_hierarchy_compatibility=False, selectors=None):
+    """ returns the sorted app ids of the instances affected by configs,
+        given as paths or config names
+
+        only instances matching selectors are considered and ids are
+        filled and flattened the way a group produced from them would be
+    """
+    paths = []
+    for config in configs:
+        path = config
+        if not os.path.isfile(config):
+            name, ext = os.path.splitext(os.path.basename(config))
+            path = index.get_config_file(name if ext in CONFIG_EXTENSIONS
+                else os.path.basename(config))
+            if path is None:
+                raise ConfigException("couldn't find config {}".format(
+                    config))
+        paths.append(path)
+    if not isinstance(template_keys, TemplateKeys):
+        template_keys = TemplateKeys(template_keys)
+    instances = index.get_affected_instances(paths)
+    if selectors:
+        selected = set(index.select_instances(selectors, template_keys))
+        instances = [i for i in instances if i in selected]
+    app_ids = set()
+    for instance in instances:
+        app_id = index.make_config_json(instance).get("id")
+        if app_id is None:
+            raise ConfigException("instance {} has no id".format(instance))
+        app_id = template_keys.fill_text(app_id)[0]
+        if flat_hierarchy_compatibility:
+            app_id = replace_path_slashes(app_id)
+        app_ids.add(app_id)
+    return sorted(app_ids)
+
 def main():
     args = setup_args()
+    profiling.run(args, run_command, args)
+
+def run_command(args):
     if args.template_keys_file is not None:
         args.template_keys = merge_template_keys(args.template_keys_file,
             args.template_keys)
     try:
-        config_json = None
-        if args.mode == "group":
-            config_json = collect_instance_files(args.input, args.root,
-                args.template_keys, args.flatten_hierarchy)
-        elif args.mode == "single":
-            if not os.path.isfile(args.input):
-                config_file = get_config_file(args.root, args.input)
-                if config_file is None:
-                    print("couldn't find config {}".format(config_file),
-                        file=sys.stderr)
-                    sys.exit(1)
-                args.input = config_file
-            config_json = make_config_json(args.root, args.input)
-        if config_json is None:
-            print("couldn't make config json", file=sys.stderr)
-            sys.exit(1)
-        json_output = format_output(config_json, args.template_keys)
-        if args.output == "-":
-            sys.stdout.write(json_output)
+        if args.bundle is not None:
+            write_output(args.output, produce_from_bundle(args))
+            return
+        index = ConfigIndex(args.root)
+        if args.pack is not None:
+            digest = bundle.pack(index, args.pack,
+                TemplateKeys(args.template_keys))
+            print("packed {} config(s) with tree hash {}".format(
+                len(index.paths), digest), file=sys.stderr)
+            return
+        if args.affected_by is not None:
+            app_ids = get_affected_app_ids(index, args.affected_by,
+                args.template_keys, args.flatten_hierarchy, args.select)
+            write_output(args.output, "".join("{}\n".format(app_id)
+                for app_id in app_ids))
+            return
+        if args.mode == "single" and not os.path.isfile(args.input):
+            config_file = index.get_config_file(args.input)
+            if config_file is None:
+                print("couldn't find config {}".format(args.input),
+                    file=sys.stderr)
+                sys.exit(1)
+            args.input = config_file
+        if args.mode == "single":
+            args.input = os.path.abspath(args.input)
+        if args.watch:
+            watch(args, index)
         else:
-            with open(args.output, "w") as output_file:
-                output_file.write(json_output)
-    except ConfigException as e:
+            write_output(args.output, produce(args, index))
+    except (ConfigException, bundle.BundleException) as e:
         print(str(e), file=sys.stderr)
         sys.exit(1)
+    except KeyboardInterrupt:
+        pass
 
 if __name__ == "__main__":
     main()
@@ -6,98 +6,372 @@
 # -*- mode: python -*-
 
 import argparse
+import collections
+import concurrent.futures
+import configparser
 import copy
+import hashlib
 import json
 import logging
+import math
 import sys
 import time
+import urllib.parse
 import warnings
 
 import os
-import requests
-from requests.packages.urllib3 import exceptions
+import posixpath
+
+from mesos_tools import bundle
+from mesos_tools import locking
+from mesos_tools import profiling
+from mesos_tools import readiness
+from mesos_tools import status
+from mesos_tools import validation
+from mesos_tools.lazy_import import LazyModule
+
+requests = LazyModule("requests")
+exceptions = LazyModule("urllib3.exceptions")
 
 logging.getLogger('Marathon').addHandler(logging.NullHandler())
 
 class MarathonException(Exception):
     pass
 
+ON_UNCHANGED_POLICIES = ("restart", "skip", "verify")
+FINGERPRINT_LABEL = "mesos-tools.fingerprint"
+""" Marathon label holding the content hash of the deployed application definition """
+STRATEGIES = ("rolling", "blue-green")
+ACTIVE_LABEL = "mesos-tools.active"
+""" Marathon label marking which of the blue and green applications receives traffic """
+STATUS_CACHE_TIMEOUT = 30
+""" Seconds to wait for a fresh status cache snapshot before asking marathon directly """
+
 class Marathon:
     """ Class for Mesos application orchestration using Marathon
 
-        This class logs through a logger named 'Marathon'
+        This class logs through a logger named 'Marathon', or 'Marathon.<name>'
+        when given a cluster name
     """
 
-    def __init__(self, baseurl, access_token):
+    def __init__(self, baseurl, access_token, on_unchanged="restart", parallelism=8, name=None, scale_step=None,
+                 scale_step_timeout=600, strategy="rolling", rollback=False, deploy_timeout=None, session=None,
+                 status_cache=None, lock="none", lock_dir=None, lock_timeout=None):
         self.baseurl = baseurl
         """ Marathon service base URL """
         self.cookies = {'access_token': access_token}
         """ Marathon service access token """
-        self.logger = logging.getLogger('Marathon')
+        if on_unchanged not in ON_UNCHANGED_POLICIES:
+            raise MarathonException("unknown policy for unchanged applications: {}".format(on_unchanged))
+        self.on_unchanged = on_unchanged
+        """ What to do with an application whose config is unchanged: restart, skip or verify """
+        self.parallelism = parallelism
+        """ Maximum number of concurrent requests for operations spanning several apps or groups """
+        self.scale_step = Marathon.parse_scale_step(scale_step)
+        """ (size, is_percentage) of each step when scaling up, or None to scale in one go """
+        self.scale_step_timeout = scale_step_timeout
+        """ Seconds to wait for each scale step to become healthy before rolling back """
+        if strategy not in STRATEGIES:
+            raise MarathonException("unknown deployment strategy: {}".format(strategy))
+        self.strategy = strategy
+        """ How changed applications are deployed: rolling upgrade in place or blue-green next to the current """
+        self.rollback = rollback
+        """ Whether deploy_group restores the pre-deploy versions of the group's applications when it fails """
+        self.deploy_timeout = deploy_timeout
+        """ Seconds deploy_group waits for the applications of a group before failing, or None to wait forever """
+        self._deadline = None
+        if session is None:
+            session = requests.Session()
+            adapter = requests.adapters.HTTPAdapter(pool_maxsize=max(parallelism, 1))
+            session.mount("http://", adapter)
+            session.mount("https://", adapter)
+        self.session = session
+        """ Connection pool for this Marathon service, may be shared by several Marathon objects """
+        self.status_cache = status_cache
+        """ Optional status.StatusCache of this service, shared with other deployments when polling deployments """
+        try:
+            self.locks = locking.make_locks(lock, self, lock_dir, lock_timeout)
+            """ Per-application locks taken by deploy, or None """
+        except locking.LockException as e:
+            raise MarathonException(str(e))
+        self.name = name
+        """ Optional cluster name, used as suffix of the logger name when deploying to several services """
+        self.logger = logging.getLogger('Marathon' if name is None else 'Marathon.' + name)
 
     def deploy(self, application):
+        if self.locks is None:
+            return self._deploy(application)
+        with self.locks.hold(application['id']):
+            return self._deploy(application)
+
+    def _deploy(self, application):
         self.logger.debug("Deploying application with id '%s'", application['id'])
-        current = self._get_application(application['id'])
+        current = self._get_current_application(application['id'])
         if current is None:
-            self._create_application(application)
+            deployed_id = application['id']
+            self._create_application(self._get_deployable(application, deployed_id))
         else:
+            # with blue/green deployments the running application may have a colour suffixed id
+            deployed_id = current['app']['id']
             # find resulting number of instances
             num_instances = self._get_number_of_expected_instances(application, current)
-            if Marathon.is_update(application, current['app']):
-                self._update_application(application, current['app']['version'],
-                                         num_instances,
-                                         scale_only=Marathon.is_scale_only_update(application, current['app']))
+            if not Marathon.is_unchanged(application, current['app']):
+                self._wait_while_app_is_affected_by_deployment(deployed_id)
+                scale_only = Marathon.is_scale_only_update(dict(application, id=deployed_id), current['app'])
+                if self.strategy == "blue-green" and not scale_only:
+                    deployed_id = self._deploy_blue_green(application, current['app'], num_instances)
+                else:
+                    if scale_only and self.scale_step is not None:
+                        self._scale_in_steps(current['app'], num_instances)
+                    self._update_application(self._get_deployable(application, deployed_id),
+                                             current['app']['version'], num_instances, scale_only=scale_only)
             else:
                 self.logger.debug("comparison indicates that given %s causes no update of current %s", application,
                                   current['app'])
-                self._restart_application(application, current['app']['version'], num_instances)
-        self._wait_while_app_is_affected_by_deployment(application['id'])
-        self.logger.info("deployment operation finished for %s", application['id'])
+                if self.on_unchanged == "skip":
+                    self.logger.info("application %s is unchanged, skipping", application['id'])
+                    return
+                elif self.on_unchanged == "verify":
+                    self._verify_application(dict(application, id=deployed_id), current['app']['version'],
+                                             num_instances)
+                else:
+                    self._wait_while_app_is_affected_by_deployment(deployed_id)
+                    self._restart_application(dict(application, id=deployed_id), current['app']['version'],
+                                              num_instances)
+        # the new version is running and healthy, marathon stopping the old tasks is not waited for. A later
+        # change of the application waits for that deployment first, since marathon would refuse it meanwhile
+        self.logger.info("deployment operation finished for %s", deployed_id)
 
-    def deploy_group(self, applications):
-        if 'apps' not in applications or type(applications['apps']) != list:
-            self.deploy(applications)
+    def _get_current_application(self, application_id):
+        if self.strategy == "blue-green":
+            active_app = self._get_active_application(application_id)
+            if active_app is None:
+                return None
+            application_id = active_app['id']
+        return self._get_application(application_id)
+
+    def _get_active_application(self, application_id):
+        return Marathon.find_active_application(application_id, self._list_applications(application_id))
+
+    def _get_deployable(self, application, application_id):
+        """ returns application as it should be sent to marathon under application_id
+
+            the fingerprint is taken of the given application so it is independent of the deployed id
+        """
+        deployable = Marathon.with_fingerprint(application)
+        deployable['id'] = application_id
+        if self.strategy == "blue-green":
+            deployable['labels'][ACTIVE_LABEL] = 'true'
+        return deployable
+
+    def _deploy_blue_green(self, application, current_app, num_instances):
+        """ deploys application next to current_app at full scale and switches over once it is healthy
+
+            current_app is kept with zero instances as a rollback path. Returns the id of the new application.
+        """
+        blue_id, green_id = Marathon.get_blue_green_ids(application['id'])
+        new_id = blue_id if current_app['id'] == green_id else green_id
+        new_app = self._get_deployable(application, new_id)
+        new_app['instances'] = num_instances
+        self.logger.info("deploying %s next to %s", new_id, current_app['id'])
+        existing = self._get_application(new_id)
+        if existing is None:
+            self._create_application(new_app)
         else:
-            for application in applications['apps']:
-                application["id"] = self._merge_group_id_and_app_id(applications["id"], application["id"])
-                self.logger.debug("Rewriting application id to: " + application['id'])
+            # the previous switch may still be scaling it down
+            self._wait_while_app_is_affected_by_deployment(new_id)
+            self._update_application(new_app, existing['app']['version'], num_instances)
+        self.logger.info("switching %s from %s to %s", application['id'], current_app['id'], new_id)
+        labels = dict(current_app.get('labels', {}))
+        labels[ACTIVE_LABEL] = 'false'
+        self._put_application_fields(current_app['id'], {'instances': 0, 'labels': labels})
+        return new_id
+
+    def deploy_group(self, applications):
+        group_applications = self._get_group_applications(applications)
+        # one list call captures the current definition and version of every application in the group
+        previous_apps = self._list_applications(applications['id']) if self.rollback else None
+        changed = []
+        if self.deploy_timeout is not None:
+            self._deadline = time.time() + self.deploy_timeout
+        try:
+            for application in group_applications:
+                # unchanged applications are at most restarted, there is nothing to restore for them
+                if previous_apps is not None and self._plan_application(application, previous_apps) != "unchanged":
+                    changed.append(application['id'])
                 self.deploy(application)
+        except Exception as e:
+            if previous_apps is None:
+                raise
+            self.logger.error("deployment of %s failed, rolling back %s: %s", applications['id'],
+                              ", ".join(changed) or "nothing", e)
+            self._deadline = None
+            self._roll_back(changed, previous_apps)
+            raise MarathonException("deployment of {} failed and was rolled back: {}".format(applications['id'], e))
+        finally:
+            self._deadline = None
+
+    def _roll_back(self, application_ids, previous_apps):
+        """ restores the applications with the given ids to their versions in previous_apps
+
+            applications that did not exist before are deleted. With blue/green deployments both colours are
+            restored. Waits until the restored applications have all instances running and healthy.
+        """
+        if not application_ids:
+            self.logger.info("rolled back nothing")
+            return
+        previous = {app['id']: app for app in previous_apps}
+        ids = []
+        for application_id in application_ids:
+            ids.append(application_id)
+            if self.strategy == "blue-green":
+                ids.extend(Marathon.get_blue_green_ids(application_id))
+        current = {app['id'] for app in self._list_applications(posixpath.commonprefix(ids) or "/")}
+        restore = [previous[app_id] for app_id in ids if app_id in previous]
+        delete = [app_id for app_id in ids if app_id not in previous and app_id in current]
+        deployment_ids = self._run_concurrently(self._roll_back_application, restore)
+        deployment_ids += self._run_concurrently(self._delete_application, delete)
+        self._wait_for_deployments([d for d in deployment_ids if d is not None])
+        self._run_concurrently(lambda app: self._wait_for_application_instances(
+            app['id'], app['version'], app['instances'], scale_only=True), restore)
+        self.logger.info("rolled back %s", ", ".join(app['id'] for app in restore) or "nothing")
+
+    def _roll_back_application(self, app):
+        """ puts an application back to a previous version, overriding the failed deployment """
+        self.logger.info("rolling %s back to version '%s'", app['id'], app['version'])
+        response = http_put("/".join([self.baseurl, 'v2', 'apps', app['id']]), {'version': app['version']},
+                            self.cookies, {'force': 'true'}, session=self.session)
+        if response.status_code != requests.codes.OK:
+            raise MarathonException("{} error while rolling back application {} - {}"
+                                    .format(response.status_code, app['id'], response.text))
+        return response.json().get('deploymentId')
+
+    def _post_lease(self, lease):
+        """ creates a lease application, returning False if it already exists """
+        response = http_post("/".join([self.baseurl, 'v2', 'apps']), lease, self.cookies, session=self.session)
+        if response.status_code == requests.codes.CONFLICT:
+            return False
+        if response.status_code not in (requests.codes.OK, requests.codes.CREATED):
+            raise MarathonException("{} error while creating lease {} - {}"
+                                    .format(response.status_code, lease['id'], response.text))
+        return True
+
+    def _delete_application(self, application_id):
+        self.logger.info("deleting application %s", application_id)
+        response = http_delete("/".join([self.baseurl, 'v2', 'apps', application_id]), self.cookies,
+                               {'force': 'true'}, session=self.session)
+        if response.status_code != requests.codes.OK:
+            raise MarathonException("{} error while deleting application {} - {}"
+                                    .format(response.status_code, application_id, response.text))
+        return response.json().get('deploymentId')
+
+    def _check_deadline(self, waiting_for):
+        if self._deadline is not None and time.time() > self._deadline:
+            raise MarathonException("timed out after {} seconds waiting for {}".format(self.deploy_timeout,
+                                                                                     waiting_for))
+
+    def plan_group(self, applications):
+        """ returns a list of (application id, action) pairs describing what deploy_group would do
+
+            action is one of create, update, scale or unchanged. Current state is fetched with a
+            single list call for the whole group.
+        """
+        group_applications = self._get_group_applications(applications)
+        current_apps = self._list_applications(applications['id'])
+        return [(application['id'], self._plan_application(application, current_apps))
+                for application in group_applications]
+
+    def _plan_application(self, application, current_apps):
+        """ returns create, update, scale or unchanged for deploying application over current_apps """
+        if self.strategy == "blue-green":
+            current_app = Marathon.find_active_application(application['id'], current_apps)
+        else:
+            current_app = next((app for app in current_apps if app['id'] == application['id']), None)
+        if current_app is None:
+            return "create"
+        elif Marathon.is_unchanged(application, current_app):
+            return "unchanged"
+        elif Marathon.is_scale_only_update(dict(application, id=current_app['id']), current_app):
+            return "scale"
+        return "update"
+
+    def _get_group_applications(self, applications):
+        """ returns the applications of a group with ids rewritten to be below the group id """
+        if 'apps' not in applications or type(applications['apps']) != list:
+            return [applications]
+        for application in applications['apps']:
+            application["id"] = self._merge_group_id_and_app_id(applications["id"], application["id"])
+            self.logger.debug("Rewriting application id to: " + application['id'])
+        return applications['apps']
 
     def delete_group(self, group_name):
         response = http_get("/".join([self.baseurl, "v2",
-            "groups", group_name]), self.cookies)
+            "groups", group_name]), self.cookies, session=self.session)
         try:
             js = response.json()
             if "groups" not in js:
                 raise MarathonException("no groups found in reponse")
-            stack = [js["groups"]]
-            groups_to_delete = [group_name]
-            while stack:
-                groups = stack.pop()
-                for group in groups:
-                    if "groups" in group:
-                        groups_to_delete.append(group["id"])
-                        stack.append(group["groups"])
-            for group in groups_to_delete[::-1]:
-                # writing an empty group is necessary since marathon cannot
-                # delete groups with content
-                js = json.loads("{{\"id\": \"{}\", \"apps\": []}}".format(group))
-                response = http_put("/".join([self.baseurl, "v2", "groups"]), js,
-                    self.cookies, {"force": "true"})
-                if response.status_code != requests.codes.OK:
-                    raise MarathonException("{} error while deploying "
-                        "empty group {} - {}".format(response.status_code,
-                        group, response.text))
-                response = http_delete("/".join([self.baseurl, "v2", "groups",
-                    group]), self.cookies)
-                if response.status_code != requests.codes.OK:
-                    raise MarathonException("{} error while deleting group "
-                        "{} - {}".format(response.status_code, group,
-                        response.text))
+            # removing the whole subtree in one forced operation is by far
+            # the fastest, but older marathon versions refuse to delete
+            # groups with content so fall back to emptying level by level
+            deployment_id = self._delete_group_forced(group_name)
+            if deployment_id is not None:
+                self._wait_for_deployments([deployment_id])
+                return
+            levels = Marathon.get_group_levels(group_name, js["groups"])
+            for level in levels[::-1]:
+                self.logger.info("deleting group(s) %s", ", ".join(level))
+                deployment_ids = []
+                for ids in self._run_concurrently(self._empty_and_delete_group, level):
+                    deployment_ids.extend(ids)
+                self._wait_for_deployments(deployment_ids)
         except ValueError as e:
             raise MarathonException("caught exception deleting group: {}"
                 .format(str(e)))
 
+    def _delete_group_forced(self, group_name):
+        response = http_delete("/".join([self.baseurl, "v2", "groups",
+            group_name]), self.cookies, {"force": "true"}, session=self.session)
+        if response.status_code != requests.codes.OK:
+            self.logger.debug("%s error while force deleting group %s, "
+                "deleting subgroups one at a time - %s", response.status_code,
+                group_name, response.text)
+            return None
+        return response.json().get("deploymentId")
+
+    def _empty_and_delete_group(self, group):
+        deployment_ids = []
+        # writing an empty group is necessary since marathon cannot
+        # delete groups with content
+        js = {"id": group, "apps": []}
+        response = http_put("/".join([self.baseurl, "v2", "groups"]), js,
+            self.cookies, {"force": "true"}, session=self.session)
+        if response.status_code != requests.codes.OK:
+            raise MarathonException("{} error while deploying "
+                "empty group {} - {}".format(response.status_code,
+                group, response.text))
+        deployment_ids.append(response.json().get("deploymentId"))
+        response = http_delete("/".join([self.baseurl, "v2", "groups",
+            group]), self.cookies, session=self.session)
+        if response.status_code != requests.codes.OK:
+            raise MarathonException("{} error while deleting group "
+                "{} - {}".format(response.status_code, group,
+                response.text))
+        deployment_ids.append(response.json().get("deploymentId"))
+        return [d for d in deployment_ids if d is not None]
+
+    def _run_concurrently(self, function, items):
+        """ runs function on each item using at most self.parallelism threads
+
+            results are returned in the order of items and the first
+            exception raised by any call is re-raised
+        """
+        if len(items) <= 1 or self.parallelism <= 1:
+            return [function(item) for item in items]
+        with concurrent.futures.ThreadPoolExecutor(max_workers=self.parallelism) as executor:
+            futures = [executor.submit(function, item) for item in items]
+            return [future.result() for future in futures]
+
     def _merge_group_id_and_app_id(self, group_id, application_id):
         self.logger.debug("Merging group id '%s' with application id '%s'", group_id, application_id)
         new_app_id = group_id
@@ -118,16 +392,35 @@ class Marathon:
             num_instances = current['app']['instances']
         return num_instances
 
+    def _get_deployments(self):
+        if self.status_cache is not None:
+            # a snapshot begun after this call can't miss deployments started before it
+            snapshot = self.status_cache.wait_for_snapshot(time.time(), STATUS_CACHE_TIMEOUT)
+            if snapshot is not None:
+                return snapshot['deployments']
+        response = http_get("/".join([self.baseurl, 'v2', 'deployments']), self.cookies,
+                            session=self.session)
+        status_code = response.status_code
+        if status_code != requests.codes.OK:
+            raise Exception("{} error while fetching deployments - {}"
+                            .format(status_code, response.text))
+        return json.loads(response.text)
+
+    def _wait_for_deployments(self, deployment_ids):
+        pending = set(deployment_ids)
+        if pending:
+            self.logger.info("waiting for %s deployment(s) to finish", len(pending))
+        while pending:
+            active_deployments = self._get_deployments()
+            pending &= {deployment['id'] for deployment in active_deployments}
+            if pending:
+                profiling.sleep(1)
+
     def _wait_while_app_is_affected_by_deployment(self, application_id):
         self.logger.info("Waiting for app to be unaffected by deployments")
         affected = True
         while affected:
-            response = http_get("/".join([self.baseurl, 'v2', 'deployments']), self.cookies)
-            status_code = response.status_code
-            if status_code != requests.codes.OK:
-                raise Exception("{} error while fetching application {} - {}"
-                                .format(status_code, application_id, response.text))
-            active_deployments = json.loads(response.text)
+            active_deployments = self._get_deployments()
 
             # Assume the app is not affected by any deployments
             affected = False
@@ -135,11 +428,14 @@ class Marathon:
             for deployment in active_deployments:
                 if application_id in deployment['affectedApps']:
                     affected = True
-            time.sleep(1)
+            if affected:
+                self._check_deadline("deployments of application {}".format(application_id))
+                profiling.sleep(1)
         return
 
     def _get_application(self, application_id):
-        response = http_get("/".join([self.baseurl, 'v2', 'apps', application_id]), self.cookies)
+        response = http_get("/".join([self.baseurl, 'v2', 'apps', application_id]), self.cookies,
+                            session=self.session)
         status_code = response.status_code
         if status_code == requests.codes.OK:
             return json.loads(response.text)
@@ -149,10 +445,81 @@ class Marathon:
             raise Exception("{} error while fetching application {} - {}"
                             .format(status_code, application_id, response.text))
 
+    def _scale_in_steps(self, current_app, num_instances):
+        """ raises instances of current_app towards num_instances one step at a time
+
+            Each step has to be running and healthy within scale_step_timeout seconds and its deployment finished
+            before the next one is sent. If a step fails in any way the application is scaled back to its original
+            number of instances. The final step is left to the caller.
+        """
+        application_id = current_app['id']
+        steps = Marathon.get_scale_steps(current_app['instances'], num_instances, self.scale_step)
+        health_checked = bool(current_app.get('healthChecks'))
+        for instances in steps[:-1]:
+            self.logger.info("scaling application %s to %s of %s instance(s)", application_id, instances,
+                             num_instances)
+            try:
+                self._put_instances(application_id, instances)
+                if not self._wait_for_scale_step(application_id, instances, health_checked):
+                    raise MarathonException("no {} healthy instance(s) within {} seconds"
+                                            .format(instances, self.scale_step_timeout))
+                # marathon refuses the next step with 409 while the deployment of this one is still running
+                self._wait_while_app_is_affected_by_deployment(application_id)
+            except Exception as e:
+                self.logger.error("scaling application %s to %s instance(s) failed, scaling back to %s: %s",
+                                  application_id, instances, current_app['instances'], e)
+                self._put_instances(application_id, current_app['instances'], force=True)
+                raise MarathonException("scaling of application {} failed at {} instance(s): {}"
+                                        .format(application_id, instances, e))
+
+    def _put_instances(self, application_id, instances, force=False):
+        self._put_application_fields(application_id, {'instances': instances}, force)
+
+    def _put_application_fields(self, application_id, fields, force=False):
+        """ partially updates an application, leaving fields not given as they are """
+        response = http_put("/".join([self.baseurl, 'v2', 'apps', application_id]), fields,
+                            self.cookies, {'force': 'true'} if force else None, session=self.session)
+        if response.status_code != requests.codes.OK:
+            raise MarathonException("{} error while updating {} of application {} - {}"
+                                    .format(response.status_code, ", ".join(sorted(fields)), application_id,
+                                            response.text))
+
+    def _wait_for_scale_step(self, application_id, instances, health_checked):
+        deadline = time.time() + self.scale_step_timeout
+        while time.time() < deadline:
+            counts = self._get_application_counts(application_id)
+            ready = counts['tasksHealthy'] if health_checked else counts['tasksRunning']
+            if ready >= instances:
+                return True
+            self._check_deadline("{} healthy instance(s) of application {}".format(instances, application_id))
+            profiling.sleep(1)
+        return False
+
+    def _get_application_counts(self, application_id):
+        """ fetches task counts of an application without its task list """
+        for app in self._list_applications(application_id, embed='apps.counts'):
+            if app['id'] == application_id:
+                return {key: app.get(key, 0) for key in
+                        ('instances', 'tasksRunning', 'tasksHealthy', 'tasksStaged', 'tasksUnhealthy')}
+        raise MarathonException("application {} not found".format(application_id))
+
+    def _list_applications(self, id_filter, embed=None):
+        params = {'id': id_filter}
+        if embed is not None:
+            params['embed'] = embed
+        response = http_get("/".join([self.baseurl, 'v2', 'apps']) + "?" + urllib.parse.urlencode(params),
+                            self.cookies, session=self.session)
+        status_code = response.status_code
+        if status_code != requests.codes.OK:
+            raise Exception("{} error while listing applications matching {} - {}"
+                            .format(status_code, id_filter, response.text))
+        return json.loads(response.text)['apps']
+
     def _create_application(self, application):
         application_id = application['id']
         self.logger.info("creating application %s", application_id)
-        response = http_post("/".join([self.baseurl, 'v2', 'apps']), application, self.cookies)
+        response = http_post("/".join([self.baseurl, 'v2', 'apps']), application, self.cookies,
+                             session=self.session)
         status_code = response.status_code
         if status_code == requests.codes.OK or status_code == requests.codes.CREATED:
             deployment = json.loads(response.text)
@@ -167,7 +534,7 @@ class Marathon:
         self.logger.info("updating version '%s' of application %s. Scale_only: %s",
                          old_version, application_id, scale_only)
         response = http_put("/".join([self.baseurl, 'v2', 'apps', application['id']]), application,
-                                     self.cookies)
+                                     self.cookies, session=self.session)
         status_code = response.status_code
         if status_code == requests.codes.OK:
             deployment = json.loads(response.text)
@@ -182,7 +549,7 @@ class Marathon:
         application_id = application['id']
         self.logger.info("restarting version '%s' of application %s", old_version, application_id)
         response = http_post("/".join([self.baseurl, 'v2', 'apps', application['id'], 'restart']), None,
-                                      self.cookies)
+                                      self.cookies, session=self.session)
         status_code = response.status_code
         if status_code == requests.codes.OK:
             deployment = json.loads(response.text)
@@ -192,12 +559,18 @@ class Marathon:
             raise Exception("{} error during restart of application {} - {}"
                             .format(status_code, application_id, response.text))
 
+    def _verify_application(self, application, version, num_instances):
+        self.logger.info("verifying version '%s' of unchanged application %s", version, application['id'])
+        # tasks started before a pure scale keep their old version, so only health and count are checked
+        self._wait_for_application_instances(application['id'], version, num_instances, scale_only=True)
+
     def _wait_for_new_application_version(self, application_id, application_version):
         self.logger.info("waiting for version '%s' of application %s", application_version, application_id)
         while True:
             current = self._get_application(application_id)
             if current is not None and current['app']['version'] >= application_version:
                 break
+            self._check_deadline("version '{}' of application {}".format(application_version, application_id))
         return current
 
     def _wait_for_application_instances(self, application_id, application_version, application_instances,
@@ -206,23 +579,26 @@ class Marathon:
                          application_instances, application_id)
         while True:
             current = self._get_application(application_id)
-            # If there are a different number of tasks than expected instances we are clearly not done.
-            if len(current['app']['tasks']) != int(application_instances):
-                time.sleep(1)
-                continue
-            instances_ok = 0
-            for task in current['app']['tasks']:
-                version_ok = True if scale_only else task['version'] >= application_version
-                if task['appId'].startswith(application_id) \
-                        and task['state'] == 'TASK_RUNNING' \
-                        and Marathon.is_healthy(task) \
-                        and version_ok:
-                    instances_ok += 1
-            if instances_ok == int(application_instances):
+            # old tasks may linger while the deployment finishes, the deployment itself is waited for by deploy
+            ready, delay = readiness.evaluate(current['app'], application_version, application_instances,
+                                              scale_only)
+            if ready:
                 break
-            time.sleep(1)
+            self._check_deadline("{} healthy instance(s) of application {}".format(application_instances,
+                                                                                   application_id))
+            profiling.sleep(delay)
         return current
 
+    @staticmethod
+    def get_group_levels(group_name, groups):
+        """ returns group ids by depth, with group_name alone at depth 0 """
+        levels = [[group_name]]
+        current = groups
+        while current:
+            levels.append([group["id"] for group in current])
+            current = [subgroup for group in current for subgroup in group.get("groups", [])]
+        return levels
+
     @staticmethod
     def is_scale_only_update(application, current):
         if 'instances' in application:
@@ -234,6 +610,84 @@ class Marathon:
         application_copy['instances'] = current['instances']
         return not Marathon.is_update(application_copy, current)
 
+    @staticmethod
+    def find_active_application(application_id, apps):
+        """ finds the live variant of application_id in apps among the id itself and its blue and green variants
+
+            an application labelled active wins over one that merely has instances
+        """
+        candidate_ids = [application_id] + Marathon.get_blue_green_ids(application_id)
+        candidates = [app for app in apps if app['id'] in candidate_ids]
+        for app in candidates:
+            if app.get('labels', {}).get(ACTIVE_LABEL) == 'true':
+                return app
+        for app in candidates:
+            if app.get('instances', 0) > 0:
+                return app
+        return candidates[0] if candidates else None
+
+    @staticmethod
+    def get_blue_green_ids(application_id):
+        """ returns the (blue, green) application ids used for blue/green deployments of application_id """
+        return [application_id + "-blue", application_id + "-green"]
+
+    @staticmethod
+    def parse_scale_step(scale_step):
+        """ parses a scale step like "10" or "25%" into (size, is_percentage) """
+        if scale_step is None:
+            return None
+        text = str(scale_step).strip()
+        is_percentage = text.endswith('%')
+        try:
+            size = float(text[:-1]) if is_percentage else int(text)
+        except ValueError:
+            raise MarathonException("invalid scale step: {}".format(scale_step))
+        if size <= 0 or (is_percentage and size > 100):
+            raise MarathonException("invalid scale step: {}".format(scale_step))
+        return size, is_percentage
+
+    @staticmethod
+    def get_scale_steps(current_instances, target_instances, scale_step):
+        """ returns the instance counts to pass through when scaling up, ending with target_instances
+
+            percentages are of target_instances and every step adds at least one instance
+        """
+        if scale_step is None or target_instances <= current_instances:
+            return [target_instances]
+        size, is_percentage = scale_step
+        increment = int(math.ceil(target_instances * size / 100.0)) if is_percentage else size
+        increment = max(increment, 1)
+        steps = list(range(current_instances + increment, target_instances, increment))
+        steps.append(target_instances)
+        return steps
+
+    @staticmethod
+    def fingerprint(application):
+        """ canonical content hash of an application definition, ignoring the fingerprint label """
+        app_copy = dict(application)
+        labels = dict(app_copy.pop('labels', {}))
+        labels.pop(FINGERPRINT_LABEL, None)
+        if labels:
+            app_copy['labels'] = labels
+        canonical = json.dumps(app_copy, sort_keys=True, separators=(',', ':'))
+        return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def with_fingerprint(application):
+        """ returns a copy of application with its fingerprint stored in a label """
+        app_copy = dict(application)
+        app_copy['labels'] = dict(application.get('labels', {}))
+        app_copy['labels'][FINGERPRINT_LABEL] = Marathon.fingerprint(application)
+        return app_copy
+
+    @staticmethod
+    def is_unchanged(application, current_app):
+        """ compares fingerprints when current_app has one and falls back to is_update otherwise """
+        fingerprint = current_app.get('labels', {}).get(FINGERPRINT_LABEL)
+        if fingerprint is not None:
+            return fingerprint == Marathon.fingerprint(application)
+        return not Marathon.is_update(application, current_app)
+
     @staticmethod
     def is_update(application, current_app):
         app_copy = copy.deepcopy(application)
@@ -309,42 +763,228 @@ class Marathon:
 
     @staticmethod
     def is_healthy(task):
-        if 'healthCheckResults' in task:
-            for result in task['healthCheckResults']:
-                if not result['alive']:
-                    return False
-        return True
+        return readiness.is_healthy(task)
 
-def http_post(url, json_data, cookies):
-    return base_http_method(requests.post, url, cookies=cookies,
+def http_post(url, json_data, cookies, session=None):
+    return base_http_method("post", url, session, cookies=cookies,
         json=json_data, verify=False, headers={'content-type':
         'application/json'})
 
-def http_put(url, json_data, cookies, params=None):
-    return base_http_method(requests.put, url, cookies=cookies,
+def http_put(url, json_data, cookies, params=None, session=None):
+    return base_http_method("put", url, session, cookies=cookies,
         json=json_data, verify=False, params=params)
 
-def http_get(url, cookies):
-    return base_http_method(requests.get, url, cookies=cookies,
+def http_get(url, cookies, session=None):
+    return base_http_method("get", url, session, cookies=cookies,
         verify=False)
 
-def http_delete(url, cookies):
-    return base_http_method(requests.delete, url, cookies=cookies,
-        verify=False)
+def http_delete(url, cookies, params=None, session=None):
+    return base_http_method("delete", url, session, cookies=cookies,
+        verify=False, params=params)
 
-def base_http_method(method, url, **kwargs):
-    with warnings.catch_warnings():
+def base_http_method(method_name, url, session=None, **kwargs):
+    # a session keeps a connection pool per marathon service, without one
+    # every request opens a new connection
+    method = getattr(requests if session is None else session, method_name)
+    with warnings.catch_warnings(), profiling.timings.stage("http"):
         warnings.simplefilter("ignore", exceptions.InsecureRequestWarning)
-        return method(url, **kwargs)
+        response = method(url, **kwargs)
+    profiling.timings.count("http calls")
+    profiling.timings.count("bytes received", len(response.content or b""))
+    return response
+
+def read_clusters_file(path):
+    """ reads clusters from an ini style file with a section per cluster
+
+        [prod]
+        baseurl = https://marathon.prod:8443
+        access_token = secret
+    """
+    try:
+        with open(path) as clusters_file:
+            # access tokens may contain '%' so values are read raw
+            parser = configparser.ConfigParser(interpolation=None)
+            parser.read_file(clusters_file)
+            return [(name, parser[name]["baseurl"], parser[name]["access_token"])
+                    for name in parser.sections()]
+    except (IOError, configparser.Error, KeyError) as e:
+        raise MarathonException("error parsing clusters file {}: {}".format(path, e))
+
+def get_clusters(baseurls, access_tokens, clusters_file=None):
+    """ returns a list of (name, baseurl, access_token) tuples """
+    clusters = []
+    if clusters_file is not None:
+        clusters.extend(read_clusters_file(clusters_file))
+    baseurls = baseurls or []
+    access_tokens = access_tokens or []
+    if len(baseurls) != len(access_tokens):
+        raise MarathonException("each --baseurl needs a matching --access-token")
+    for baseurl, access_token in zip(baseurls, access_tokens):
+        clusters.append((urllib.parse.urlparse(baseurl).netloc or baseurl, baseurl, access_token))
+    if not clusters:
+        raise MarathonException("no marathon services given")
+    names = [cluster[0] for cluster in clusters]
+    duplicates = sorted({name for name in names if names.count(name) > 1})
+    if duplicates:
+        raise MarathonException("cluster names must be unique, found duplicates: {}".format(", ".join(duplicates)))
+    return clusters
+
+def run_action(marathon, action, argument):
+    if action == "deploy":
+        # deploy_group rewrites application ids in place
+        marathon.deploy_group(copy.deepcopy(argument))
+    elif action == "plan":
+        for application_id, application_action in marathon.plan_group(copy.deepcopy(argument)):
+            marathon.logger.info("%s: %s", application_id, application_action)
+    elif action == "delete":
+        marathon.delete_group(argument)
+    else:
+        raise MarathonException("unknown action: {}".format(action))
+
+def start_status_cache(marathon, argument, make_listeners, interval):
+    """ starts a StatusCache for the applications of a deploy, with the listeners returned by
+        make_listeners(tracker, cluster name)
+    """
+    app_ids = [application['id'] for application in marathon._get_group_applications(copy.deepcopy(argument))]
+    cache = status.StatusCache(marathon, argument['id'], interval)
+    cache.listeners.extend(make_listeners(status.RolloutTracker(app_ids), marathon.name))
+    return cache.start()
+
+def run_on_clusters(clusters, action, argument, canary_first=False, status_listeners=None, status_interval=2.0,
+                    **marathon_args):
+    """ runs action against every cluster concurrently
+
+        Returns an ordered dict mapping cluster name to None on success or
+        the exception that made the cluster fail. With canary_first the
+        first cluster is handled alone and the rest are skipped if it fails.
+        status_listeners(tracker, cluster name) returns listeners for a
+        StatusCache polled every status_interval seconds during deploys.
+    """
+    results = collections.OrderedDict()
+
+    def run(cluster):
+        name, baseurl, access_token = cluster
+        marathon = Marathon(baseurl, access_token, name=name if len(clusters) > 1 else None, **marathon_args)
+        cache = None
+        try:
+            if action == "deploy" and status_listeners is not None:
+                cache = start_status_cache(marathon, argument, status_listeners, status_interval)
+            run_action(marathon, action, argument)
+            return None
+        except Exception as e:
+            marathon.logger.error(e, exc_info=True)
+            return e
+        finally:
+            if cache is not None:
+                cache.stop()
+
+    remaining = list(clusters)
+    if canary_first and len(remaining) > 1:
+        canary = remaining.pop(0)
+        results[canary[0]] = run(canary)
+        if results[canary[0]] is not None:
+            for cluster in remaining:
+                results[cluster[0]] = MarathonException("skipped since canary cluster {} failed".format(canary[0]))
+            return results
+    if remaining:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(remaining)) as executor:
+            for cluster, error in zip(remaining, executor.map(run, remaining)):
+                results[cluster[0]] = error
+    return results
 
 def parse_args():
     parser = argparse.ArgumentParser(description='Script for Mesos application orchestration using Marathon')
-    parser.add_argument('-b', '--baseurl', required=True, help='base URL of marathon service')
-    parser.add_argument('-a', '--access-token', required=True, help='cookie for authentication on marathon')
-    parser.add_argument("action", metavar="deploy|delete",
-        help="\"deploy\" takes a marathon json file to deploy and "
-            "\"delete\" takes a group name to delete as argument", nargs=2)
-    return parser.parse_args()
+    add_arguments(parser)
+    parser.add_argument("action", metavar="deploy|delete|plan",
+        help="\"deploy\" takes a marathon json file to deploy, "
+            "\"delete\" takes a group name to delete and \"plan\" takes a "
+            "marathon json file and shows what deploying it would do", nargs=2)
+    args = parser.parse_args()
+    check_args(parser, args)
+    return args
+
+
+def add_cluster_arguments(parser):
+    """ adds the options selecting marathon services """
+    parser.add_argument('-b', '--baseurl', action='append', help='base URL of marathon service. '
+        'can be given several times to deploy to several services concurrently')
+    parser.add_argument('-a', '--access-token', action='append', help='cookie for authentication on marathon. '
+        'give one for each --baseurl, in the same order')
+    parser.add_argument('--clusters-file', help='ini file with a section per marathon service containing '
+        'baseurl and access_token')
+
+
+def add_marathon_arguments(parser):
+    """ adds the options controlling how applications are deployed, see get_marathon_args """
+    parser.add_argument('--on-unchanged', choices=ON_UNCHANGED_POLICIES, default="restart",
+        help="what to do with applications whose config is unchanged: \"restart\" does a rolling restart, "
+            "\"skip\" leaves the application alone and \"verify\" only waits for the current version "
+            "to be healthy. defaults to restart")
+    parser.add_argument('--parallelism', type=int, default=8,
+        help="maximum number of concurrent requests against marathon. defaults to 8")
+    parser.add_argument('--scale-step', help="scale up in steps of this many instances, or a percentage of the "
+        "target like 25%%, waiting for each step to be healthy. by default apps are scaled in one go")
+    parser.add_argument('--scale-step-timeout', type=int, default=600, help="seconds to wait for a scale step "
+        "to be healthy before scaling back to the original number of instances. defaults to 600")
+    parser.add_argument('--strategy', choices=STRATEGIES, default="rolling", help="\"rolling\" upgrades "
+        "changed applications in place, \"blue-green\" deploys them next to the running application as "
+        "<id>-blue or <id>-green and scales the old one to zero once the new one is healthy. defaults to rolling")
+    parser.add_argument('--rollback', action='store_true', help="when deploying fails or times out, put every "
+        "application of the group that was touched back to its version from before the deploy, delete new ones "
+        "and wait for them to be healthy")
+    parser.add_argument('--deploy-timeout', type=float, help="seconds to wait for a deploy to become healthy "
+        "before failing it. defaults to waiting forever")
+    parser.add_argument('--lock', choices=locking.LOCK_KINDS, default="none", help="lock each application while "
+        "deploying it, so concurrent deployers of overlapping groups take turns per application. \"marathon\" "
+        "keeps leases as applications without instances below {}, \"file\" keeps lock files in --lock-dir for "
+        "deployers on the same host. defaults to none".format(locking.LOCK_GROUP))
+    parser.add_argument('--lock-dir', help="directory of the lock files of --lock file")
+    parser.add_argument('--lock-timeout', type=float, help="seconds to wait for the lock of an application "
+        "before failing. defaults to waiting forever")
+
+
+def get_marathon_args(args):
+    """ returns the Marathon keyword arguments given by the options of add_marathon_arguments """
+    return {"on_unchanged": args.on_unchanged, "parallelism": args.parallelism, "scale_step": args.scale_step,
+            "scale_step_timeout": args.scale_step_timeout, "strategy": args.strategy, "rollback": args.rollback,
+            "deploy_timeout": args.deploy_timeout, "lock": args.lock, "lock_dir": args.lock_dir,
+            "lock_timeout": args.lock_timeout}
+
+
+def add_arguments(parser):
+    """ adds all options except the action, shared with the mesos-tools command """
+    add_cluster_arguments(parser)
+    parser.add_argument('--canary-first', action='store_true', help='run against the first service before '
+        'the others and stop if it fails')
+    add_marathon_arguments(parser)
+    parser.add_argument('--bundle', help="read the application to deploy or plan from a bundle written by "
+        "marathon-config-producer --pack, taking an app id instead of a json file")
+    parser.add_argument('--bundle-hash', metavar='HASH', help="fail unless the bundle was packed with this tree "
+        "hash, as printed by --pack")
+    parser.add_argument('--dashboard', action='store_true', help="show healthy/target instances, deployment "
+        "progress and elapsed time per application on standard out while deploying, instead of info logging. "
+        "only for a single marathon service")
+    parser.add_argument('--status-json', metavar='FILE', help="write the same status as json lines to FILE, "
+        "- for standard out, while deploying")
+    parser.add_argument('--status-interval', type=float, default=2.0, help="seconds between status refreshes. "
+        "defaults to 2")
+    parser.add_argument('--validate', action='store_true', help="check all applications before deploying "
+        "anything and fail with all errors found")
+    profiling.add_arguments(parser)
+
+
+def check_marathon_args(parser, args):
+    """ checks the options of add_cluster_arguments and add_marathon_arguments """
+    if args.baseurl is None and args.clusters_file is None:
+        parser.error("the following arguments are required: -b/--baseurl or --clusters-file")
+    if args.lock == "file" and args.lock_dir is None:
+        parser.error("--lock file requires --lock-dir")
+
+
+def check_args(parser, args):
+    check_marathon_args(parser, args)
+    if args.dashboard and args.status_json == "-":
+        parser.error("--dashboard and --status-json - both write to standard out")
 
 
 def create_logger():
@@ -368,23 +1008,74 @@ def create_logger():
 
 def main():
     args = parse_args()
+    profiling.run(args, run_command, args)
+
+
+def load_applications(argument, bundle_path=None, bundle_hash=None):
+    """ reads applications from a json file, or the application with the app id or config name argument from a
+        bundle, optionally checking its tree hash
+    """
+    if bundle_path is None:
+        with open(argument) as json_file:
+            return json.load(json_file)
+    with bundle.Bundle(bundle_path, bundle_hash) as config_bundle:
+        application = config_bundle.get_config(argument)
+    if application is None:
+        raise MarathonException("couldn't find {} in bundle {}".format(argument, bundle_path))
+    return application
+
+
+def make_status_listeners(dashboard, status_stream):
+    def make_listeners(tracker, cluster):
+        listeners = []
+        if dashboard:
+            listeners.append(status.TerminalDashboard(sys.stdout, tracker, cluster))
+        if status_stream is not None:
+            listeners.append(status.JsonStatusStream(status_stream, tracker, cluster))
+        return listeners
+    return make_listeners
+
+
+def run_command(args):
     logger = create_logger()
+    status_stream = None
 
     try:
-        marathon = Marathon(args.baseurl, args.access_token)
-        if args.action[0] == "deploy":
-            with open(args.action[1]) as json_file:
-                json_data = json.load(json_file)
-                marathon.deploy_group(json_data)
-        elif args.action[0] == "delete":
-            marathon.delete_group(args.action[1])
-        else:
-            raise MarathonException("unknown action: {}".format(
-                args.action[0]))
+        clusters = get_clusters(args.baseurl, args.access_token, args.clusters_file)
+        if args.dashboard:
+            if len(clusters) > 1:
+                raise MarathonException("--dashboard only supports a single marathon service, "
+                                        "use --status-json for several")
+            # info lines would scroll the dashboard away
+            for handler in logger.handlers:
+                handler.setLevel(logging.WARNING)
+        if args.status_json is not None:
+            status_stream = sys.stdout if args.status_json == "-" else open(args.status_json, "w")
+        action, argument = args.action
+        if action in ("deploy", "plan"):
+            argument = load_applications(argument, args.bundle, args.bundle_hash)
+            if args.validate:
+                errors = validation.validate(argument)
+                if errors:
+                    raise MarathonException("{} validation error(s):\n{}".format(len(errors), "\n".join(errors)))
+        elif action != "delete":
+            raise MarathonException("unknown action: {}".format(action))
+        results = run_on_clusters(clusters, action, argument, args.canary_first,
+                                  status_listeners=make_status_listeners(args.dashboard, status_stream)
+                                  if args.dashboard or status_stream is not None else None,
+                                  status_interval=args.status_interval, **get_marathon_args(args))
     except Exception as e:
         logger.error(e, exc_info=True)
         sys.exit(1)
+    finally:
+        if status_stream is not None and status_stream is not sys.stdout:
+            status_stream.close()
 
+    if len(results) > 1:
+        for name, error in results.items():
+            logger.info("%s: %s", name, "ok" if error is None else "failed - {}".format(error))
+    if any(error is not None for error in results.values()):
+        sys.exit(1)
     sys.exit(os.EX_OK)
 
 
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+# Copyright Dansk Bibliotekscenter a/s. Licensed under GPLv3
+# See license text at https://opensource.dbc.dk/licenses/gpl-3.0
+
+import collections
+import contextlib
+import cProfile
+import io
+import json
+import pstats
+import sys
+import threading
+import time
+
+PROFILE_TOP = 25
+""" Number of functions shown in the --profile summary """
+
+class Timings(object):
+    """ Accumulates wall and cpu time per stage and named counters
+
+        Stages may nest, so the time of an inner stage is also part of the
+        outer stage. cpu time is that of the whole process.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self._lock:
+            self.stages = collections.OrderedDict()
+            self.counters = collections.OrderedDict()
+
+    @contextlib.contextmanager
+    def stage(self, name):
+        wall = time.perf_counter()
+        cpu = time.process_time()
+        try:
+            yield
+        finally:
+            wall = time.perf_counter() - wall
+            cpu = time.process_time() - cpu
+            with self._lock:
+                stage = self.stages.setdefault(name,
+                    {"calls": 0, "wall": 0.0, "cpu": 0.0})
+                stage["calls"] += 1
+                stage["wall"] += wall
+                stage["cpu"] += cpu
+
+    def count(self, name, value=1):
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def as_dict(self):
+        with self._lock:
+            return {"stages": collections.OrderedDict(
+                (name, dict(stage)) for name, stage in self.stages.items()),
+                "counters": collections.OrderedDict(self.counters)}
+
+    def write(self, path):
+        """ writes the timings as json to path, or to stderr if path is - """
+        output = "{}\n".format(json.dumps(self.as_dict(), indent=4))
+        if path == "-":
+            sys.stderr.write(output)
+        else:
+            with open(path, "w") as timings_file:
+                timings_file.write(output)
+
+timings = Timings()
+""" Timings of the running command, shared by all modules """
+
+def sleep(seconds):
+    """ time.sleep recorded as the "sleep" stage """
+    with timings.stage("sleep"):
+        time.sleep(seconds)
+
+def add_arguments(parser):
+    parser.add_argument("--profile", metavar="FILE", help="run under "
+        "cProfile, dump the stats to FILE and print the top {} functions "
+        "by cumulative time to standard error".format(PROFILE_TOP))
+    parser.add_argument("--trace-timings", metavar="FILE", help="write wall "
+        "and cpu time per stage and counters as json to FILE, - for "
+        "standard error")
+
+def run(args, function, *function_args):
+    """ runs function with the profiling requested by args """
+    profiler = cProfile.Profile() if args.profile else None
+    timings.reset()
+    try:
+        if profiler is not None:
+            profiler.enable()
+        return function(*function_args)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(args.profile)
+            summary = io.StringIO()
+            pstats.Stats(profiler, stream=summary).sort_stats(
+                "cumulative").print_stats(PROFILE_TOP)
+            sys.stderr.write(summary.getvalue())
+        if args.trace_timings:
+            timings.write(args.trace_timings)
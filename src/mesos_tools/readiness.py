@@ -0,0 +1,98 @@
+#!/usr/bin/env python3
+# Copyright Dansk Bibliotekscenter a/s. Licensed under GPLv3
+# See license text at https://opensource.dbc.dk/licenses/gpl-3.0
+
+import calendar
+import time
+
+DEFAULT_INTERVAL = 60
+""" Marathon's default intervalSeconds of a health check """
+DEFAULT_POLL = 1.0
+""" Seconds until the next check when nothing better is known """
+MIN_POLL = 0.5
+MAX_POLL = 10.0
+""" Bounds of the time between checks, so a wrong guess costs little """
+
+def parse_time(value):
+    """ parses a marathon timestamp like 2017-04-26T15:56:28.384Z into
+        seconds since the epoch, or None
+    """
+    if not value:
+        return None
+    seconds, _, fraction = value.rstrip("Z").partition(".")
+    try:
+        parsed = calendar.timegm(time.strptime(seconds, "%Y-%m-%dT%H:%M:%S"))
+    except ValueError:
+        return None
+    return parsed + float("0." + fraction) if fraction.isdigit() else parsed
+
+def is_healthy(task, health_checked=False):
+    """ whether no health check of task failed, and with health_checked
+        also that it has passed them
+    """
+    results = task.get("healthCheckResults") or []
+    if health_checked and not results:
+        return False
+    return all(result["alive"] for result in results)
+
+def is_target_task(task, app_id, version, scale_only=False):
+    """ whether task belongs to app_id and runs version or later, or any
+        version when only scaling
+    """
+    return task["appId"].startswith(app_id) and \
+        (scale_only or task["version"] >= version)
+
+def get_health_interval(app):
+    intervals = [check.get("intervalSeconds", DEFAULT_INTERVAL)
+        for check in app.get("healthChecks") or []]
+    return min(intervals) if intervals else None
+
+def get_next_change(task, interval):
+    """ predicts when the health of task can next change: one interval
+        after its last health check result, or after it started
+    """
+    checked = [parse_time(result.get(key)) for result in
+        task.get("healthCheckResults") or []
+        for key in ("lastSuccess", "lastFailure")]
+    checked = [value for value in checked if value is not None]
+    last = max(checked) if checked else \
+        parse_time(task.get("startedAt") or task.get("stagedAt"))
+    return None if last is None else last + interval
+
+def evaluate(app, version, instances, scale_only=False, now=None):
+    """ returns (ready, seconds to wait before checking again) for app
+
+        app is ready as soon as instances of its tasks on version are
+        running and healthy, however many old tasks are still around. When
+        only scaling every task counts, so a scale down is ready once the
+        tasks above instances are gone. The wait is the time until the
+        earliest task could become healthy, judged by the health check
+        interval, within MIN_POLL and MAX_POLL.
+    """
+    now = time.time() if now is None else now
+    interval = get_health_interval(app)
+    health_checked = interval is not None
+    ready = 0
+    pending = []
+    for task in app.get("tasks", []):
+        if not is_target_task(task, app["id"], version, scale_only):
+            continue
+        if task.get("state") == "TASK_RUNNING" and \
+                is_healthy(task, health_checked):
+            ready += 1
+        else:
+            pending.append(task)
+    if scale_only and ready + len(pending) > int(instances):
+        # surplus tasks of a scale down are still being killed
+        return False, DEFAULT_POLL
+    if ready >= int(instances):
+        return True, 0
+    changes = []
+    if health_checked:
+        changes = [get_next_change(task, interval) for task in pending
+            if task.get("state") == "TASK_RUNNING"]
+        changes = [change for change in changes if change is not None]
+    if not changes or len(changes) < len(pending):
+        # tasks still being launched or without a known check time
+        return False, DEFAULT_POLL
+    return False, min(max(min(changes) - now, MIN_POLL), MAX_POLL)
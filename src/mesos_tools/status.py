@@ -0,0 +1,237 @@
+#!/usr/bin/env python3
+# Copyright Dansk Bibliotekscenter a/s. Licensed under GPLv3
+# See license text at https://opensource.dbc.dk/licenses/gpl-3.0
+
+import json
+import logging
+import threading
+import time
+import warnings
+
+REFRESH_EVENTS = ("api_post_event", "deployment_info", "deployment_success",
+    "deployment_failed", "deployment_step_success",
+    "deployment_step_failure", "status_update_event",
+    "health_status_changed_event")
+""" Marathon events that make StatusCache.follow_events refresh """
+
+class StatusCache(object):
+    """ Snapshot of the applications below a group and the deployments
+        affecting them, refreshed by a single background poller
+
+        Each refresh costs two requests however many applications there are:
+        one list of the group's apps with task counts and one list of
+        deployments. Listeners are called with the new snapshot after each
+        refresh. marathon must not read its deployments from this cache.
+    """
+
+    def __init__(self, marathon, group_id, interval=2.0):
+        self.marathon = marathon
+        self.group_id = group_id
+        self.interval = interval
+        self.listeners = []
+        self._snapshot = None
+        self._updated = threading.Condition()
+        self._stopped = threading.Event()
+        self._wakeup = threading.Event()
+        self._thread = None
+        self.logger = marathon.logger
+
+    def snapshot(self):
+        with self._updated:
+            return self._snapshot
+
+    def wait_for_snapshot(self, after, timeout=None):
+        """ returns the first snapshot begun at or after the time after,
+            waking the poller up, or None after timeout seconds
+        """
+        self.refresh_soon()
+        with self._updated:
+            if not self._updated.wait_for(lambda: self._snapshot is not None
+                    and self._snapshot["time"] >= after, timeout):
+                return None
+            return self._snapshot
+
+    def refresh_soon(self):
+        """ makes the poller refresh now instead of after its interval """
+        self._wakeup.set()
+
+    def refresh(self):
+        # the start time, so a snapshot never hides anything begun before it
+        started = time.time()
+        apps = self.marathon._list_applications(self.group_id,
+            embed="apps.counts")
+        deployments = self.marathon._get_deployments()
+        snapshot = {
+            "time": started,
+            "apps": {app["id"]: app for app in apps},
+            "deployments": deployments,
+        }
+        with self._updated:
+            self._snapshot = snapshot
+            self._updated.notify_all()
+        for listener in self.listeners:
+            listener(snapshot)
+        return snapshot
+
+    def _run(self):
+        while not self._stopped.is_set():
+            self._wakeup.clear()
+            try:
+                self.refresh()
+            except Exception as e:
+                # the status view must never break the deployment it shows
+                self.logger.debug("status refresh failed: %s", e)
+            self._wakeup.wait(self.interval)
+
+    def follow_events(self, retry_interval=5):
+        """ refreshes whenever marathon's event stream reports a change of
+            applications or deployments, until stopped
+
+            Meant to run in a thread of its own next to the poller, which
+            then only has to catch what the stream misses.
+        """
+        marathon = self.marathon
+        url = "/".join([marathon.baseurl, "v2", "events"])
+        while not self._stopped.is_set():
+            try:
+                with warnings.catch_warnings():
+                    warnings.simplefilter("ignore")
+                    response = marathon.session.get(url,
+                        cookies=marathon.cookies, stream=True, verify=False,
+                        headers={"Accept": "text/event-stream"},
+                        timeout=(10, None))
+                try:
+                    if response.status_code != 200:
+                        raise Exception("{} error while following events "
+                            "- {}".format(response.status_code,
+                            response.text))
+                    for line in response.iter_lines(decode_unicode=True):
+                        if self._stopped.is_set():
+                            break
+                        if line.startswith("event:") and \
+                                line[6:].strip() in REFRESH_EVENTS:
+                            self.refresh_soon()
+                finally:
+                    response.close()
+            except Exception as e:
+                self.logger.debug("event stream failed: %s", e)
+            self._stopped.wait(retry_interval)
+
+    def start(self):
+        self._stopped.clear()
+        self._wakeup.clear()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stopped.set()
+        self._wakeup.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+        try:
+            self.refresh()
+        except Exception as e:
+            self.logger.debug("status refresh failed: %s", e)
+
+class RolloutTracker(object):
+    """ Turns snapshots into per-application rollout rows """
+
+    def __init__(self, app_ids=None):
+        self.app_ids = app_ids
+        self.started = time.time()
+        self._deploying_since = {}
+        self._finished_after = {}
+
+    def rows(self, snapshot):
+        deployments_by_app = {}
+        for deployment in snapshot["deployments"]:
+            for app_id in deployment.get("affectedApps", []):
+                deployments_by_app[app_id] = deployment
+        app_ids = self.app_ids if self.app_ids is not None else \
+            sorted(snapshot["apps"])
+        rows = []
+        for app_id in app_ids:
+            app = snapshot["apps"].get(app_id, {})
+            deployment = deployments_by_app.get(app_id)
+            if deployment is not None:
+                self._deploying_since.setdefault(app_id, snapshot["time"])
+                self._finished_after.pop(app_id, None)
+                progress = "step {}/{}".format(
+                    deployment.get("currentStep", 0),
+                    deployment.get("totalSteps", 0))
+            elif app_id in self._deploying_since:
+                self._finished_after.setdefault(app_id, snapshot["time"]
+                    - self._deploying_since[app_id])
+                progress = "done"
+            else:
+                progress = "waiting" if not app else "-"
+            if app_id in self._finished_after:
+                elapsed = self._finished_after[app_id]
+            elif app_id in self._deploying_since:
+                elapsed = snapshot["time"] - self._deploying_since[app_id]
+            else:
+                elapsed = 0.0
+            rows.append({
+                "id": app_id,
+                "healthy": app.get("tasksHealthy", 0),
+                "running": app.get("tasksRunning", 0),
+                "staged": app.get("tasksStaged", 0),
+                "target": app.get("instances", 0),
+                "version": app.get("version"),
+                "progress": progress,
+                "elapsed": round(elapsed, 1),
+            })
+        return rows
+
+class TerminalDashboard(object):
+    """ Redraws a table of rollout rows in place on a terminal, or appends
+        it when the stream is not a terminal
+    """
+
+    def __init__(self, stream, tracker, title=None):
+        self.stream = stream
+        self.tracker = tracker
+        self.title = title
+        self._lines = 0
+
+    def __call__(self, snapshot):
+        rows = self.tracker.rows(snapshot)
+        width = max([len(row["id"]) for row in rows] + [11])
+        lines = []
+        if self.title is not None:
+            lines.append(self.title)
+        lines.append("{:<{}}  {:>15}  {:>7}  {:>6}  {:<12}  {:>8}".format(
+            "application", width, "healthy/target", "running", "staged",
+            "progress", "elapsed"))
+        for row in rows:
+            lines.append("{:<{}}  {:>15}  {:>7}  {:>6}  {:<12}  {:>7.1f}s"
+                .format(row["id"], width, "{}/{}".format(row["healthy"],
+                row["target"]), row["running"], row["staged"],
+                row["progress"], row["elapsed"]))
+        output = "\n".join(lines) + "\n"
+        if self.stream.isatty() and self._lines:
+            # move to the start of the previous table and clear it
+            output = "\x1b[{}F\x1b[J".format(self._lines) + output
+        self._lines = len(lines)
+        self.stream.write(output)
+        self.stream.flush()
+
+class JsonStatusStream(object):
+    """ Writes one json document per snapshot and line, for CI """
+
+    def __init__(self, stream, tracker, cluster=None):
+        self.stream = stream
+        self.tracker = tracker
+        self.cluster = cluster
+        self._lock = threading.Lock()
+
+    def __call__(self, snapshot):
+        status = {"time": snapshot["time"], "apps":
+            self.tracker.rows(snapshot)}
+        if self.cluster is not None:
+            status["cluster"] = self.cluster
+        with self._lock:
+            self.stream.write(json.dumps(status, sort_keys=True) + "\n")
+            self.stream.flush()
@@ -0,0 +1,162 @@
+#!/usr/bin/env python3
+# Copyright Dansk Bibliotekscenter a/s. Licensed under GPLv3
+# See license text at https://opensource.dbc.dk/licenses/gpl-3.0
+
+import difflib
+import numbers
+import posixpath
+
+NUMBER = (numbers.Real,)
+STRING = (str,)
+
+APP_FIELDS = {
+    "acceptedResourceRoles": list, "args": list, "backoffFactor": NUMBER,
+    "backoffSeconds": NUMBER, "cmd": STRING, "constraints": list,
+    "container": dict, "cpus": NUMBER, "dependencies": list, "disk": NUMBER,
+    "env": dict, "executor": STRING, "extends": STRING, "fetch": list,
+    "gpus": NUMBER, "healthChecks": list, "id": STRING, "instances": int,
+    "ipAddress": dict, "killSelection": STRING, "labels": dict,
+    "maxLaunchDelaySeconds": NUMBER, "mem": NUMBER, "networks": list,
+    "portDefinitions": list, "ports": list, "readinessChecks": list,
+    "requirePorts": bool, "residency": dict, "secrets": dict,
+    "storeUrls": list, "taskKillGracePeriodSeconds": NUMBER,
+    "unreachableStrategy": (dict, str), "upgradeStrategy": dict,
+    "uris": list, "user": STRING,
+}
+""" Marathon application fields and their json types. "extends" is left
+    in place by the producer for templates without "changes" """
+
+REQUIRED_FIELDS = ("id", "instances")
+PORT_PROTOCOLS = ("tcp", "udp", "udp,tcp", "tcp,udp")
+
+def _compile_type_check(expected):
+    types = expected if isinstance(expected, tuple) else (expected,)
+    names = "/".join(sorted(t.__name__ for t in types))
+
+    def check(value):
+        # bool is an int in python but not a number in json
+        if isinstance(value, bool) and bool not in types:
+            return "expected {}, got bool".format(names)
+        if not isinstance(value, types):
+            return "expected {}, got {}".format(names, type(value).__name__)
+        return None
+    return check
+
+_FIELD_CHECKS = {field: _compile_type_check(expected)
+    for field, expected in APP_FIELDS.items()}
+
+def get_apps(config_json):
+    """ returns all applications of a group, walking nested groups, or the
+        config itself if it is a single application
+    """
+    if "apps" not in config_json and "groups" not in config_json:
+        return [config_json]
+    apps = []
+    stack = [config_json]
+    while stack:
+        group = stack.pop()
+        apps.extend(group.get("apps", []))
+        stack.extend(group.get("groups", [])[::-1])
+    return apps
+
+def validate_app(app, app_ids=None):
+    """ returns a list of errors in a single application
+
+        app_ids is the set of application ids in the same group, used to
+        check that dependencies resolve. dependencies are not checked when
+        it is None.
+    """
+    app_id = app.get("id", "<no id>") if isinstance(app, dict) else "<no id>"
+    if not isinstance(app, dict):
+        return ["{}: expected an object".format(app_id)]
+    errors = []
+    for field in REQUIRED_FIELDS:
+        if field not in app:
+            errors.append("missing \"{}\"".format(field))
+    for field, value in sorted(app.items()):
+        check = _FIELD_CHECKS.get(field)
+        if check is None:
+            error = "unknown key \"{}\"".format(field)
+            close = difflib.get_close_matches(field, APP_FIELDS, 1)
+            if close:
+                error += ", did you mean \"{}\"".format(close[0])
+            errors.append(error)
+            continue
+        # marathon itself writes null for unset optional fields
+        if value is None and field not in REQUIRED_FIELDS:
+            continue
+        error = check(value)
+        if error is not None:
+            errors.append("\"{}\": {}".format(field, error))
+    if isinstance(app.get("instances"), int) and app["instances"] < 0:
+        errors.append("\"instances\" must not be negative")
+    for field in ("cpus", "mem", "disk"):
+        if isinstance(app.get(field), NUMBER) and app[field] < 0:
+            errors.append("\"{}\" must not be negative".format(field))
+    errors.extend(_validate_ports(app))
+    if app_ids is not None and isinstance(app.get("dependencies"), list):
+        errors.extend(_validate_dependencies(app, app_ids))
+    return ["{}: {}".format(app_id, error) for error in errors]
+
+def _validate_port(value):
+    if isinstance(value, bool) or not isinstance(value, int) or \
+            not 0 <= value <= 65535:
+        return "invalid port {}".format(value)
+    return None
+
+def _validate_ports(app):
+    errors = []
+    ports = []
+    if isinstance(app.get("ports"), list):
+        for port in app["ports"]:
+            error = _validate_port(port)
+            if error is not None:
+                errors.append("\"ports\": " + error)
+    if isinstance(app.get("portDefinitions"), list):
+        for i, definition in enumerate(app["portDefinitions"]):
+            where = "\"portDefinitions\"[{}]".format(i)
+            if not isinstance(definition, dict):
+                errors.append("{}: expected an object".format(where))
+                continue
+            if "port" not in definition:
+                errors.append("{}: missing \"port\"".format(where))
+            else:
+                error = _validate_port(definition["port"])
+                if error is not None:
+                    errors.append("{}: {}".format(where, error))
+                elif definition["port"] != 0:
+                    ports.append(definition["port"])
+            if definition.get("protocol", "tcp") not in PORT_PROTOCOLS:
+                errors.append("{}: invalid protocol {}".format(where,
+                    definition["protocol"]))
+    duplicates = sorted({port for port in ports if ports.count(port) > 1})
+    if duplicates:
+        errors.append("\"portDefinitions\": duplicate port(s) {}".format(
+            ", ".join(str(port) for port in duplicates)))
+    return errors
+
+def _validate_dependencies(app, app_ids):
+    errors = []
+    base = posixpath.dirname(app.get("id", ""))
+    for dependency in app["dependencies"]:
+        if not isinstance(dependency, str):
+            errors.append("invalid dependency {}".format(dependency))
+            continue
+        resolved = posixpath.normpath(posixpath.join(base, dependency))
+        if dependency not in app_ids and resolved not in app_ids:
+            errors.append("dependency \"{}\" is not in the group".format(
+                dependency))
+    return errors
+
+def validate(config_json):
+    """ returns all errors in a single application or a group of them """
+    apps = get_apps(config_json)
+    app_ids = {app["id"] for app in apps
+        if isinstance(app, dict) and isinstance(app.get("id"), str)}
+    errors = []
+    for app in apps:
+        errors.extend(validate_app(app, app_ids))
+    if len(app_ids) != len([app for app in apps if isinstance(app, dict)
+            and isinstance(app.get("id"), str)]):
+        errors.append("duplicate application ids in group")
+    return errors
@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+# Copyright Dansk Bibliotekscenter a/s. Licensed under GPLv3
+# See license text at https://opensource.dbc.dk/licenses/gpl-3.0
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from mesos_tools import bundle
+from mesos_tools import marathon_config_producer
+
+class TestBundle(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        self.write("base.template", {"cpus": 1, "env": {"A": "${a}"}})
+        for name in ["a", "b", "c"]:
+            self.write("apps/{}.instance".format(name), {"extends": "base",
+                "changes": {"id": "/grp/" + name}})
+        self.index = marathon_config_producer.ConfigIndex(self.root)
+        self.path = os.path.join(self.root, "configs.bundle")
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, name, data):
+        path = os.path.join(self.root, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(data, f)
+
+    def test_pack_and_lookup(self):
+        digest = bundle.pack(self.index, self.path,
+            marathon_config_producer.TemplateKeys({"a": "1"}))
+        with bundle.Bundle(self.path) as config_bundle:
+            self.assertEqual(digest, config_bundle.tree_hash)
+            self.assertEqual(["/grp/a", "/grp/b", "/grp/c"],
+                config_bundle.app_ids())
+            self.assertEqual({"id": "/grp/b", "cpus": 1, "env": {"A": "1"}},
+                config_bundle.get("/grp/b"))
+            self.assertEqual({"cpus": 1, "env": {"A": "1"}},
+                config_bundle.get_config("base"))
+            self.assertIsNone(config_bundle.get("/grp/d"))
+
+    def test_pack_fills_values_literally(self):
+        value = 'say "hi" in C:\\tmp'
+        digest = bundle.pack(self.index, self.path,
+            marathon_config_producer.TemplateKeys({"a": value}))
+        with bundle.Bundle(self.path) as config_bundle:
+            self.assertEqual({"A": value}, config_bundle.get("/grp/a")["env"])
+        self.assertEqual(bundle.tree_hash(self.index, {"a": value}).hex(),
+            digest)
+
+    def test_tree_hash_changes_with_content(self):
+        digest = bundle.tree_hash(self.index)
+        self.assertEqual(digest, bundle.tree_hash(self.index))
+        self.write("apps/a.instance", {"extends": "base",
+            "changes": {"id": "/grp/z"}})
+        self.assertNotEqual(digest, bundle.tree_hash(self.index))
+        self.assertNotEqual(digest, bundle.tree_hash(self.index, {"a": "1"}))
+
+    def test_not_a_bundle(self):
+        with self.assertRaises(bundle.BundleException):
+            bundle.Bundle(os.path.join(self.root, "base.template"))
+        with self.assertRaises(bundle.BundleException):
+            bundle.Bundle(os.path.join(self.root, "missing"))
+
+    def test_pack_is_world_readable(self):
+        bundle.pack(self.index, self.path)
+        self.assertEqual(bundle.BUNDLE_MODE, os.stat(self.path).st_mode & 0o777)
+
+    def test_pack_duplicate_app_ids(self):
+        self.write("apps/d.instance", {"extends": "base",
+            "changes": {"id": "/grp/a"}})
+        index = marathon_config_producer.ConfigIndex(self.root)
+        with self.assertRaisesRegex(bundle.BundleException, "/grp/a"):
+            bundle.pack(index, self.path)
+        self.assertFalse(os.path.exists(self.path))
+
+    def test_expected_hash(self):
+        digest = bundle.pack(self.index, self.path)
+        bundle.Bundle(self.path, digest).close()
+        with self.assertRaisesRegex(bundle.BundleException, "expected 00"):
+            bundle.Bundle(self.path, "00")
+
+    def test_truncated_bundle(self):
+        bundle.pack(self.index, self.path)
+        with open(self.path, "r+b") as f:
+            f.truncate(os.path.getsize(self.path) - 1)
+        with self.assertRaisesRegex(bundle.BundleException, "truncated"):
+            bundle.Bundle(self.path)
+
+    def test_corrupt_entry(self):
+        bundle.pack(self.index, self.path)
+        with bundle.Bundle(self.path) as config_bundle:
+            _, _, data_offset, _ = config_bundle._record(0)
+        with open(self.path, "r+b") as f:
+            f.seek(data_offset)
+            f.write(b"garbage")
+        with bundle.Bundle(self.path) as config_bundle:
+            with self.assertRaisesRegex(bundle.BundleException, "corrupt"):
+                config_bundle.get("/grp/a")
@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+# Copyright Dansk Bibliotekscenter a/s. Licensed under GPLv3
+# See license text at https://opensource.dbc.dk/licenses/gpl-3.0
+
+import os
+import subprocess
+import sys
+import time
+import unittest
+
+from mesos_tools import cli
+from mesos_tools import marathon_config_producer
+from mesos_tools import marathon_deployer
+
+STARTUP_BUDGET = 0.5
+""" Maximum seconds for `mesos-tools --help`, best of STARTUP_RUNS """
+STARTUP_RUNS = 5
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), "src")
+
+def run_python(*args):
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join([SRC_DIR] + [p for p in
+        env.get("PYTHONPATH", "").split(os.pathsep) if p])
+    return subprocess.run([sys.executable] + list(args), env=env,
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+        universal_newlines=True)
+
+class TestCli(unittest.TestCase):
+    def test_produce_args(self):
+        args = cli.setup_args(["produce", "--mode", "group", "grp"])
+        self.assertEqual("group", args.mode)
+        self.assertEqual("grp", args.input)
+        self.assertIs(marathon_config_producer.run_command, args.run_command)
+
+    def test_deployer_args(self):
+        for action in ["deploy", "delete", "plan"]:
+            args = cli.setup_args([action, "-b", "http://marathon", "-a",
+                "token", "grp"])
+            self.assertEqual([action, "grp"], args.action)
+            self.assertIs(marathon_deployer.run_command, args.run_command)
+
+    def test_help_does_not_import_requests(self):
+        result = run_python("-c", "import sys\n"
+            "from mesos_tools import cli\n"
+            "try:\n"
+            "    cli.setup_args(['deploy', '--help'])\n"
+            "except SystemExit:\n"
+            "    pass\n"
+            "print('requests' in sys.modules)")
+        self.assertEqual("False", result.stdout.strip().splitlines()[-1])
+
+    def test_startup_time(self):
+        durations = []
+        for _ in range(STARTUP_RUNS):
+            start = time.perf_counter()
+            result = run_python("-m", "mesos_tools.cli", "--help")
+            durations.append(time.perf_counter() - start)
+            self.assertEqual(0, result.returncode, result.stderr)
+        self.assertLess(min(durations), STARTUP_BUDGET)
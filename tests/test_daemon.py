@@ -0,0 +1,165 @@
+#!/usr/bin/env python3
+# Copyright Dansk Bibliotekscenter a/s. Licensed under GPLv3
+# See license text at https://opensource.dbc.dk/licenses/gpl-3.0
+
+import http.client
+import io
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from mesos_tools import daemon
+from mesos_tools import status
+from mesos_tools.marathon_deployer import Marathon, MarathonException
+
+CLUSTERS = [("dc1", "http://marathon-1", "token"), ("dc2", "http://marathon-2", "token")]
+
+class TestAppLocks(unittest.TestCase):
+    def test_overlapping_apps_wait(self):
+        locks = daemon.AppLocks()
+        acquired = threading.Event()
+
+        def hold_a():
+            with locks.hold(["/a"]):
+                acquired.set()
+
+        with locks.hold(["/b", "/a"]):
+            thread = threading.Thread(target=hold_a, daemon=True)
+            thread.start()
+            self.assertFalse(acquired.wait(0.1))
+            with locks.hold(["/c"]):
+                pass
+        self.assertTrue(acquired.wait(5))
+        thread.join(5)
+        self.assertEqual({}, locks._locks)
+
+    def test_cluster_locks_are_per_cluster(self):
+        locks = daemon.AppLocks()
+        configured = mock.MagicMock()
+        dc1 = daemon.ClusterLocks(locks, "dc1", configured)
+        dc2 = daemon.ClusterLocks(locks, "dc2")
+        with dc1.hold("/a"):
+            # the same application on another service is not held up
+            with dc2.hold("/a"):
+                pass
+        configured.hold.assert_called_once_with("/a")
+
+class TestDaemon(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.address = os.path.join(self.tmpdir, "daemon.sock")
+        self.daemon = daemon.Daemon(CLUSTERS, follow_events=False)
+        self.server = daemon.make_server(self.daemon, self.address)
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.daemon.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_plan_job(self):
+        stream = io.StringIO()
+        with mock.patch.object(Marathon, "plan_group", return_value=[("/grp/a", "create")]):
+            job = daemon.submit(self.address, "plan", {"id": "/grp", "apps": [{"id": "a"}]}, ["dc2"], stream)
+        self.assertEqual("succeeded", job["state"])
+        self.assertEqual({"dc2": None}, job["results"])
+        self.assertIn("Marathon.job-1.dc2 - INFO - /grp/a: create", stream.getvalue())
+
+    def test_failed_deploy_job(self):
+        with mock.patch.object(Marathon, "deploy_group", side_effect=MarathonException("boom")):
+            job = daemon.submit(self.address, "deploy", {"id": "/grp", "apps": [{"id": "a"}]})
+        self.assertEqual("failed", job["state"])
+        self.assertEqual(["dc1", "dc2"], list(job["results"]))
+        self.assertEqual("boom", job["results"]["dc1"])
+        connection = daemon.connect(self.address)
+        connection.request("GET", "/jobs/{}".format(job["id"]))
+        response = connection.getresponse()
+        self.assertEqual(200, response.status)
+        self.assertEqual("failed", json.loads(response.read().decode("utf-8"))["state"])
+        connection.close()
+
+    def test_bad_jobs_are_rejected(self):
+        with self.assertRaisesRegex(MarathonException, "400 error.*unknown action"):
+            daemon.submit(self.address, "restart", "/grp")
+        with self.assertRaisesRegex(MarathonException, "400 error.*unknown cluster"):
+            daemon.submit(self.address, "delete", "/grp", ["dc3"])
+
+    def test_finished_jobs_are_pruned(self):
+        self.daemon.keep_jobs = 1
+        with mock.patch.object(Marathon, "plan_group", return_value=[]):
+            first = daemon.submit(self.address, "plan", {"id": "/grp"})
+            second = daemon.submit(self.address, "plan", {"id": "/grp"})
+            third = daemon.submit(self.address, "plan", {"id": "/grp"})
+        self.assertEqual(["job-1", "job-2", "job-3"], [first["id"], second["id"], third["id"]])
+        self.assertIsNone(self.daemon.get_job("job-1"))
+        self.assertEqual(["job-2", "job-3"], [job.id for job in self.daemon.get_jobs()])
+
+    def test_deploys_lock_each_app_on_its_cluster(self):
+        held = []
+
+        def deploy(marathon, application):
+            with marathon.locks.hold(application["id"]):
+                held.append(sorted(self.daemon.locks._locks))
+
+        with mock.patch.object(Marathon, "deploy", autospec=True, side_effect=deploy):
+            job = daemon.submit(self.address, "deploy", {"id": "/grp", "apps": [{"id": "a"}, {"id": "b"}]},
+                                ["dc1"])
+        self.assertEqual("succeeded", job["state"])
+        self.assertEqual([[("dc1", "/grp/a")], [("dc1", "/grp/b")]], held)
+        self.assertEqual({}, self.daemon.locks._locks)
+
+    def test_existing_file_is_not_replaced(self):
+        path = os.path.join(self.tmpdir, "file")
+        with open(path, "w") as f:
+            f.write("keep")
+        with self.assertRaisesRegex(MarathonException, "not a socket"):
+            daemon.make_server(self.daemon, path)
+        with self.assertRaisesRegex(MarathonException, "already listening"):
+            daemon.make_server(self.daemon, self.address)
+
+    def test_stale_socket_is_replaced(self):
+        path = os.path.join(self.tmpdir, "stale.sock")
+        server = daemon.make_server(self.daemon, path)
+        # closing the server leaves the socket file behind
+        server.server_close()
+        server = daemon.make_server(self.daemon, path)
+        server.server_close()
+
+    def test_remote_address_is_refused(self):
+        with self.assertRaisesRegex(MarathonException, "loopback"):
+            daemon.make_server(self.daemon, "0.0.0.0:0")
+
+    def test_tcp_address(self):
+        server = daemon.make_server(self.daemon, "127.0.0.1:0")
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            connection = daemon.connect("127.0.0.1:{}".format(server.server_address[1]))
+            connection.request("GET", "/status")
+            response = connection.getresponse()
+            self.assertEqual({"dc1": None, "dc2": None}, json.loads(response.read().decode("utf-8")))
+            connection.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+class TestSharedStatusCache(unittest.TestCase):
+    def test_marathon_reads_deployments_from_cache(self):
+        deployments = [{"id": "d1", "affectedApps": ["/grp/a"]}]
+        poller = mock.Mock()
+        poller._list_applications.return_value = []
+        poller._get_deployments.return_value = deployments
+        cache = status.StatusCache(poller, "/", interval=60).start()
+        try:
+            marathon = Marathon("http://marathon", "token", status_cache=cache)
+            with mock.patch("mesos_tools.marathon_deployer.http_get") as http_get:
+                self.assertEqual(deployments, marathon._get_deployments())
+            http_get.assert_not_called()
+            self.assertEqual(deployments, cache.wait_for_snapshot(time.time(), 5)["deployments"])
+        finally:
+            cache.stop()
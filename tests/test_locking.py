@@ -0,0 +1,161 @@
+#!/usr/bin/env python3
+# Copyright Dansk Bibliotekscenter a/s. Licensed under GPLv3
+# See license text at https://opensource.dbc.dk/licenses/gpl-3.0
+
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from unittest import mock
+
+from mesos_tools import locking
+from mesos_tools.marathon_deployer import Marathon, MarathonException
+
+class TestFileLocks(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.locks = locking.FileLocks(self.tmpdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @mock.patch.object(locking, "RETRY_INTERVAL", 0.01)
+    def test_same_app_waits(self):
+        acquired = threading.Event()
+
+        def hold():
+            with self.locks.hold("/grp/a"):
+                acquired.set()
+
+        with self.locks.hold("/grp/a"):
+            threading.Thread(target=hold, daemon=True).start()
+            self.assertFalse(acquired.wait(0.1))
+            # other applications are not held up
+            with self.locks.hold("/grp/b"):
+                pass
+        self.assertTrue(acquired.wait(5))
+        self.assertEqual({"%2Fgrp%2Fa.lock", "%2Fgrp%2Fb.lock"}, set(os.listdir(self.tmpdir)))
+
+    @mock.patch.object(locking, "RETRY_INTERVAL", 0.01)
+    def test_timeout(self):
+        locks = locking.FileLocks(self.tmpdir, timeout=0.05)
+        with self.locks.hold("/grp/a"):
+            with self.assertRaisesRegex(locking.LockException, "timed out.*/grp/a"):
+                with locks.hold("/grp/a"):
+                    pass
+
+class FakeLeases(object):
+    """ The lease applications of a marathon service """
+
+    def __init__(self, *leases):
+        self.apps = {lease["id"]: lease for lease in leases}
+        self.on_create = None
+
+    def lease(self, owner, expires_in, lease_id="/mesos-tools-locks/grp/a"):
+        return {"id": lease_id, "labels": {locking.OWNER_LABEL: owner,
+                locking.EXPIRES_LABEL: str(int(time.time() + expires_in))}}
+
+    def install(self, marathon):
+        marathon._post_lease = mock.Mock(side_effect=self.post)
+        marathon._get_application = mock.Mock(side_effect=lambda app_id: {"app": self.apps[app_id]}
+                                              if app_id in self.apps else None)
+        marathon._delete_application = mock.Mock(side_effect=lambda app_id: self.apps.pop(app_id))
+        marathon._put_application_fields = mock.Mock(side_effect=lambda app_id, fields, force=False:
+                                                     self.apps[app_id].update(fields))
+        return marathon
+
+    def post(self, lease):
+        if lease["id"] in self.apps:
+            return False
+        self.apps[lease["id"]] = lease
+        if self.on_create is not None:
+            self.on_create(lease)
+        return True
+
+    def owner(self, lease_id="/mesos-tools-locks/grp/a"):
+        return self.apps[lease_id]["labels"][locking.OWNER_LABEL] if lease_id in self.apps else None
+
+@mock.patch.object(locking, "SETTLE_TIME", 0)
+@mock.patch.object(locking, "RETRY_INTERVAL", 0.01)
+class TestMarathonLocks(unittest.TestCase):
+    def make_marathon(self, leases, timeout=None):
+        marathon = Marathon("http://marathon", "token", lock="marathon", lock_timeout=timeout)
+        marathon._deploy = mock.Mock()
+        return leases.install(marathon)
+
+    def test_deploy_waits_for_lease(self):
+        leases = FakeLeases()
+        leases.apps["/mesos-tools-locks/grp/a"] = leases.lease("other", 60)
+        marathon = self.make_marathon(leases)
+        threading.Timer(0.05, leases.apps.clear).start()
+        owners = []
+        marathon._deploy.side_effect = lambda application: owners.append(leases.owner())
+        marathon.deploy({"id": "/grp/a"})
+        lease = marathon._post_lease.call_args[0][0]
+        self.assertEqual(0, lease["instances"])
+        self.assertTrue(owners[0].startswith(locking.get_owner()))
+        marathon._deploy.assert_called_once_with({"id": "/grp/a"})
+        self.assertEqual({}, leases.apps)
+
+    def test_expired_lease_is_taken_over(self):
+        leases = FakeLeases()
+        leases.apps["/mesos-tools-locks/grp/a"] = leases.lease("crashed", -1)
+        marathon = self.make_marathon(leases)
+        marathon.deploy({"id": "/grp/a"})
+        self.assertEqual(2, marathon._delete_application.call_count)
+        marathon._deploy.assert_called_once_with({"id": "/grp/a"})
+        self.assertEqual({}, leases.apps)
+
+    def test_lost_takeover_race_waits(self):
+        leases = FakeLeases()
+        leases.apps["/mesos-tools-locks/grp/a"] = leases.lease("crashed", -1)
+        marathon = self.make_marathon(leases, timeout=0.1)
+
+        def racer_replaces(lease):
+            # another deployer deletes the lease just created, thinking it is the expired one
+            leases.on_create = None
+            leases.apps[lease["id"]] = leases.lease("racer", 60)
+
+        leases.on_create = racer_replaces
+        with self.assertRaisesRegex(locking.LockException, "held by racer"):
+            marathon.deploy({"id": "/grp/a"})
+        marathon._deploy.assert_not_called()
+        self.assertEqual("racer", leases.owner())
+
+    def test_lease_taken_over_is_not_released(self):
+        leases = FakeLeases()
+        marathon = self.make_marathon(leases)
+        marathon._deploy.side_effect = lambda application: leases.apps.update(
+            {"/mesos-tools-locks/grp/a": leases.lease("other", 60)})
+        marathon.deploy({"id": "/grp/a"})
+        marathon._delete_application.assert_not_called()
+        self.assertEqual("other", leases.owner())
+
+    def test_lease_is_renewed(self):
+        leases = FakeLeases()
+        marathon = leases.install(mock.Mock())
+        locks = locking.MarathonLocks(marathon, ttl=0.06)
+        with locks.hold("/grp/a"):
+            owner = leases.owner()
+            time.sleep(0.1)
+        self.assertTrue(marathon._put_application_fields.called)
+        lease_id, fields = marathon._put_application_fields.call_args[0]
+        self.assertEqual("/mesos-tools-locks/grp/a", lease_id)
+        self.assertEqual(owner, fields["labels"][locking.OWNER_LABEL])
+        self.assertEqual({}, leases.apps)
+
+    def test_lease_is_released_when_deploy_fails(self):
+        leases = FakeLeases()
+        marathon = self.make_marathon(leases)
+        marathon._deploy.side_effect = MarathonException("failed")
+        with self.assertRaises(MarathonException):
+            marathon.deploy({"id": "/grp/a"})
+        marathon._delete_application.assert_called_once_with("/mesos-tools-locks/grp/a")
+
+    def test_unknown_lock(self):
+        with self.assertRaises(MarathonException):
+            Marathon("http://marathon", "token", lock="zookeeper")
+        with self.assertRaises(MarathonException):
+            Marathon("http://marathon", "token", lock="file")
@@ -2,7 +2,14 @@
 # Copyright Dansk Bibliotekscenter a/s. Licensed under GPLv3
 # See license text at https://opensource.dbc.dk/licenses/gpl-3.0
 
+import argparse
 import io
+import json
+import os
+import queue
+import shutil
+import tempfile
+import threading
 import unittest
 
 from mesos_tools import marathon_config_producer
@@ -32,6 +39,30 @@ class TestConfigProducer(unittest.TestCase):
             key1="value1", key2="value2")
         self.assertEqual(expected_result, actual_result)
 
+    def test_fill_template_is_literal_and_single_pass(self):
+        template = '${a} ${b} ${missing}'
+        self.assertEqual('\\d ${a} ${missing}', marathon_config_producer
+            .fill_template(template, a="\\d", b="${a}"))
+
+    def test_template_keys_per_app(self):
+        template_keys = marathon_config_producer.TemplateKeys({"env": "prod",
+            "version": "1.0", "unused": "x"})
+        shared = {"cmd": "run --env ${env}", "env": {"${env}_HOME": "/h"}}
+        a = template_keys.fill(dict(shared, id="/${env}/a",
+            labels={"v": "${version}"}))
+        b = template_keys.fill(dict(shared, id="/${env}/b",
+            labels={"v": "${build}"}))
+        self.assertEqual("/prod/a", a["id"])
+        self.assertEqual({"prod_HOME": "/h"}, a["env"])
+        self.assertEqual("${build}", b["labels"]["v"])
+        # the shared command is filled once for both applications
+        self.assertEqual(1, len([text for text in template_keys._filled
+            if text.startswith("run")]))
+        self.assertEqual({"apps": {
+            "/prod/a": {"used": ["env", "version"], "missing": []},
+            "/prod/b": {"used": ["env"], "missing": ["build"]}},
+            "unused": ["unused"]}, template_keys.get_report())
+
     def test_merge_lists(self):
         src = {"a": [
             {
@@ -205,5 +236,212 @@ class TestTemplateKeys(unittest.TestCase):
             "", template_keys_args)
         self.assertEqual(expected_result, actual_result)
 
+class TestConfigIndex(unittest.TestCase):
+    def setUp(self):
+        self.root = os.path.realpath(tempfile.mkdtemp())
+        self.write("templates/base.template", {"cpus": 1, "env": {"A": "1"}})
+        self.write("templates/java.template", {"extends": "base",
+            "changes": {"env": {"B": "2"}}})
+        self.write("apps/a.instance", {"extends": "java",
+            "changes": {"id": "/grp/a"}})
+        self.write("apps/b.instance", {"extends": "base",
+            "changes": {"id": "/grp/b"}})
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def path(self, name):
+        return os.path.join(self.root, name)
+
+    def write(self, name, data):
+        os.makedirs(os.path.dirname(self.path(name)), exist_ok=True)
+        with open(self.path(name), "w") as f:
+            json.dump(data, f)
+
+    def test_collect_instance_files_fills_per_app(self):
+        self.write("apps/c.instance", {"extends": "base",
+            "changes": {"id": "/grp/${name}"}})
+        group = marathon_config_producer.collect_instance_files("/grp",
+            self.root, {"name": "c"})
+        self.assertEqual(["/grp/a", "/grp/b", "/grp/c"], sorted(app["id"]
+            for app in group["apps"]))
+
+    def test_make_config_json_matches_uncached(self):
+        index = marathon_config_producer.ConfigIndex(self.root)
+        for name in ["apps/a.instance", "apps/b.instance"]:
+            self.assertEqual(marathon_config_producer.make_config_json(
+                self.root, self.path(name)),
+                index.make_config_json(self.path(name)))
+
+    def test_get_extend_hierarchy(self):
+        index = marathon_config_producer.ConfigIndex(self.root)
+        expected_result = [self.path("apps/a.instance"),
+            self.path("templates/java.template"),
+            self.path("templates/base.template")]
+        self.assertEqual(expected_result, index.get_extend_hierarchy(
+            self.path("apps/a.instance")))
+
+    def test_circular_extends_throws_exception(self):
+        self.write("templates/base.template", {"extends": "java"})
+        index = marathon_config_producer.ConfigIndex(self.root)
+        with self.assertRaises(marathon_config_producer.ConfigException):
+            index.make_config_json(self.path("apps/a.instance"))
+
+    def test_invalidate_changed_template(self):
+        index = marathon_config_producer.ConfigIndex(self.root)
+        marathon_config_producer.collect_instance_files("grp", self.root,
+            index=index)
+        self.write("templates/java.template", {"extends": "base",
+            "changes": {"env": {"B": "3"}}})
+        affected = index.invalidate({self.path("templates/java.template")})
+        self.assertEqual([self.path("apps/a.instance")], affected)
+        self.assertEqual({"A": "1", "B": "3"}, index.make_config_json(
+            self.path("apps/a.instance"))["env"])
+
+    def test_invalidate_added_file_rescans(self):
+        index = marathon_config_producer.ConfigIndex(self.root)
+        self.write("apps/c.instance", {"extends": "base",
+            "changes": {"id": "/grp/c"}})
+        affected = index.invalidate({self.path("apps/c.instance")})
+        self.assertEqual(3, len(affected))
+        self.assertEqual(3, len(index.instances))
+
+    def test_invalidate_relative_input_path(self):
+        cwd = os.getcwd()
+        os.chdir(self.root)
+        try:
+            index = marathon_config_producer.ConfigIndex(".")
+            self.assertEqual("/grp/b", index.make_config_json(
+                "apps/b.instance")["id"])
+            self.write("apps/b.instance", {"extends": "base",
+                "changes": {"id": "/grp/c"}})
+            index.invalidate({self.path("apps/b.instance")})
+            self.assertEqual("/grp/c", index.make_config_json(
+                "apps/b.instance")["id"])
+        finally:
+            os.chdir(cwd)
+
+    def test_get_affected_instances(self):
+        index = marathon_config_producer.ConfigIndex(self.root)
+        self.assertEqual([self.path("apps/a.instance")],
+            index.get_affected_instances([self.path(
+            "templates/java.template")]))
+        self.assertEqual(2, len(index.get_affected_instances([self.path(
+            "templates/base.template")])))
+
+    def test_get_affected_app_ids_by_name(self):
+        index = marathon_config_producer.ConfigIndex(self.root)
+        self.assertEqual(["/grp/a"], marathon_config_producer
+            .get_affected_app_ids(index, ["java.template"]))
+        self.assertEqual(["/grp/a", "/grp/b"], marathon_config_producer
+            .get_affected_app_ids(index, ["base"]))
+        with self.assertRaises(marathon_config_producer.ConfigException):
+            marathon_config_producer.get_affected_app_ids(index, ["nope"])
+
+    def test_get_affected_app_ids_selected_and_flattened(self):
+        self.write("apps/c.instance", {"extends": "base",
+            "changes": {"id": "/${env}/c"}})
+        index = marathon_config_producer.ConfigIndex(self.root)
+        self.assertEqual(["grp-a", "grp-b", "prod-c"], marathon_config_producer
+            .get_affected_app_ids(index, ["base"], {"env": "prod"}, True))
+        self.assertEqual(["/grp/b"], marathon_config_producer
+            .get_affected_app_ids(index, ["base"], selectors=["/grp/b"]))
+
+    def test_get_affected_app_ids_without_id(self):
+        self.write("apps/c.instance", {"extends": "base"})
+        index = marathon_config_producer.ConfigIndex(self.root)
+        with self.assertRaisesRegex(marathon_config_producer.ConfigException,
+                "c.instance has no id"):
+            marathon_config_producer.get_affected_app_ids(index, ["base"])
+
+    def test_select_instances(self):
+        self.write("prod/search/api.instance", {"extends": "base",
+            "changes": {"id": "/prod/search/api"}})
+        self.write("prod/other.instance", {"extends": "base",
+            "changes": {"id": "/prod/other"}})
+        index = marathon_config_producer.ConfigIndex(self.root)
+        self.assertEqual([self.path("prod/search/api.instance")],
+            index.select_instances(["/prod/search"]))
+        self.assertEqual([self.path("prod/search/api.instance")],
+            index.select_instances(["/prod/*/api"]))
+        self.assertEqual(2, len(index.select_instances([self.path("prod")])))
+        self.assertEqual([], index.select_instances(["/prod/sea"]))
+
+    def test_select_directory_relative_to_root(self):
+        self.write("prod/search/api.instance", {"extends": "base",
+            "changes": {"id": "/prod/search/api"}})
+        index = marathon_config_producer.ConfigIndex(self.root)
+        cwd = os.getcwd()
+        os.chdir(tempfile.gettempdir())
+        try:
+            self.assertEqual([self.path("prod/search/api.instance")],
+                index.select_instances(["prod/search"]))
+        finally:
+            os.chdir(cwd)
+        # directories outside the root are app id selectors
+        self.assertIsNone(marathon_config_producer.Selector("..",
+            self.root).directory)
+
+    def test_select_filled_app_ids(self):
+        self.write("apps/c.instance", {"extends": "base",
+            "changes": {"id": "/${env}/c"}})
+        index = marathon_config_producer.ConfigIndex(self.root)
+        group = marathon_config_producer.collect_instance_files("/", self.root,
+            {"env": "prod"}, index=index, selectors=["/prod"])
+        self.assertEqual("/prod/c", group["groups"][0]["apps"][0]["id"])
+
+    def test_group_id_is_filled(self):
+        index = marathon_config_producer.ConfigIndex(self.root)
+        group = marathon_config_producer.collect_instance_files("/${env}",
+            self.root, {"env": "grp"}, index=index)
+        self.assertEqual("/grp", group["id"])
+        self.assertEqual(["/grp/a", "/grp/b"], sorted(app["id"] for app in
+            group["apps"]))
+
+    def test_select_nothing_fails(self):
+        index = marathon_config_producer.ConfigIndex(self.root)
+        with self.assertRaisesRegex(marathon_config_producer.ConfigException,
+                "match /nope"):
+            marathon_config_producer.collect_instance_files("grp", self.root,
+                index=index, selectors=["/nope"])
+
+    def test_select_option_leaves_input(self):
+        parser = argparse.ArgumentParser()
+        marathon_config_producer.add_arguments(parser)
+        args = parser.parse_args(["-m", "group", "--select", "/a",
+            "--select", "b", "grp"])
+        self.assertEqual(["/a", "b"], args.select)
+        self.assertEqual("grp", args.input)
+
+    def test_select_by_directory_parses_nothing_outside(self):
+        index = marathon_config_producer.ConfigIndex(self.root)
+        group = marathon_config_producer.collect_instance_files("grp",
+            self.root, index=index, selectors=[self.path("apps/")])
+        self.assertEqual(2, len(group["apps"]))
+        os.makedirs(self.path("prod"))
+        with open(self.path("prod/broken.instance"), "w") as f:
+            f.write("not json")
+        index = marathon_config_producer.ConfigIndex(self.root)
+        marathon_config_producer.collect_instance_files("grp", self.root,
+            index=index, selectors=[self.path("apps")])
+
+    def test_poll_changes(self):
+        outside = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, outside)
+        input_path = os.path.join(outside, "input.json")
+        with open(input_path, "w") as f:
+            f.write("{}")
+        changes = marathon_config_producer._poll_changes(self.root, 0.01,
+            {input_path})
+        os.utime(self.path("apps/b.instance"), ns=(0, 0))
+        os.utime(input_path, ns=(0, 0))
+        # read in a daemon thread so a missed change fails the test
+        # instead of blocking the suite
+        result = queue.Queue()
+        threading.Thread(target=lambda: result.put(next(changes)),
+            daemon=True).start()
+        self.assertEqual({self.path("apps/b.instance"), input_path},
+            result.get(timeout=5))
+
 def raise_exception(exception):
     raise exception
@@ -8,8 +8,13 @@
 import copy
 import json
 import os
+import shutil
+import tempfile
+import time
 import unittest
-from mesos_tools.marathon_deployer import Marathon
+from unittest import mock
+from mesos_tools import marathon_deployer
+from mesos_tools.marathon_deployer import ACTIVE_LABEL, FINGERPRINT_LABEL, Marathon, MarathonException
 
 
 class TestMarathon(unittest.TestCase):
@@ -236,3 +241,380 @@ class TestMarathon(unittest.TestCase):
         current = copy.deepcopy(application)
         current['portDefinitions'][1]['port'] = 22
         self.assertFalse(Marathon.is_port_update(application, current))
+
+    def test_fingerprint_ignores_key_order_and_fingerprint_label(self):
+        application = {'id': '/app', 'mem': 42, 'labels': {'a': 'b'}}
+        reordered = json.loads('{"labels": {"a": "b"}, "mem": 42, "id": "/app"}')
+        self.assertEqual(Marathon.fingerprint(application), Marathon.fingerprint(reordered))
+        self.assertEqual(Marathon.fingerprint(application),
+                         Marathon.fingerprint(Marathon.with_fingerprint(application)))
+        self.assertNotEqual(Marathon.fingerprint(application), Marathon.fingerprint({'id': '/app', 'mem': 43}))
+        self.assertNotIn(FINGERPRINT_LABEL, application['labels'])
+
+    def test_is_unchanged_uses_fingerprint_label(self):
+        current = copy.deepcopy(self.app_response['app'])
+        current['labels'] = {FINGERPRINT_LABEL: Marathon.fingerprint({'mem': 42})}
+        self.assertTrue(Marathon.is_unchanged({'mem': 42}, current))
+        self.assertFalse(Marathon.is_unchanged({'mem': 43}, current))
+
+    def test_is_unchanged_without_label_falls_back_to_is_update(self):
+        self.assertTrue(Marathon.is_unchanged(self.app_response['app'], self.app_response['app']))
+        self.assertFalse(Marathon.is_unchanged({'mem': 42}, self.app_response['app']))
+
+    def test_get_scale_steps(self):
+        self.assertEqual([55, 105, 155, 200], Marathon.get_scale_steps(5, 200, Marathon.parse_scale_step("50")))
+        self.assertEqual([55, 105, 155, 200], Marathon.get_scale_steps(5, 200, Marathon.parse_scale_step("25%")))
+        self.assertEqual([2, 3], Marathon.get_scale_steps(1, 3, Marathon.parse_scale_step("1%")))
+        self.assertEqual([2], Marathon.get_scale_steps(5, 2, Marathon.parse_scale_step("1")))
+        self.assertEqual([10], Marathon.get_scale_steps(5, 10, None))
+
+    def test_parse_scale_step_invalid(self):
+        for scale_step in ["0", "-1", "abc", "150%"]:
+            with self.assertRaises(MarathonException):
+                Marathon.parse_scale_step(scale_step)
+
+    def test_find_active_application(self):
+        apps = [{'id': '/app', 'instances': 0}, {'id': '/app-blue', 'instances': 2},
+                {'id': '/app-green', 'instances': 2, 'labels': {ACTIVE_LABEL: 'true'}}, {'id': '/app-2', 'instances': 1}]
+        self.assertEqual('/app-green', Marathon.find_active_application('/app', apps)['id'])
+        self.assertEqual('/app-blue', Marathon.find_active_application('/app', apps[:2])['id'])
+        self.assertEqual('/app', Marathon.find_active_application('/app', apps[:1])['id'])
+        self.assertIsNone(Marathon.find_active_application('/app', apps[3:]))
+
+
+class TestMarathonDeploy(unittest.TestCase):
+    def setUp(self):
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), 'app_response.json'), 'r') as app_response:
+            self.app_response = json.load(app_response)
+
+    def make_marathon(self, on_unchanged):
+        marathon = Marathon("http://marathon", "token", on_unchanged)
+        marathon._get_application = mock.Mock(return_value=self.app_response)
+        marathon._restart_application = mock.Mock()
+        marathon._wait_for_application_instances = mock.Mock()
+        marathon._wait_while_app_is_affected_by_deployment = mock.Mock()
+        return marathon
+
+    def test_unknown_on_unchanged_policy(self):
+        with self.assertRaises(MarathonException):
+            Marathon("http://marathon", "token", "ignore")
+
+    def test_deploy_unchanged_restart(self):
+        marathon = self.make_marathon("restart")
+        marathon.deploy(copy.deepcopy(self.app_response['app']))
+        marathon._restart_application.assert_called_once()
+        marathon._wait_while_app_is_affected_by_deployment.assert_called_once()
+
+    def test_deploy_unchanged_skip(self):
+        marathon = self.make_marathon("skip")
+        marathon.deploy(copy.deepcopy(self.app_response['app']))
+        marathon._restart_application.assert_not_called()
+        marathon._wait_for_application_instances.assert_not_called()
+        marathon._wait_while_app_is_affected_by_deployment.assert_not_called()
+
+    def test_deploy_unchanged_verify(self):
+        marathon = self.make_marathon("verify")
+        marathon.deploy(copy.deepcopy(self.app_response['app']))
+        marathon._restart_application.assert_not_called()
+        app = self.app_response['app']
+        marathon._wait_for_application_instances.assert_called_once_with(app['id'], app['version'],
+                                                                          app['instances'], scale_only=True)
+
+    def test_deploy_update_returns_when_ready(self):
+        marathon = self.make_marathon("restart")
+        calls = []
+        marathon._wait_while_app_is_affected_by_deployment.side_effect = lambda app_id: calls.append("wait")
+        marathon._update_application = mock.Mock(side_effect=lambda *args, **kwargs: calls.append("update"))
+        application = copy.deepcopy(self.app_response['app'])
+        application['mem'] = 42
+        marathon.deploy(application)
+        # only a deployment still running from before is waited for, not the one just made
+        self.assertEqual(["wait", "update"], calls)
+
+    def test_deploy_update_stores_fingerprint(self):
+        marathon = self.make_marathon("restart")
+        marathon._update_application = mock.Mock()
+        application = copy.deepcopy(self.app_response['app'])
+        application['mem'] = 42
+        marathon.deploy(application)
+        deployed = marathon._update_application.call_args[0][0]
+        self.assertEqual(Marathon.fingerprint(application), deployed['labels'][FINGERPRINT_LABEL])
+
+    def test_plan_group(self):
+        marathon = self.make_marathon("restart")
+        scaled = copy.deepcopy(self.app_response['app'])
+        scaled['instances'] = 42
+        changed = copy.deepcopy(self.app_response['app'])
+        changed['mem'] = 42
+        changed['id'] = 'changed'
+        marathon._list_applications = mock.Mock(return_value=[
+            dict(self.app_response['app'], id='/grp/unchanged'),
+            dict(self.app_response['app'], id='/grp/scaled'),
+            dict(self.app_response['app'], id='/grp/changed')])
+        group = {'id': '/grp', 'apps': [
+            dict(self.app_response['app'], id='unchanged'), dict(scaled, id='scaled'), changed, {'id': 'new'}]}
+        expected_result = [('/grp/unchanged', 'unchanged'), ('/grp/scaled', 'scale'), ('/grp/changed', 'update'),
+                           ('/grp/new', 'create')]
+        self.assertEqual(expected_result, marathon.plan_group(group))
+        marathon._list_applications.assert_called_once_with('/grp')
+
+    def test_deploy_scale_in_steps(self):
+        marathon = self.make_marathon("restart")
+        marathon.scale_step = Marathon.parse_scale_step("1")
+        marathon._update_application = mock.Mock()
+        marathon._put_instances = mock.Mock()
+        marathon._get_application_counts = mock.Mock(return_value={'tasksHealthy': 10, 'tasksRunning': 10})
+        application = copy.deepcopy(self.app_response['app'])
+        application['instances'] = 6
+        marathon.deploy(application)
+        self.assertEqual([mock.call(application['id'], 4), mock.call(application['id'], 5)],
+                         marathon._put_instances.call_args_list)
+        self.assertEqual(6, marathon._update_application.call_args[0][2])
+        self.assertTrue(marathon._update_application.call_args[1]['scale_only'])
+
+    def test_deploy_scale_in_steps_rolls_back_unhealthy_step(self):
+        marathon = self.make_marathon("restart")
+        marathon.scale_step = Marathon.parse_scale_step("1")
+        marathon.scale_step_timeout = 0
+        marathon._update_application = mock.Mock()
+        marathon._put_instances = mock.Mock()
+        application = copy.deepcopy(self.app_response['app'])
+        application['instances'] = 6
+        with self.assertRaises(MarathonException):
+            marathon.deploy(application)
+        self.assertEqual(mock.call(application['id'], 3, force=True), marathon._put_instances.call_args)
+        marathon._update_application.assert_not_called()
+
+    def test_deploy_scale_in_steps_waits_for_each_deployment(self):
+        marathon = self.make_marathon("restart")
+        marathon.scale_step = Marathon.parse_scale_step("1")
+        marathon._update_application = mock.Mock()
+        marathon._put_instances = mock.Mock()
+        marathon._get_application_counts = mock.Mock(return_value={'tasksHealthy': 10, 'tasksRunning': 10})
+        application = copy.deepcopy(self.app_response['app'])
+        application['instances'] = 6
+        marathon.deploy(application)
+        # once before scaling and once after each of the two intermediate steps
+        self.assertEqual(3, marathon._wait_while_app_is_affected_by_deployment.call_count)
+
+    def test_deploy_scale_in_steps_scales_back_on_any_error(self):
+        marathon = self.make_marathon("restart")
+        marathon.scale_step = Marathon.parse_scale_step("1")
+        marathon._update_application = mock.Mock()
+        marathon._put_instances = mock.Mock()
+        marathon._get_application_counts = mock.Mock(return_value={'tasksHealthy': 10, 'tasksRunning': 10})
+        marathon._wait_while_app_is_affected_by_deployment.side_effect = [None, MarathonException("409 locked")]
+        application = copy.deepcopy(self.app_response['app'])
+        application['instances'] = 6
+        with self.assertRaisesRegex(MarathonException, "failed at 4 instance.*409 locked"):
+            marathon.deploy(application)
+        self.assertEqual(mock.call(application['id'], 3, force=True), marathon._put_instances.call_args)
+
+    def test_wait_for_scale_step_checks_deploy_deadline(self):
+        marathon = self.make_marathon("restart")
+        marathon._get_application_counts = mock.Mock(return_value={'tasksHealthy': 0, 'tasksRunning': 0})
+        marathon._deadline = time.time() - 1
+        with self.assertRaisesRegex(MarathonException, "timed out"):
+            marathon._wait_for_scale_step('/app', 4, True)
+
+    def test_deploy_blue_green(self):
+        marathon = self.make_marathon("restart")
+        marathon.strategy = "blue-green"
+        current = copy.deepcopy(self.app_response)
+        current['app']['id'] += '-green'
+        current['app']['labels'] = {ACTIVE_LABEL: 'true'}
+        marathon._list_applications = mock.Mock(return_value=[current['app']])
+        marathon._get_application = mock.Mock(side_effect=lambda app_id: current if app_id == current['app']['id']
+                                              else None)
+        marathon._create_application = mock.Mock()
+        marathon._put_application_fields = mock.Mock()
+        application = copy.deepcopy(self.app_response['app'])
+        application['mem'] = 42
+        marathon.deploy(application)
+        created = marathon._create_application.call_args[0][0]
+        self.assertEqual(application['id'] + '-blue', created['id'])
+        self.assertEqual('true', created['labels'][ACTIVE_LABEL])
+        self.assertEqual(Marathon.fingerprint(application), created['labels'][FINGERPRINT_LABEL])
+        marathon._put_application_fields.assert_called_once_with(
+            current['app']['id'], {'instances': 0, 'labels': {ACTIVE_LABEL: 'false'}})
+
+    def test_deploy_blue_green_scale_only_in_place(self):
+        marathon = self.make_marathon("restart")
+        marathon.strategy = "blue-green"
+        current = copy.deepcopy(self.app_response)
+        current['app']['id'] += '-green'
+        marathon._list_applications = mock.Mock(return_value=[current['app']])
+        marathon._get_application = mock.Mock(return_value=current)
+        marathon._update_application = mock.Mock()
+        application = copy.deepcopy(self.app_response['app'])
+        application['instances'] = 42
+        marathon.deploy(application)
+        self.assertEqual(current['app']['id'], marathon._update_application.call_args[0][0]['id'])
+        self.assertTrue(marathon._update_application.call_args[1]['scale_only'])
+
+
+def make_response(status_code, js):
+    response = mock.Mock()
+    response.status_code = status_code
+    response.json.return_value = js
+    response.text = json.dumps(js)
+    return response
+
+
+class TestMarathonDeleteGroup(unittest.TestCase):
+    groups = {
+        "id": "/grp",
+        "groups": [
+            {"id": "/grp/a", "groups": [{"id": "/grp/a/x", "groups": []}]},
+            {"id": "/grp/b", "groups": []}
+        ]
+    }
+
+    def setUp(self):
+        self.marathon = Marathon("http://marathon", "token")
+        self.marathon._wait_for_deployments = mock.Mock()
+
+    def test_get_group_levels(self):
+        expected_result = [["/grp"], ["/grp/a", "/grp/b"], ["/grp/a/x"]]
+        self.assertEqual(expected_result, Marathon.get_group_levels("/grp", self.groups["groups"]))
+
+    def test_delete_group_forced(self):
+        with mock.patch.object(marathon_deployer, "http_get", return_value=make_response(200, self.groups)), \
+                mock.patch.object(marathon_deployer, "http_delete",
+                                  return_value=make_response(200, {"deploymentId": "d1"})) as http_delete, \
+                mock.patch.object(marathon_deployer, "http_put") as http_put:
+            self.marathon.delete_group("/grp")
+        http_delete.assert_called_once_with("http://marathon/v2/groups//grp", self.marathon.cookies,
+                                            {"force": "true"}, session=self.marathon.session)
+        http_put.assert_not_called()
+        self.marathon._wait_for_deployments.assert_called_once_with(["d1"])
+
+    def test_delete_group_level_by_level(self):
+        deleted = []
+
+        def http_delete(url, cookies, params=None, session=None):
+            if params is not None:
+                return make_response(409, {"message": "group has content"})
+            deleted.append(url.split("/v2/groups/")[1])
+            return make_response(200, {"deploymentId": "delete" + url})
+
+        with mock.patch.object(marathon_deployer, "http_get", return_value=make_response(200, self.groups)), \
+                mock.patch.object(marathon_deployer, "http_delete", side_effect=http_delete), \
+                mock.patch.object(marathon_deployer, "http_put",
+                                  return_value=make_response(200, {"deploymentId": "put"})):
+            self.marathon.delete_group("/grp")
+        self.assertEqual("/grp/a/x", deleted[0])
+        self.assertEqual({"/grp/a", "/grp/b"}, set(deleted[1:3]))
+        self.assertEqual("/grp", deleted[3])
+        self.assertEqual(3, self.marathon._wait_for_deployments.call_count)
+
+    def test_delete_group_empty_group_error(self):
+        with mock.patch.object(marathon_deployer, "http_get", return_value=make_response(200, self.groups)), \
+                mock.patch.object(marathon_deployer, "http_delete", return_value=make_response(409, {})), \
+                mock.patch.object(marathon_deployer, "http_put", return_value=make_response(500, {})):
+            with self.assertRaises(MarathonException):
+                self.marathon.delete_group("/grp")
+
+
+class TestMarathonRollback(unittest.TestCase):
+    group = {"id": "/grp", "apps": [{"id": "a", "instances": 2}, {"id": "b", "instances": 1},
+                                    {"id": "c", "instances": 1}]}
+    previous_apps = [{"id": "/grp/a", "version": "v1", "instances": 3}]
+
+    def make_marathon(self, rollback=True):
+        marathon = Marathon("http://marathon", "token", rollback=rollback)
+        marathon._list_applications = mock.Mock(side_effect=[self.previous_apps,
+                                                             self.previous_apps + [{"id": "/grp/b"}]])
+        marathon.deploy = mock.Mock(side_effect=[None, MarathonException("b never became healthy")])
+        marathon._wait_for_deployments = mock.Mock()
+        marathon._wait_for_application_instances = mock.Mock()
+        return marathon
+
+    def test_failed_deploy_is_rolled_back(self):
+        marathon = self.make_marathon()
+        with mock.patch.object(marathon_deployer, "http_put",
+                               return_value=make_response(200, {"deploymentId": "d1"})) as http_put, \
+                mock.patch.object(marathon_deployer, "http_delete",
+                                  return_value=make_response(200, {"deploymentId": "d2"})) as http_delete:
+            with self.assertRaisesRegex(MarathonException, "rolled back"):
+                marathon.deploy_group(copy.deepcopy(self.group))
+        http_put.assert_called_once_with("http://marathon/v2/apps//grp/a", {"version": "v1"}, marathon.cookies,
+                                         {"force": "true"}, session=marathon.session)
+        http_delete.assert_called_once_with("http://marathon/v2/apps//grp/b", marathon.cookies,
+                                            {"force": "true"}, session=marathon.session)
+        marathon._wait_for_deployments.assert_called_once_with(["d1", "d2"])
+        marathon._wait_for_application_instances.assert_called_once_with("/grp/a", "v1", 3, scale_only=True)
+
+    def test_unchanged_apps_are_not_rolled_back(self):
+        marathon = self.make_marathon()
+        unchanged = [{"id": "/grp/a", "version": "v1", "instances": 2}]
+        marathon._list_applications.side_effect = [unchanged, unchanged + [{"id": "/grp/b"}]]
+        with mock.patch.object(marathon_deployer, "http_put") as http_put, \
+                mock.patch.object(marathon_deployer, "http_delete",
+                                  return_value=make_response(200, {"deploymentId": "d2"})) as http_delete:
+            with self.assertRaisesRegex(MarathonException, "rolled back"):
+                marathon.deploy_group(copy.deepcopy(self.group))
+        http_put.assert_not_called()
+        http_delete.assert_called_once_with("http://marathon/v2/apps//grp/b", marathon.cookies,
+                                            {"force": "true"}, session=marathon.session)
+        marathon._list_applications.assert_called_with("/grp/b")
+
+    def test_no_rollback_by_default(self):
+        marathon = self.make_marathon(rollback=False)
+        with self.assertRaisesRegex(MarathonException, "never became healthy"):
+            marathon.deploy_group(copy.deepcopy(self.group))
+        marathon._list_applications.assert_not_called()
+
+    def test_deploy_timeout(self):
+        marathon = Marathon("http://marathon", "token", deploy_timeout=0)
+        marathon._deadline = time.time() - 1
+        marathon._get_deployments = mock.Mock(return_value=[{"affectedApps": ["/a"]}])
+        with self.assertRaisesRegex(MarathonException, "timed out"):
+            marathon._wait_while_app_is_affected_by_deployment("/a")
+
+
+class TestMarathonClusters(unittest.TestCase):
+    clusters = [("dev", "http://dev", "a"), ("stage", "http://stage", "b"), ("prod", "http://prod", "c")]
+
+    def test_get_clusters_from_args(self):
+        expected_result = [("dev:8080", "http://dev:8080", "a"), ("prod:8080", "http://prod:8080", "b")]
+        actual_result = marathon_deployer.get_clusters(["http://dev:8080", "http://prod:8080"], ["a", "b"])
+        self.assertEqual(expected_result, actual_result)
+
+    def test_get_clusters_unmatched_access_tokens(self):
+        with self.assertRaises(MarathonException):
+            marathon_deployer.get_clusters(["http://dev", "http://prod"], ["a"])
+
+    def test_get_clusters_duplicate_names(self):
+        with self.assertRaises(MarathonException):
+            marathon_deployer.get_clusters(["http://h:8080/a", "http://h:8080/b"], ["a", "b"])
+
+    def test_get_clusters_file_with_percent_and_duplicate_of_args(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, "clusters.ini")
+            with open(path, "w") as clusters_file:
+                clusters_file.write("[h:8080]\nbaseurl = http://h:8080\naccess_token = ab%2Fcd\n")
+            self.assertEqual([("h:8080", "http://h:8080", "ab%2Fcd")], marathon_deployer.get_clusters(None, None, path))
+            with self.assertRaises(MarathonException):
+                marathon_deployer.get_clusters(["http://h:8080"], ["a"], path)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_run_on_clusters(self):
+        with mock.patch.object(marathon_deployer, "run_action") as run_action:
+            results = marathon_deployer.run_on_clusters(self.clusters, "delete", "/grp")
+        self.assertEqual(["dev", "stage", "prod"], list(results.keys()))
+        self.assertTrue(all(error is None for error in results.values()))
+        self.assertEqual({"http://dev", "http://stage", "http://prod"},
+                         {call[0][0].baseurl for call in run_action.call_args_list})
+        self.assertEqual({"Marathon.dev", "Marathon.stage", "Marathon.prod"},
+                         {call[0][0].logger.name for call in run_action.call_args_list})
+
+    def test_run_on_clusters_canary_failure_skips_rest(self):
+        with mock.patch.object(marathon_deployer, "run_action", side_effect=MarathonException("boom")) as run_action:
+            results = marathon_deployer.run_on_clusters(self.clusters, "delete", "/grp", canary_first=True)
+        run_action.assert_called_once()
+        self.assertEqual("boom", str(results["dev"]))
+        self.assertIsInstance(results["stage"], MarathonException)
+        self.assertIsInstance(results["prod"], MarathonException)
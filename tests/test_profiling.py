@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# Copyright Dansk Bibliotekscenter a/s. Licensed under GPLv3
+# See license text at https://opensource.dbc.dk/licenses/gpl-3.0
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from mesos_tools import profiling
+
+class TestTimings(unittest.TestCase):
+    def test_stage_and_count(self):
+        timings = profiling.Timings()
+        for _ in range(3):
+            with timings.stage("merge"):
+                pass
+        timings.count("files parsed")
+        timings.count("bytes received", 42)
+        result = timings.as_dict()
+        self.assertEqual(3, result["stages"]["merge"]["calls"])
+        self.assertEqual({"files parsed": 1, "bytes received": 42},
+            dict(result["counters"]))
+
+    def test_stage_records_on_exception(self):
+        timings = profiling.Timings()
+        with self.assertRaises(ValueError):
+            with timings.stage("http"):
+                raise ValueError()
+        self.assertEqual(1, timings.as_dict()["stages"]["http"]["calls"])
+
+class TestRun(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_run_writes_profile_and_timings(self):
+        parser = argparse.ArgumentParser()
+        profiling.add_arguments(parser)
+        profile_path = os.path.join(self.directory, "out.prof")
+        timings_path = os.path.join(self.directory, "timings.json")
+        args = parser.parse_args(["--profile", profile_path,
+            "--trace-timings", timings_path])
+
+        def function(value):
+            profiling.timings.count("calls")
+            return value
+
+        self.assertEqual(42, profiling.run(args, function, 42))
+        self.assertTrue(os.path.isfile(profile_path))
+        with open(timings_path) as timings_file:
+            self.assertEqual({"calls": 1}, json.load(timings_file)["counters"])
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+# Copyright Dansk Bibliotekscenter a/s. Licensed under GPLv3
+# See license text at https://opensource.dbc.dk/licenses/gpl-3.0
+
+import copy
+import importlib.util
+import os
+import random
+import unittest
+
+from mesos_tools import marathon_config_producer as producer
+from mesos_tools.marathon_deployer import Marathon
+
+EXAMPLES = 200
+""" Random examples checked per property """
+
+def load_benchmark():
+    path = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "benchmarks",
+                        "benchmark.py")
+    spec = importlib.util.spec_from_file_location("benchmark", path)
+    benchmark = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(benchmark)
+    return benchmark
+
+def random_value(rng, depth=0):
+    kind = rng.choice(["int", "str", "bool", "list", "dict"] if depth < 3 else ["int", "str", "bool"])
+    if kind == "int":
+        return rng.randint(0, 5)
+    if kind == "str":
+        return rng.choice("abcde")
+    if kind == "bool":
+        return rng.random() < 0.5
+    if kind == "list":
+        return [random_value(rng, depth + 1) for _ in range(rng.randint(0, 4))]
+    return random_dict(rng, depth + 1)
+
+def random_dict(rng, depth=0):
+    return {rng.choice("abcdefgh"): random_value(rng, depth) for _ in range(rng.randint(0, 5))}
+
+def random_app(rng):
+    app = {"id": "/grp/app", "instances": rng.randint(0, 5), "cpus": rng.choice([0.1, 0.5, 1]),
+           "env": {key: str(value) for key, value in random_dict(rng, 3).items()},
+           "constraints": [[rng.choice("abc"), "LIKE", rng.choice("xyz")] for _ in range(rng.randint(0, 3))],
+           "portDefinitions": [{"port": rng.randint(1, 100), "protocol": "tcp"} for _ in range(rng.randint(0, 3))]}
+    if rng.random() < 0.5:
+        app["labels"] = {key: str(value) for key, value in random_dict(rng, 3).items()}
+    return app
+
+class TestMergeProperties(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(26)
+
+    def test_merge_into_empty_is_identity(self):
+        for _ in range(EXAMPLES):
+            src = random_dict(self.rng)
+            self.assertEqual(src, producer.merge(src, {}))
+
+    def test_merge_keeps_destination_keys(self):
+        for _ in range(EXAMPLES):
+            src, dest = random_dict(self.rng), random_dict(self.rng)
+            merged = producer.merge(src, dest)
+            self.assertEqual(set(src) | set(dest), set(merged))
+            for key in set(dest) - set(src):
+                self.assertEqual(dest[key], merged[key])
+
+    def test_merge_is_idempotent(self):
+        for _ in range(EXAMPLES):
+            src, dest = random_dict(self.rng), random_dict(self.rng)
+            merged = producer.merge(src, dest)
+            self.assertEqual(merged, producer.merge(src, merged))
+
+    def test_merge_does_not_modify_arguments(self):
+        for _ in range(EXAMPLES):
+            src, dest = random_dict(self.rng), random_dict(self.rng)
+            src_copy, dest_copy = copy.deepcopy(src), copy.deepcopy(dest)
+            producer.merge(src, dest)
+            self.assertEqual((src_copy, dest_copy), (src, dest))
+
+    def test_merge_lists_contains_both(self):
+        for _ in range(EXAMPLES):
+            src = [random_value(self.rng, 3) for _ in range(self.rng.randint(0, 6))]
+            dest = [random_value(self.rng, 3) for _ in range(self.rng.randint(0, 6))]
+            merged = producer.merge_lists(src, dest)
+            self.assertEqual(dest, merged[:len(dest)])
+            for element in src:
+                self.assertIn(element, merged)
+
+class TestDiffProperties(unittest.TestCase):
+    def setUp(self):
+        self.rng = random.Random(41)
+
+    def test_application_is_not_an_update_of_itself(self):
+        for _ in range(EXAMPLES):
+            app = random_app(self.rng)
+            self.assertFalse(Marathon.is_update(app, copy.deepcopy(app)))
+            self.assertFalse(Marathon.is_scale_only_update(app, copy.deepcopy(app)))
+
+    def test_subset_of_current_is_not_an_update(self):
+        for _ in range(EXAMPLES):
+            current = random_app(self.rng)
+            app = {key: value for key, value in current.items() if self.rng.random() < 0.5}
+            self.assertFalse(Marathon.is_update(app, current))
+
+    def test_changing_instances_only_is_scale_only(self):
+        for _ in range(EXAMPLES):
+            current = random_app(self.rng)
+            app = dict(copy.deepcopy(current), instances=current["instances"] + self.rng.randint(1, 5))
+            self.assertTrue(Marathon.is_update(app, current))
+            self.assertTrue(Marathon.is_scale_only_update(app, current))
+
+    def test_changing_env_is_not_scale_only(self):
+        for _ in range(EXAMPLES):
+            current = random_app(self.rng)
+            app = copy.deepcopy(current)
+            app["instances"] += 1
+            app["env"]["CHANGED"] = "yes"
+            self.assertTrue(Marathon.is_update(app, current))
+            self.assertFalse(Marathon.is_scale_only_update(app, current))
+
+class TestBenchmark(unittest.TestCase):
+    def test_run_benchmarks(self):
+        benchmark = load_benchmark()
+        current = benchmark.run_benchmarks(sizes=(2,), repeat=1, min_time=0)
+        self.assertEqual(list(benchmark.BENCHMARKS), list(current["results"]))
+        for sizes in current["results"].values():
+            self.assertGreater(sizes["2"]["peak_bytes"], 0)
+
+    def test_find_regressions(self):
+        benchmark = load_benchmark()
+        baseline = {"results": {"merge": {"10": {"relative": 1.0, "peak_bytes": 1000}}}}
+        current = {"results": {"merge": {"10": {"relative": 1.5, "peak_bytes": 1000}},
+                               "new": {"10": {"relative": 9.0, "peak_bytes": 9}}}}
+        self.assertEqual([], benchmark.find_regressions(baseline, current))
+        current["results"]["merge"]["10"] = {"relative": 3.0, "peak_bytes": 2000}
+        self.assertEqual(2, len(benchmark.find_regressions(baseline, current)))
@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+# Copyright Dansk Bibliotekscenter a/s. Licensed under GPLv3
+# See license text at https://opensource.dbc.dk/licenses/gpl-3.0
+
+import unittest
+from unittest import mock
+
+from mesos_tools import readiness
+from mesos_tools.marathon_deployer import Marathon
+
+NOW = readiness.parse_time("2017-04-26T16:00:00.000Z")
+
+def make_task(version, state="TASK_RUNNING", last_success=None, started="2017-04-26T15:59:55.000Z"):
+    task = {"appId": "/grp/app", "version": version, "state": state, "startedAt": started}
+    if last_success is not None:
+        task["healthCheckResults"] = [{"alive": True, "lastSuccess": last_success, "lastFailure": None}]
+    return task
+
+def make_app(tasks, interval=None):
+    app = {"id": "/grp/app", "tasks": tasks}
+    if interval is not None:
+        app["healthChecks"] = [{"intervalSeconds": interval}]
+    return app
+
+class TestReadiness(unittest.TestCase):
+    def test_parse_time(self):
+        self.assertEqual(1493222188.384, readiness.parse_time("2017-04-26T15:56:28.384Z"))
+        self.assertEqual(1493222188, readiness.parse_time("2017-04-26T15:56:28Z"))
+        self.assertIsNone(readiness.parse_time(None))
+
+    def test_scale_down_waits_for_surplus_tasks(self):
+        app = make_app([make_task("v1"), make_task("v1"), make_task("v1", state="TASK_KILLING")])
+        self.assertEqual((False, readiness.DEFAULT_POLL), readiness.evaluate(app, "v1", 2, scale_only=True, now=NOW))
+        app["tasks"].pop()
+        self.assertEqual((True, 0), readiness.evaluate(app, "v1", 2, scale_only=True, now=NOW))
+
+    def test_ready_while_old_tasks_linger(self):
+        app = make_app([make_task("v1"), make_task("v1"), make_task("v2"), make_task("v2")])
+        self.assertEqual((True, 0), readiness.evaluate(app, "v2", 2, now=NOW))
+        self.assertFalse(readiness.evaluate(app, "v2", 3, now=NOW)[0])
+        self.assertTrue(readiness.evaluate(app, "v2", 4, scale_only=True, now=NOW)[0])
+
+    def test_health_checked_tasks_need_results(self):
+        app = make_app([make_task("v2")], interval=10)
+        ready, delay = readiness.evaluate(app, "v2", 1, now=NOW)
+        self.assertFalse(ready)
+        # started five seconds ago, so checked five seconds from now
+        self.assertEqual(5, delay)
+        app["tasks"][0]["healthCheckResults"] = [{"alive": True, "lastSuccess": "2017-04-26T15:59:59.000Z"}]
+        self.assertTrue(readiness.evaluate(app, "v2", 1, now=NOW)[0])
+
+    def test_wait_until_next_health_check(self):
+        app = make_app([make_task("v2", last_success="2017-04-26T15:59:38.000Z"),
+                        make_task("v2", last_success="2017-04-26T15:59:40.000Z")], interval=30)
+        app["tasks"][0]["healthCheckResults"][0]["alive"] = False
+        self.assertEqual((False, 8), readiness.evaluate(app, "v2", 2, now=NOW))
+        # overdue checks are polled for quickly, far ones not too late
+        self.assertEqual(readiness.MIN_POLL, readiness.evaluate(app, "v2", 2, now=NOW + 60)[1])
+        app["healthChecks"][0]["intervalSeconds"] = 300
+        self.assertEqual(readiness.MAX_POLL, readiness.evaluate(app, "v2", 2, now=NOW)[1])
+
+    def test_staged_tasks_are_polled(self):
+        app = make_app([make_task("v2", state="TASK_STAGING")], interval=30)
+        self.assertEqual((False, readiness.DEFAULT_POLL), readiness.evaluate(app, "v2", 1, now=NOW))
+
+    def test_marathon_waits_with_predicted_delay(self):
+        marathon = Marathon("http://marathon", "token")
+        unhealthy = make_app([make_task("v1"), make_task("v2", last_success=None)], interval=10)
+        healthy = make_app([make_task("v1"), make_task("v2", last_success="2017-04-26T16:00:01.000Z")],
+                           interval=10)
+        marathon._get_application = mock.Mock(side_effect=[{"app": unhealthy}, {"app": healthy}])
+        with mock.patch("mesos_tools.profiling.sleep") as sleep, \
+                mock.patch("mesos_tools.readiness.time.time", return_value=NOW):
+            current = marathon._wait_for_application_instances("/grp/app", "v2", 1)
+        self.assertEqual(healthy, current["app"])
+        sleep.assert_called_once_with(5)
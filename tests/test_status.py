@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+# Copyright Dansk Bibliotekscenter a/s. Licensed under GPLv3
+# See license text at https://opensource.dbc.dk/licenses/gpl-3.0
+
+import io
+import json
+import unittest
+import unittest.mock as mock
+
+from mesos_tools import status
+
+def make_marathon(apps, deployments):
+    marathon = mock.Mock()
+    marathon._list_applications = mock.Mock(return_value=apps)
+    marathon._get_deployments = mock.Mock(return_value=deployments)
+    return marathon
+
+class TestStatus(unittest.TestCase):
+    def test_refresh_costs_two_requests(self):
+        apps = [{"id": "/g/{}".format(i), "instances": 2} for i in range(50)]
+        marathon = make_marathon(apps, [])
+        listener = mock.Mock()
+        cache = status.StatusCache(marathon, "/g")
+        cache.listeners.append(listener)
+        snapshot = cache.refresh()
+        marathon._list_applications.assert_called_once_with("/g",
+            embed="apps.counts")
+        marathon._get_deployments.assert_called_once_with()
+        listener.assert_called_once_with(snapshot)
+        self.assertEqual(50, len(cache.snapshot()["apps"]))
+
+    def test_rollout_rows(self):
+        tracker = status.RolloutTracker(["/g/a", "/g/b", "/g/new"])
+        apps = {"/g/a": {"id": "/g/a", "instances": 3, "tasksHealthy": 1,
+            "tasksRunning": 2, "tasksStaged": 1, "version": "v2"},
+            "/g/b": {"id": "/g/b", "instances": 1, "tasksHealthy": 1}}
+        deployments = [{"affectedApps": ["/g/a"], "currentStep": 1,
+            "totalSteps": 2}]
+        rows = tracker.rows({"time": 10.0, "apps": apps,
+            "deployments": deployments})
+        self.assertEqual(["step 1/2", "-", "waiting"],
+            [row["progress"] for row in rows])
+        self.assertEqual((1, 3, 2, 1), (rows[0]["healthy"], rows[0]["target"],
+            rows[0]["running"], rows[0]["staged"]))
+        rows = tracker.rows({"time": 14.0, "apps": apps, "deployments": []})
+        self.assertEqual("done", rows[0]["progress"])
+        self.assertEqual(4.0, rows[0]["elapsed"])
+        rows = tracker.rows({"time": 20.0, "apps": apps, "deployments": []})
+        self.assertEqual(4.0, rows[0]["elapsed"])
+
+    def test_json_status_stream(self):
+        stream = io.StringIO()
+        tracker = status.RolloutTracker()
+        listener = status.JsonStatusStream(stream, tracker, cluster="dc1")
+        snapshot = {"time": 1.0, "apps": {"/a": {"id": "/a", "instances": 1}},
+            "deployments": []}
+        listener(snapshot)
+        listener(snapshot)
+        lines = stream.getvalue().splitlines()
+        self.assertEqual(2, len(lines))
+        line = json.loads(lines[0])
+        self.assertEqual("dc1", line["cluster"])
+        self.assertEqual("/a", line["apps"][0]["id"])
+
+    def test_terminal_dashboard_appends_when_not_a_tty(self):
+        stream = io.StringIO()
+        dashboard = status.TerminalDashboard(stream, status.RolloutTracker())
+        snapshot = {"time": 1.0, "apps": {"/a": {"id": "/a", "instances": 2,
+            "tasksHealthy": 1}}, "deployments": []}
+        dashboard(snapshot)
+        dashboard(snapshot)
+        self.assertNotIn("\x1b", stream.getvalue())
+        self.assertEqual(2, stream.getvalue().count("1/2"))
+
+    def test_stop_refreshes_once_more(self):
+        marathon = make_marathon([], [])
+        cache = status.StatusCache(marathon, "/g", interval=60)
+        cache.start()
+        cache.stop()
+        self.assertGreaterEqual(marathon._list_applications.call_count, 2)
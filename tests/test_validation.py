@@ -0,0 +1,45 @@
+#!/usr/bin/env python3
+# Copyright Dansk Bibliotekscenter a/s. Licensed under GPLv3
+# See license text at https://opensource.dbc.dk/licenses/gpl-3.0
+
+import json
+import os
+import unittest
+
+from mesos_tools import validation
+
+class TestValidation(unittest.TestCase):
+    def test_valid_app_response(self):
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                "app_response.json")) as app_response:
+            app = json.load(app_response)["app"]
+        app = {key: value for key, value in app.items()
+            if key in validation.APP_FIELDS}
+        self.assertEqual([], validation.validate(app))
+
+    def test_unknown_key_suggests_field(self):
+        errors = validation.validate_app({"id": "/a", "intances": 1})
+        self.assertIn("/a: missing \"instances\"", errors)
+        self.assertIn("/a: unknown key \"intances\", did you mean "
+            "\"instances\"", errors)
+
+    def test_wrong_types(self):
+        errors = validation.validate_app({"id": "/a", "instances": "2",
+            "cpus": True, "env": []})
+        self.assertEqual(3, len(errors))
+
+    def test_port_definitions(self):
+        errors = validation.validate_app({"id": "/a", "instances": 1,
+            "portDefinitions": [{"port": 8080}, {"port": 8080},
+            {"port": 70000}, {"port": 0, "protocol": "http"}, {}]})
+        self.assertEqual(4, len(errors))
+
+    def test_group_dependencies_and_all_errors(self):
+        group = {"id": "grp", "groups": [{"id": "sub", "groups": [], "apps": [
+            {"id": "/grp/sub/a", "instances": 1, "dependencies": ["b",
+                "/grp/sub/c"]},
+            {"id": "/grp/sub/b", "instances": 1, "dependencies": ["../x"]}]}]}
+        errors = validation.validate(group)
+        self.assertEqual(["/grp/sub/a: dependency \"/grp/sub/c\" is not in "
+            "the group", "/grp/sub/b: dependency \"../x\" is not in the "
+            "group"], errors)